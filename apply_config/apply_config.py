@@ -9,6 +9,12 @@ device specified in the filename, E.g. merge_config_ios.txt for Cisco IOS or
 merge_config_junos.txt for Juniper Junos. Call the files "replace_" to perform
 a replace operation, E.g. replace_config_junos.txt or replace_config_ios.txt.
 
+The config is applied in two phases. First the config is loaded on every
+device and the diff is collected, then discarded, -w devices at a time.
+Then the config is committed to the devices with a diff, the --canary
+devices first and then --commit-workers devices at a time. A dry run stops
+after the first phase.
+
 sudo -H pip3 install napalm
 
 example inventory.yml:
@@ -24,28 +30,18 @@ R2:
 
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-from jnpr.junos.exception import ConnectUnknownHostError as JuniperConnectUnknownHostError
-from jnpr.junos.exception import CommitError as JuniperCommitError
-from jnpr.junos.exception import RpcTimeoutError as JuniperRpcTimeoutError
-from jnpr.junos.exception import UnlockError as JuniperUnlockError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.ssh_exception import NetMikoAuthenticationException
 import os
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
 import sys
-import yaml
+
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
 
 
 def build_inventory(args):
@@ -100,13 +96,13 @@ def check_config_files_exist(args, inventory):
     # directory exists
     if not os.path.isdir(args['configs']):
         print("Path to config file(s) directory doesn't exist: {}".
-               format(conf_dir))
+               format(args['configs']))
         return False
 
     # Check all types of command files exist within the config directory
     for dev, opt in inventory.items():
 
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             continue
 
         if args['host']:
@@ -144,6 +140,14 @@ def check_log_path_exists(log_dir):
         return True
 
 
+def close_device(dev, device):
+
+    try:
+        device.close()
+    except drivers.get_napalm_exception('UnlockError'):
+        print("Unable to unlock config for {}".format(dev))
+
+
 def commit_check(dev, device):
 
     """
@@ -151,29 +155,233 @@ def commit_check(dev, device):
     however, there is one available within the PyEz library. Below this is
     accessed directly through NAPALMs instantiation of the PyEZ library
     https://github.com/Juniper/py-junos-eznc/blob/master/lib/jnpr/junos/utils/config.py
+    Returns False if the check failed.
     """
 
     try:
         check = device.device.cu.commit_check()
         if not check:
             print("Commit check failed on {}: {}".format(dev, check))
+            return False
         else:
             print("Commit check passed on {}".format(dev))
-    except JuniperCommitError as e:
+            return True
+    except drivers.get_junos_exception('CommitError') as e:
         print("Commit check failed on {}: {}".format(dev, e))
     except Exception as e:
         print("Couldn't run commit check on {}: {}".format(dev, e))
 
+    return False
 
-def filter_inv(inventory, os_type):
 
-    # Filter the inventory down to the specified type:
-    filtered_inv = {}
-    for dev, opt in inventory.items():
-        if opt['os'] == os_type:
-            filtered_inv[dev] = opt
+def commit_config(args, dev, device, dev_os):
+
+    # Commit message is only supported on Junos
+    if dev_os == 'junos':
+        note = args['note']
+    else:
+        note = None
+
+    if args['replace']:
+        print("Replacing config on {}...".format(dev))
+        return replace_config(dev, device, note)
+    else:
+        print("Merging config on {}...".format(dev))
+        return merge_config(dev, device, note)
+
+
+def commit_device(args, dev, opt, diffs):
+
+    """
+    Connect to a device again, load the config and commit it, as long as the
+    diff is still the same as its diff in diffs from diff_device(). If the
+    config on the device has changed since then nothing is committed.
+    Returns False if the config wasn't committed.
+    """
+
+    print("Committing {}...".format(dev))
+
+    dev_os = opt['os']
+    device = connect_device(dev, opt)
+    if not device:
+        return False
+
+    ret_val = False
+
+    # Always close the session, even after an unexpected error
+    try:
+        if load_config(args, get_config_file(args, dev, dev_os), dev, device):
+            current_diff = get_diff(dev, device)
+            if current_diff is False:
+                pass
+            elif current_diff != diffs[dev]:
+                print("The diff for {} has changed since it was checked, not "
+                      "committing:\n{}".format(dev, current_diff))
+            else:
+                ret_val = commit_config(args, dev, device, dev_os)
+
+            discard_config(dev, device)
+    finally:
+        close_device(dev, device)
+
+    print("{} {}".format(dev, "committed" if ret_val else "not committed"))
+
+    return ret_val
+
+
+def commit_inventory(args, inventory, devs, diffs):
+
+    """
+    Commit the config to the devices with a diff. The first --canary devices
+    are committed on their own, if any of them fail nothing else is
+    committed. The remaining devices are committed --commit-workers at a
+    time. Returns a list of the devices which weren't committed.
+    """
+
+    canary = devs[:args['canary']]
+    remaining = devs[args['canary']:]
+
+    if canary:
+        print("\nCommitting to {} canary device(s): {}".
+              format(len(canary), ", ".join(canary)))
+        results = run_pool(args, inventory, canary, args['commit_workers'],
+                           commit_device, diffs)
+        failed = [dev for dev in canary if not results[dev]]
+        if failed:
+            print("Canary commit failed on {}, not committing to the "
+                  "remaining {} device(s)".
+                  format(", ".join(failed), len(remaining)))
+            return failed + remaining
+
+    if not remaining:
+        return []
+
+    print("\nCommitting to {} device(s) using {} workers".
+          format(len(remaining), args['commit_workers']))
+    results = run_pool(args, inventory, remaining, args['commit_workers'],
+                       commit_device, diffs)
+
+    return [dev for dev in remaining if not results[dev]]
+
+
+def configure_device(args, dev, device, dev_os):
+
+    """
+    Load, diff and (unless this is a dry run) commit the config on a device
+    which is already connected, in a single session. The device isn't closed
+    so that the caller can keep using it. Returns False if the config
+    couldn't be loaded or committed.
+    """
+
+    diff = load_and_diff(args, dev, device, dev_os)
+    if diff is False:
+        discard_config(dev, device)
+        return False
+
+    ret_val = True
+    if not args['dry_run']:
+        ret_val = commit_config(args, dev, device, dev_os)
+
+    discard_config(dev, device)
+
+    return ret_val
 
-    return filtered_inv
+
+def connect_device(dev, opt):
+
+    """
+    Return an open NAPALM session to a device, or False if it couldn't be
+    connected to.
+    """
+
+    driver = drivers.get_network_driver(opt['os'])
+
+    # If Kwargs doesn't have exactly the keys required (no extras)
+    # driver() will throw an exception
+    device = driver(**drivers.get_driver_args(opt))
+
+    # Try to get the transport port number and type for debug messages
+    port = get_port(device)
+    transport = get_transport(device)
+
+    # Connect to the device
+    try:
+       device.open()
+    except drivers.get_auth_errors():
+        print("Couldn't authenticate to {} as {}".
+              format(opt['hostname'], opt['username']))
+        return False
+    except drivers.get_connect_errors():
+        print("Couldn't connect to: {} using {} on port {}".
+              format(opt['hostname'], transport, port))
+        return False
+    except drivers.get_napalm_exception('LockError'):
+        print("Couldn't lock configuration for {}".format(dev))
+        return False
+
+    return device
+
+
+def diff_device(args, dev, opt):
+
+    """
+    Connect to a single device, load the config and get the diff, then
+    discard the config without committing it. Returns the diff, which is
+    empty if there are no changes, or False if the config couldn't be
+    loaded or failed the commit check.
+    """
+
+    print("Trying {}...".format(dev))
+
+    device = connect_device(dev, opt)
+    if not device:
+        return False
+
+    # Always close the session, even after an unexpected error
+    try:
+        diff = load_and_diff(args, dev, device, opt['os'])
+        discard_config(dev, device)
+    finally:
+        close_device(dev, device)
+
+    print("{} done".format(dev))
+
+    return diff
+
+
+def diff_inventory(args, inventory):
+
+    """
+    Load the config and get the diff of every device, --workers devices at a
+    time. Nothing is committed. Returns a dict of {dev: diff}, the diff is
+    False for a device which failed.
+    """
+
+    print("Loading config on {} device(s) using {} workers".
+          format(len(inventory.keys()), args['workers']))
+
+    return run_pool(args, inventory, list(inventory.keys()), args['workers'],
+                    diff_device)
+
+
+def discard_config(dev, device):
+
+    try:
+        device.discard_config()
+    except Exception as e:
+        print("Couldn't discard the candidate config on {}: {}".format(dev, e))
+
+
+def get_config_file(args, dev, dev_os):
+
+    if args['target']:
+        return args['configs']
+    elif args['host']:
+        return os.path.join(args['configs'], dev+'.txt')
+    elif args['replace']:
+        return os.path.join(args['configs'], 'replace_config_'+dev_os+'.txt')
+    else:
+        return os.path.join(args['configs'], 'merge_config_'+dev_os+'.txt')
 
 
 def get_diff(dev, device):
@@ -214,37 +422,75 @@ def get_transport(device):
     return transport
 
 
-def load_inv(args):
+def load_and_diff(args, dev, device, dev_os):
 
-    print("Loading inventory {}".format(args['inventory_file']))
+    """
+    Load the config on a connected device, log the diff and run the commit
+    check if enabled. The candidate config is left loaded. Returns the diff,
+    or False if the config couldn't be loaded or failed the commit check.
+    """
 
-    # Load the initial inventory from a YAML file
-    try:
-        inventory_file = open(args['inventory_file'])
-    except Exception as e:
-        print("Couldn't open inventory file {}".format(e))
-        sys.exit(1)
+    config_file = get_config_file(args, dev, dev_os)
+
+    timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
+    output_file = args['log_dir']+'/'+dev+'_'+timestamp+'.txt'
 
     try:
-        raw_inventory = yaml.load(inventory_file)
+        output_log = open(output_file, "w")
     except Exception as e:
-        print("Couldn't load inventory YAML: {}".format(e))
-        sys.exit(1)
+        print("Couldn't open output log file {}: {}".format(output_file, e))
+        return False
+
+    if not load_config(args, config_file, dev, device):
+        output_log.close()
+        return False
+
+    diff = get_diff(dev, device)
+    if diff is False: # get_diff returned an error
+        output_log.close()
+        return False
+    elif not diff:
+        print("No config changes for {}".format(dev))
+    else:
+        print("{} diff:\n{}".format(dev, diff))
+        output_log.write('#'+dev+'\n')
+        output_log.write(diff+'\n\n')
 
-    inventory_file.close()
+    output_log.close()
 
-    # Filter the inventory to a specific device OS if specified
-    if args['os']:
-        filtered_inv = filter_inv(raw_inventory, args['os'])
+    # "commit check" is only supported on Junos
+    if args['verify'] and dev_os == 'junos':
+        if not commit_check(dev, device):
+            return False
+
+    return diff
+
+
+def load_config(args, config_file, dev, device):
+
+    if args['replace']:
+        return load_replace(config_file, dev, device)
     else:
-        filtered_inv = raw_inventory
+        return load_merge(config_file, dev, device)
+
+
+def load_inv(args):
+
+    print("Loading inventory {}".format(args['inventory_file']))
+
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # to the devices matching the selector and device OS if specified
+    filtered_inv = inventory_cache.load_inv(args['inventory_file'],
+                                            args['select'], args['os'])
+    if filtered_inv is False:
+        sys.exit(1)
 
     inventory = filtered_inv.copy()
 
     for dev, opt in filtered_inv.items():
 
         # Remove any unsupported OS types from the inventory
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             print("Removing {}, unsupported device OS type: {}".
                   format(dev, opt['os']))
             inventory.pop(dev)
@@ -262,12 +508,12 @@ def load_merge(config_file, dev, device):
 
     try:
         device.load_merge_candidate(filename=config_file)
-        print("Loaded merge config")
+        print("Loaded merge config on {}".format(dev))
         return True
-    except MergeConfigException as e:
+    except drivers.get_napalm_exception('MergeConfigException') as e:
         print("Couldn't load merge config for {}: {}".format(dev, e))
         return False
-    except LockError as e:
+    except drivers.get_napalm_exception('LockError') as e:
         print("Lock error during load_merge\n"
               "Is there uncommited config present on {}\n"
               "{}".format(dev, e))
@@ -278,12 +524,13 @@ def load_replace(config_file, dev, device):
 
     try:
         device.load_replace_candidate(filename=config_file)
-        print("Loaded replace config")
+        print("Loaded replace config on {}".format(dev))
         return True
-    except (ReplaceConfigException, FileNotFoundError) as e:
+    except (drivers.get_napalm_exception('ReplaceConfigException'),
+            FileNotFoundError) as e:
         print("Couldn't load replace config for {}: {}".format(dev, e))
         return False
-    except LockError as e:
+    except drivers.get_napalm_exception('LockError') as e:
         print("Lock error during load_replace\n"
               "Is there uncommited config present on {}\n"
               "{}".format(dev, e))
@@ -294,16 +541,19 @@ def merge_config(dev, device, note):
 
     try:
         device.commit_config(message=note)
-        print("Merged")
-    except JuniperCommitError as e:
+        print("Merged config on {}".format(dev))
+        return True
+    except drivers.get_junos_exception('CommitError') as e:
         print("Couldn't merge config on {} (JuniperCommitError): {}".format(dev, e))
-    except JuniperRpcTimeoutError as e:
+    except drivers.get_junos_exception('RpcTimeoutError') as e:
         print("Couldn't merge config on {} (JuniperRpcTimeoutErroras): {}".format(dev, e))
-    except JuniperUnlockError as e:
+    except drivers.get_junos_exception('UnlockError') as e:
         print("Couldn't merge config on {} (JuniperUnlockError): {}".format(dev, e))
-    except MergeConfigException as e:
+    except drivers.get_napalm_exception('MergeConfigException') as e:
         print("Couldn't merge config on {} (MergeConfigException): {}".format(dev, e))
 
+    return False
+
 
 def parse_cli_args():
 
@@ -320,6 +570,21 @@ def parse_cli_args():
         type=str,
         default='./configs/',
     )
+    parser.add_argument(
+        '--canary',
+        help='Number of devices to commit the config to first, on their own. '
+             'If any of them fail the config isn\'t committed to any other '
+             'device.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--commit-workers',
+        help='Number of devices to commit the config to concurrently, after '
+             'the canary devices.',
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '-d', '--dry-run',
         help='Perform a dry run, only generate a diff for each device.',
@@ -360,8 +625,9 @@ def parse_cli_args():
     parser.add_argument(
         '-o', '--os',
         help='Only process devices from the inventory file with the specific '
-             'OS type e.g. ios or junos. This is optional with an inventory '
-             'file but mandatory for a single device when using -t|--target.',
+             'OS type e.g. ios or junos, the same as -s os=<type>. This is '
+             'optional with an inventory file but mandatory for a single '
+             'device when using -t|--target.',
         type=str,
         default=None,
     )
@@ -385,6 +651,15 @@ def parse_cli_args():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--target',
         help='Hostname or IP of target device to configure. When using this '
@@ -408,6 +683,14 @@ def parse_cli_args():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of devices to load the config on and get the diff from '
+             'concurrently. Nothing is committed while the diffs are '
+             'collected.',
+        type=int,
+        default=1,
+    )
 
     return vars(parser.parse_args())
 
@@ -416,16 +699,50 @@ def replace_config(dev, device, note):
 
     try:
         device.commit_config(message=note)
-        print("Replaced")
-    except JuniperCommitError as e:
+        print("Replaced config on {}".format(dev))
+        return True
+    except drivers.get_junos_exception('CommitError') as e:
         print("Couln't replace config on {} (JuniperCommitError): {}".format(dev, e))
-    except JuniperRpcTimeoutError as e:
+    except drivers.get_junos_exception('RpcTimeoutError') as e:
         print("Couldn't replace config on {} (JuniperRpcTimeoutErroras): {}".format(dev, e))
-    except JuniperUnlockError as e:
+    except drivers.get_junos_exception('UnlockError') as e:
         print("Couldn't replace config on {} (JuniperUnlockError): {}".format(dev, e))
-    except ReplaceConfigException as e:
+    except drivers.get_napalm_exception('ReplaceConfigException') as e:
         print("Couldn't replace config on {} (ReplaceConfigException): {}".format(dev, e))
 
+    return False
+
+
+def run_pool(args, inventory, devs, workers, func, *func_args):
+
+    """
+    Run func(args, dev, opt, *func_args) for each of devs using a bounded
+    pool of worker threads. Each device gets its own copy of its inventory
+    options. Returns a dict of {dev: result}, the result is False for a
+    device which raised an unexpected error.
+    """
+
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+
+        futures = {}
+        for dev in devs:
+            future = pool.submit(func, args, dev, dict(inventory[dev]),
+                                 *func_args)
+            futures[future] = dev
+
+        for future in as_completed(futures):
+            # Isolate each device, an unexpected error on one device must
+            # not stop the remaining devices
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print("Error processing {}: {}".format(futures[future], e))
+                results[futures[future]] = False
+
+    return results
+
 
 def set_dev_opts(args, opt):
 
@@ -476,148 +793,25 @@ def main():
     if args['dry_run']:
         print("Dry run enabled!")
 
+    # Collect the diff of every device first, then only commit to the
+    # devices which have changes
+    diffs = diff_inventory(args, inventory)
 
-    ret_val = True
-    for dev, opt in inventory.items():
-
-        print("")
-        print("Trying {}...".format(dev))
-
-
-        if args['target']:
-            config_file = args['configs']
-        elif args['host']:
-            config_file = args['configs']+'/'+dev+'.txt'
-        elif args['replace']:
-            config_file = args['configs']+'replace_config_'+opt['os']+'.txt'
-        else:
-            config_file = args['configs']+'merge_config_'+opt['os']+'.txt'
-
-
-        timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
-        output_file = args['log_dir']+'/'+dev+'_'+timestamp+'.txt'
-
-        try:
-            output_log = open(output_file, "w")
-        except Exception as e:
-            print("Couldn't open output log file {}: {}".format(output_file, e))
-            ret_val = False
-            continue
-
-
-        if ( (args['note'] != None) and (opt['os'] != 'junos') ):
-            # Commit message is only supported on Junos
-            args['note'] = None
-
-
-        # Record if this is a junos device to allow the user of "commit check"
-        if opt['os'] == 'junos':
-            junos = True
-        else:
-            junos = False
-
-
-        driver = napalm.get_network_driver(opt['os'])
-        
-        # If Kwargs doesn't have exactly the keys required (no extras)
-        # driver() will throw an exception
-        opt.pop('os')
-        device = driver(**opt)
-
-        # Try to get the transport port number and type for debug messages
-        port = get_port(device)
-        transport = get_transport(device)
-
-        # Connect to the device
-        try:
-           device.open()
-        except (JuniperConnectAuthError, NetMikoAuthenticationException):
-            print("Couldn't authenticate to {} as {}".
-                  format(opt['hostname'], opt['username']))
-            ret_val = False
-            continue
-        except (ConnectionException, JuniperConnectRefusedError, 
-                JuniperConnectUnknownHostError, SocketError,
-                SocketTimeout, SSHException):
-            print("Couldn't connect to: {} using {} on port {}".
-                  format(opt['hostname'], transport, port))
-            ret_val = False
-            continue
-        except LockError:
-            print("Couldn't lock configuration for {}".format(dev))
-            ret_val = False
-            continue
-        
-
-        # Perform a full device configuration replace operation
-        if args['replace']:
-            
-            if not load_replace(config_file, dev, device):
-                ret_val = False
-                continue
-
-            diff = get_diff(dev, device)
-            if not diff:
-                print("No config changes for {}".format(dev))
-            elif diff == False: # get_diff returned an error
-                device.close()
-                ret_val = False
-                continue
-            else:
-                print("{} diff:\n{}".format(dev, diff))
-                output_log.write('#'+dev+'\n')
-                output_log.write(diff+'\n\n')
-
-            if args['verify'] and junos:
-                commit_check(dev, device)
-
-            if not args['dry_run']:
-                print("Replacing config...")
-                replace_config(dev, device, args['note'])
-
-
-        # Perform a merge config operation
-        else:
-
-            if not load_merge(config_file, dev, device):
-                ret_val = False
-                continue
-
-            diff = get_diff(dev, device)
-            if not diff:
-                print("No config changes for {}".format(dev))
-            elif diff == False: # get_diff returned an error
-                device.close()
-                ret_val = False
-                continue
-            else:
-                print("{} diff:\n{}".format(dev, diff))
-                output_log.write('#'+dev+'\n')
-                output_log.write(diff+'\n\n')
+    failed = [dev for dev in inventory if diffs[dev] is False]
+    changed = [dev for dev in inventory if diffs[dev]]
 
-            if args['verify'] and junos:
-                commit_check(dev, device)
+    print("\n{} device(s) with config changes, {} without, {} failed".
+          format(len(changed), len(inventory) - len(changed) - len(failed),
+                 len(failed)))
 
-            if not args['dry_run']:
-                print("Merging config...")
-                merge_config(dev, device, args['note'])
+    if changed and not args['dry_run']:
+        failed += commit_inventory(args, inventory, changed, diffs)
 
-
-        device.discard_config()
-        output_log.close()
-
-        try:
-            device.close()
-        except UnlockError:
-            print("Unable to unlock config for {}".format(dev))
-
-        print("{} done".format(dev))
-
-
-    if ret_val:
-        sys.exit(0)
-    else:
+    if failed:
+        print("Failed device(s): {}".format(", ".join(sorted(failed))))
         sys.exit(1)
+    else:
+        sys.exit(0)
 
 
 if __name__ == '__main__':
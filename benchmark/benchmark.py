@@ -0,0 +1,671 @@
+#!/usr/bin/python3
+
+"""
+Benchmark how long each script in this repo takes to start up and to reach
+its first useful work, and how much memory it uses.
+
+For each script this records:
+* The cold start time of "<script> -h" (a new interpreter each run)
+* The import time of each top level package, from python -X importtime
+* The time to the first line of output and to the first useful work (e.g.
+  "Trying R1...") when run against a canned inventory, and the total time
+* The peak RSS of each run
+
+Devices are replaced with NAPALM's mock driver (see mock_run.py) so this runs
+offline. The results are saved as JSON and can be compared to the results of
+an earlier run to catch start up regressions:
+
+./benchmark.py -o before.json
+./benchmark.py -o after.json -b before.json
+"""
+
+
+import argparse
+from datetime import datetime
+import importlib.metadata
+import importlib.util
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_RUN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'mock_run.py')
+
+# The scripts to benchmark. "args" is the canned run of each script, the
+# {placeholders} are filled in by build_args(). "ready" matches the first
+# line of output which shows the script has started its real work, and
+# "mock" runs the script through mock_run.py.
+BENCHMARKS = {
+    'apply_config': {
+        'script': 'apply_config/apply_config.py',
+        'args': ['-i', '{inventory}', '-c', '{repo}/apply_config/configs',
+                 '-d', '-u', 'bench', '-p', 'bench', '-l', '{work}/apply'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'diff_per_cmd_output': {
+        'script': 'diff_per_cmd_output/diff_per_cmd_output.py',
+        'args': ['-pre', '{repo}/diff_per_cmd_output/logs/before/R3-IOSXE',
+                 '-post', '{repo}/diff_per_cmd_output/logs/after/R3-IOSXE',
+                 '-o', 'ios', '-m', '', '-d', '{work}/diff.txt',
+                 '-f', '{repo}/diff_per_cmd_output/diff_filter.yml'],
+        'ready': r'^Comparing ',
+        'mock': False,
+    },
+    'get_version': {
+        'script': 'napalm_getters/get_version.py',
+        'args': ['-i', '{inventory}', '-u', 'bench'],
+        'ready': r'.',
+        'mock': True,
+    },
+    'inventory_cache': {
+        'script': 'common/inventory_cache.py',
+        'args': ['-i', '{inventory}', '-s', 'os=junos'],
+        'ready': r'.',
+        'mock': False,
+    },
+    'napalm_getters': {
+        'script': 'napalm_getters/napalm_getters.py',
+        'args': ['-i', '{inventory}', '-u', 'bench', '-l', '{work}/getters',
+                 '-c', '{work}/getter_cache', '--ttl-file', ''],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'network_change': {
+        'script': 'network_change/network_change.py',
+        'args': ['-rollback', '-force-rollback', '-ref', 'bench', '-i',
+                 '{inventory}', '-u', 'bench', '-scripts', '{repo}/'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'rollback': {
+        'script': 'rollback/rollback.py',
+        'args': ['-i', '{inventory}', '-u', 'bench', '-p', 'bench'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'run_and_log_per_cmd': {
+        'script': 'run_and_log_per_cmd/run_and_log_per_cmd.py',
+        'args': ['-i', '{inventory}', '-c', '{repo}/run_and_log_per_cmd/commands',
+                 '-u', 'bench', '-p', 'bench', '-l', '{work}/per_cmd'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'run_and_log_per_device': {
+        'script': 'run_and_log_per_device/run_and_log_per_device.py',
+        'args': ['-i', '{inventory}', '-c', '{repo}/run_and_log_per_cmd/commands',
+                 '-u', 'bench', '-l', '{work}/per_device'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'run_cmd': {
+        'script': 'run_cmd/run_cmd.py',
+        'args': ['-i', '{inventory}', '-s', 'os=ios', '-c', 'show version',
+                 '-u', 'bench', '-p', 'bench'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'run_commands_ntc': {
+        'script': 'run_commands_ntc/run_commands_ntc.py',
+        'args': ['-i', '{inventory}', '-c', '{repo}/run_and_log_per_cmd/commands',
+                 '-u', 'bench', '-l', '{work}/ntc'],
+        'ready': r'^Trying ',
+        'mock': True,
+    },
+    'syntax_check': {
+        'script': 'syntax_check/syntax_check.py',
+        'args': ['-c', '{repo}/syntax_check/good_configs/merge_config_ios.txt',
+                 '-t', 'ios', '--cache-file', ''],
+        'ready': r'^Syntax checking',
+        'mock': False,
+    },
+}
+
+# Canned CLI output for the mock devices, from the logs in this repo
+MOCK_LOGS = {
+    'ios': 'run_and_log_per_cmd/logs/R3-IOSXE',
+    'junos': 'run_and_log_per_cmd/logs/R2-Junos',
+}
+
+# Metrics compared against a baseline, as (section, key)
+METRICS = [
+    ('help', 'time'),
+    ('help', 'max_rss_kb'),
+    ('run', 'ready_time'),
+    ('run', 'time'),
+    ('run', 'max_rss_kb'),
+]
+
+
+def build_args(args, work_dir, inventory_file):
+
+    values = {
+        'inventory': inventory_file,
+        'repo': REPO_DIR,
+        'work': work_dir,
+    }
+
+    return [arg.format(**values) for arg in args]
+
+
+def build_inventory(work_dir, devices):
+
+    """
+    Write an inventory of devices alternating between IOS and Junos, and
+    return the filename.
+    """
+
+    inventory_file = os.path.join(work_dir, 'inventory.yml')
+
+    with open(inventory_file, 'w') as inventory:
+        for i in range(devices):
+            dev_os = 'ios' if i % 2 == 0 else 'junos'
+            inventory.write("bench-{}:\n".format(i))
+            inventory.write("  hostname: 192.0.2.{}\n".format(i % 250 + 1))
+            inventory.write("  os: {}\n".format(dev_os))
+            inventory.write("  password: bench\n")
+
+    return inventory_file
+
+
+def build_mock_dir(work_dir):
+
+    """
+    Write the canned output read by NAPALM's mock driver for each device
+    type. Returns the mock directory or False if NAPALM isn't installed.
+    """
+
+    getters = get_napalm_getters()
+    if getters is False:
+        return False
+
+    sys.path.insert(0, os.path.dirname(MOCK_RUN))
+    from mock_run import sanitise_cmd
+
+    mock_dir = os.path.join(work_dir, 'mock')
+
+    # Every getter returns an empty result, except the facts which
+    # get_version.py prints
+    mocked = {name: {} for name in getters}
+    mocked['compare_config'] = {'diff': '+ benchmark'}
+    mocked['get_facts'] = {
+        'fqdn': 'bench', 'hostname': 'bench', 'interface_list': [],
+        'model': 'bench', 'os_version': 'bench', 'serial_number': 'bench',
+        'uptime': 0, 'vendor': 'bench',
+    }
+    for name in ['commit_config', 'discard_config', 'load_merge_candidate',
+                 'load_replace_candidate']:
+        mocked[name] = {}
+
+    for dev_os, log_dir in MOCK_LOGS.items():
+        os_dir = os.path.join(mock_dir, dev_os)
+        os.makedirs(os_dir, exist_ok=True)
+
+        for name, result in mocked.items():
+            with open(os.path.join(os_dir, name+'.1'), 'w') as mock_file:
+                json.dump(result, mock_file)
+
+        log_dir = os.path.join(REPO_DIR, log_dir)
+        for log_file in os.listdir(log_dir):
+            cmd = os.path.splitext(log_file)[0]
+            shutil.copyfile(os.path.join(log_dir, log_file),
+                            os.path.join(os_dir, 'cli.'+sanitise_cmd(cmd)))
+
+    return mock_dir
+
+
+def compare_results(results, baseline, threshold):
+
+    """
+    Print the change in each metric from the baseline results. Returns False
+    if any metric is more than threshold percent worse than the baseline, or
+    if a script's -h or canned run fails when it didn't in the baseline.
+    """
+
+    ret_val = True
+
+    print("\n{:<24} {:<16} {:>12} {:>12} {:>8}".
+          format("Script", "Metric", "Baseline", "Current", "Change"))
+
+    for name, result in sorted(results['scripts'].items()):
+        if name not in baseline.get('scripts', {}):
+            continue
+
+        for section in ['help', 'run']:
+            before = get_failure(baseline['scripts'][name].get(section))
+            current = get_failure(result.get(section))
+            if current and not before:
+                print("{:<24} {:<16} {:>12} {:>12}  REGRESSION".
+                      format(name, section, "ok", "failed"))
+                ret_val = False
+
+        for section, key in METRICS:
+            current = result.get(section, {}).get(key)
+            before = baseline['scripts'][name].get(section, {}).get(key)
+            if not current or not before:
+                continue
+
+            change = (current - before) / before * 100
+            flag = ""
+            if change > threshold:
+                flag = " REGRESSION"
+                ret_val = False
+
+            print("{:<24} {:<16} {:>12} {:>12} {:>+7.1f}%{}".
+                  format(name, section+'.'+key, format_metric(key, before),
+                         format_metric(key, current), change, flag))
+
+    return ret_val
+
+
+def format_metric(key, value):
+
+    if key.endswith('_kb'):
+        return "{:.1f}MB".format(value / 1024)
+
+    return "{:.3f}s".format(value)
+
+
+def get_failure(result):
+
+    """
+    Return a short description of why a -h or canned run measurement failed,
+    or None if it succeeded or wasn't measured.
+    """
+
+    if not result:
+        return None
+
+    if 'error' in result:
+        lines = result['error'].strip().splitlines()
+        return lines[-1] if lines else "failed"
+
+    if result.get('returncode'):
+        return "exited with {}".format(result['returncode'])
+
+    return None
+
+
+def get_napalm_getters():
+
+    """
+    Return the names of the getters of NAPALM's NetworkDriver, or False if
+    NAPALM isn't installed. They are read from napalm/base/base.py rather
+    than importing NAPALM, as the benchmark scripts are forked from this
+    process and their peak RSS would include NAPALM.
+    """
+
+    spec = importlib.util.find_spec('napalm')
+    if not spec:
+        return False
+
+    path = os.path.join(spec.submodule_search_locations[0], 'base', 'base.py')
+    try:
+        with open(path) as base_file:
+            source = base_file.read()
+    except Exception as e:
+        print("Couldn't read NAPALM drivers {}: {}".format(path, e))
+        return False
+
+    return re.findall(r'^    def (get_\w+)\(', source, re.MULTILINE)
+
+
+def get_napalm_version():
+
+    try:
+        return importlib.metadata.version('napalm')
+    except Exception:
+        return None
+
+
+def load_baseline(filename):
+
+    try:
+        with open(filename) as baseline_file:
+            return json.load(baseline_file)
+    except Exception as e:
+        print("Couldn't load baseline results {}: {}".format(filename, e))
+        return False
+
+
+def measure_help(script, repeat, timeout):
+
+    """
+    Time "<script> -h" repeat times, each in a new interpreter.
+    """
+
+    times = []
+    max_rss_kb = 0
+
+    for _ in range(repeat):
+        result = run_process([sys.executable, script, '-h'], timeout=timeout)
+        if result['returncode'] != 0:
+            return {'error': result['stderr']}
+        times.append(result['time'])
+        max_rss_kb = max(max_rss_kb, result['max_rss_kb'])
+
+    return {
+        'max_rss_kb': max_rss_kb,
+        'median_time': statistics.median(times),
+        'time': min(times),
+        'times': times,
+    }
+
+
+def measure_imports(script, top, timeout):
+
+    """
+    Return the total import time of "<script> -h" and the cumulative import
+    time of the top level packages which took the longest, in microseconds.
+    """
+
+    result = run_process([sys.executable, '-X', 'importtime', script, '-h'],
+                         timeout=timeout)
+
+    packages = {}
+    total = 0
+
+    for line in result['stderr'].splitlines():
+        match = re.match(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line)
+        if not match:
+            continue
+        # Only count the modules imported directly, which are not indented,
+        # as their cumulative time includes everything they import
+        if match.group(3):
+            continue
+        package = match.group(4).split('.')[0]
+        packages[package] = packages.get(package, 0) + int(match.group(2))
+        total += int(match.group(2))
+
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+    return {
+        'packages': [{'package': package, 'cumulative_us': us}
+                     for package, us in slowest[:top]],
+        'total_us': total,
+    }
+
+
+def measure_run(benchmark, work_dir, inventory_file, mock_dir, repeat,
+                timeout):
+
+    """
+    Run the canned run of a script repeat times and return the fastest time
+    to the first line of output, to the first useful work and to exit.
+    """
+
+    script = os.path.join(REPO_DIR, benchmark['script'])
+    cmd = [sys.executable]
+    if benchmark['mock']:
+        cmd += [MOCK_RUN, mock_dir]
+    cmd += [script] + build_args(benchmark['args'], work_dir, inventory_file)
+
+    runs = []
+    for _ in range(repeat):
+        runs.append(run_process(cmd, ready=benchmark['ready'], stdin='bench\n',
+                                timeout=timeout, cwd=work_dir))
+
+    run = min(runs, key=lambda run: run['time'])
+
+    return {
+        'first_output_time': run['first_output_time'],
+        'max_rss_kb': max(run['max_rss_kb'] for run in runs),
+        'output_lines': run['output_lines'],
+        'ready_time': run['ready_time'],
+        'returncode': run['returncode'],
+        'time': run['time'],
+    }
+
+
+def parse_cli_args():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the start up time, import time and peak memory '
+                    'use of each script in this repo.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-b', '--baseline',
+        help='Compare the results to this earlier results file and exit with '
+             'an error if any metric regressed by more than --threshold.',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '-d', '--devices',
+        help='Number of mock devices in the canned inventory.',
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='Results file (JSON), by default benchmark_<timestamp>.json.',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Number of times to run each script, the fastest run is kept.',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '-s', '--scripts',
+        help='Only benchmark these scripts.',
+        nargs='+',
+        choices=sorted(BENCHMARKS),
+        default=sorted(BENCHMARKS),
+    )
+    parser.add_argument(
+        '--threshold',
+        help='Percentage a metric can be worse than the baseline before it is '
+             'reported as a regression.',
+        type=float,
+        default=25.0,
+    )
+    parser.add_argument(
+        '--timeout',
+        help='Seconds to wait for each run of a script.',
+        type=int,
+        default=120,
+    )
+    parser.add_argument(
+        '--top',
+        help='Number of the slowest packages to import to record per script.',
+        type=int,
+        default=10,
+    )
+
+    return vars(parser.parse_args())
+
+
+def run_process(cmd, ready=None, stdin=None, timeout=120, cwd=None):
+
+    """
+    Run a command and return the time taken to exit, to the first line of
+    output and to the first line matching ready, and its peak RSS.
+    """
+
+    stderr_file = tempfile.TemporaryFile(mode='w+')
+    # Starting a new session detaches the script from the terminal, so that
+    # getpass() reads the password from stdin
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=stderr_file, cwd=cwd, text=True,
+                            start_new_session=True)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+
+    if stdin:
+        try:
+            proc.stdin.write(stdin)
+        except BrokenPipeError:
+            pass
+    proc.stdin.close()
+
+    first_output_time = None
+    ready_time = None
+    output_lines = 0
+    for line in proc.stdout:
+        now = time.perf_counter() - start
+        output_lines += 1
+        if first_output_time is None:
+            first_output_time = now
+        if ready and ready_time is None and re.search(ready, line):
+            ready_time = now
+
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stdout.close()
+
+    stderr_file.seek(0)
+    stderr = stderr_file.read()
+    stderr_file.close()
+
+    return {
+        'first_output_time': first_output_time,
+        # ru_maxrss is in KB on Linux
+        'max_rss_kb': rusage.ru_maxrss,
+        'output_lines': output_lines,
+        'ready_time': ready_time,
+        'returncode': proc.returncode,
+        'stderr': stderr,
+        'time': elapsed,
+    }
+
+
+def print_summary(name, result):
+
+    """
+    Print one line of the results of a script. A -h which failed, a canned
+    run which was skipped and a run with no ready line are shown as such
+    rather than as a time of 0.
+    """
+
+    help_result = result['help']
+    run = result.get('run')
+
+    if 'error' in help_result:
+        summary = ["-h failed"]
+    else:
+        summary = ["-h {} (import {})".format(
+            format_metric('time', help_result['time']),
+            format_metric('time', result['imports']['total_us'] / 1e6),
+        )]
+
+    if not run:
+        summary.append("run skipped")
+    else:
+        if run['ready_time'] is None:
+            summary.append("ready not seen")
+        else:
+            summary.append("ready {}".format(format_metric('time',
+                                                           run['ready_time'])))
+        summary.append("total {}".format(format_metric('time', run['time'])))
+
+    max_rss_kb = help_result.get('max_rss_kb')
+    if run and run['max_rss_kb']:
+        max_rss_kb = run['max_rss_kb']
+    if max_rss_kb:
+        summary.append("peak RSS {}".format(format_metric('max_rss_kb',
+                                                          max_rss_kb)))
+
+    print("  "+", ".join(summary))
+
+    if 'error' in help_result:
+        print("  {} -h failed: {}".format(name, get_failure(help_result)))
+    if run and run['returncode'] != 0:
+        print("  {} exited with {}".format(name, run['returncode']))
+
+
+def save_results(results, filename):
+
+    try:
+        with open(filename, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    except Exception as e:
+        print("Couldn't save results to {}: {}".format(filename, e))
+        return False
+
+    print("\nSaved results to {}".format(filename))
+
+    return True
+
+
+def main():
+
+    args = parse_cli_args()
+
+    baseline = None
+    if args['baseline']:
+        baseline = load_baseline(args['baseline'])
+        if not baseline:
+            sys.exit(1)
+
+    if not args['output']:
+        timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
+        args['output'] = 'benchmark_'+timestamp+'.json'
+
+    results = {
+        'created': datetime.now().isoformat(),
+        'devices': args['devices'],
+        'napalm': get_napalm_version(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'repeat': args['repeat'],
+        'scripts': {},
+    }
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+
+    try:
+        inventory_file = build_inventory(work_dir, args['devices'])
+        mock_dir = build_mock_dir(work_dir)
+        if not mock_dir:
+            print("NAPALM isn't installed, only benchmarking start up for "
+                  "scripts which connect to devices")
+
+        for name in args['scripts']:
+            benchmark = BENCHMARKS[name]
+            script = os.path.join(REPO_DIR, benchmark['script'])
+
+            print("Benchmarking {}...".format(name))
+            result = {
+                'help': measure_help(script, args['repeat'], args['timeout']),
+                'imports': measure_imports(script, args['top'],
+                                           args['timeout']),
+            }
+            if mock_dir or not benchmark['mock']:
+                result['run'] = measure_run(benchmark, work_dir,
+                                            inventory_file, mock_dir,
+                                            args['repeat'], args['timeout'])
+
+            results['scripts'][name] = result
+
+            print_summary(name, result)
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    save_results(results, args['output'])
+
+    if baseline and not compare_results(results, baseline, args['threshold']):
+        sys.exit(1)
+
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
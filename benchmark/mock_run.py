@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+"""
+Run one of the scripts in this repo with every device replaced by NAPALM's
+mock driver, so that it can be benchmarked without a network.
+
+./mock_run.py <mock_dir> <script> [script args...]
+
+The mock driver of each device type reads its canned output from
+<mock_dir>/<os>/, which is created by benchmark.py. The script is run in this
+process with the same sys.argv it would have if it was run directly.
+"""
+
+
+import os
+import re
+import runpy
+import sys
+
+
+def get_mock_driver(mock_dir, os_type):
+
+    from napalm.base.mock import MockDriver
+
+    class BenchmarkDriver(MockDriver):
+
+        """
+        NAPALM's mock driver with the canned output of each device type. The
+        output of cli() is read from cli.<command> rather than one file per
+        call, as the scripts run each command in a separate call.
+        """
+
+        def __init__(self, hostname, username, password, timeout=60,
+                     optional_args=None):
+            optional_args = dict(optional_args or {})
+            optional_args['path'] = os.path.join(mock_dir, os_type)
+            super().__init__(hostname, username, password, timeout,
+                             optional_args)
+
+        def cli(self, commands, encoding='text'):
+            self._raise_if_closed()
+            return {cmd: load_cli_output(self.path, cmd) for cmd in commands}
+
+        def _file_prompt_quiet(self):
+            # Called by rollback.py before "configure replace" on IOS
+            self._raise_if_closed()
+
+    return BenchmarkDriver
+
+
+def load_cli_output(path, cmd):
+
+    try:
+        with open(os.path.join(path, 'cli.'+sanitise_cmd(cmd))) as output:
+            return output.read()
+    except FileNotFoundError:
+        return ""
+
+
+def sanitise_cmd(cmd):
+
+    # The same file name NAPALM's mock driver uses for a command
+    return re.sub('[^a-zA-Z0-9]+', '_', cmd).strip('_')
+
+
+def main():
+
+    if len(sys.argv) < 3:
+        print("Usage: {} <mock_dir> <script> [args...]".format(sys.argv[0]))
+        sys.exit(1)
+
+    mock_dir = os.path.abspath(sys.argv[1])
+    script = os.path.abspath(sys.argv[2])
+
+    # Load the drivers module the script will import and swap the real
+    # NAPALM drivers for the mock driver
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.join(repo_dir, 'common'))
+    import drivers
+    drivers.get_network_driver = (
+        lambda os_type: get_mock_driver(mock_dir, os_type)
+    )
+
+    sys.argv = sys.argv[2:]
+    sys.path[0] = os.path.dirname(script)
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
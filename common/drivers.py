@@ -0,0 +1,150 @@
+"""
+Load NAPALM and the device driver libraries only when a device is about to
+be connected to.
+
+Importing NAPALM, PyEZ (jnpr), Netmiko and Paramiko takes longer than
+everything else the scripts in this repo do before connecting to a device,
+so they aren't imported at the top of the scripts. NAPALM is imported by
+get_network_driver() and each NAPALM driver imports its own library (e.g.
+PyEZ for Junos), so only the driver stack of the devices actually used is
+loaded.
+
+The exceptions of a driver library are looked up with get_exception(). If
+the library hasn't been imported yet none of its exceptions can have been
+raised, so a placeholder exception is returned instead of importing it.
+"""
+
+
+import importlib
+import importlib.util
+import os
+from socket import error as SocketError
+from socket import timeout as SocketTimeout
+import sys
+import threading
+
+
+# The drivers supported by NAPALM if napalm/_SUPPORTED_DRIVERS.py can't be
+# read, see load_supported_drivers()
+DEFAULT_DRIVERS = [
+    'base',
+    'eos',
+    'ios',
+    'iosxr',
+    'junos',
+    'nxos',
+    'nxos_ssh',
+]
+
+# Held while NAPALM and a driver are imported, importing them from several
+# threads at once (e.g. napalm_getters.py -w) can deadlock
+IMPORT_LOCK = threading.Lock()
+
+# The device options from the inventory which are passed to a NAPALM driver,
+# any other fields (e.g. site or tags used by selectors) are left out
+DRIVER_ARGS = (
+    'hostname',
+    'optional_args',
+    'password',
+    'timeout',
+    'username',
+)
+
+# Exceptions raised by device.open() when the login is rejected
+AUTH_ERRORS = [
+    ('jnpr.junos.exception', 'ConnectAuthError'),
+    ('netmiko', 'NetMikoAuthenticationException'),
+]
+
+# Exceptions raised by device.open() when the device can't be reached
+CONNECT_ERRORS = [
+    ('jnpr.junos.exception', 'ConnectRefusedError'),
+    ('jnpr.junos.exception', 'ConnectUnknownHostError'),
+    ('napalm.base.exceptions', 'ConnectionException'),
+    ('paramiko.ssh_exception', 'SSHException'),
+]
+
+
+class NotLoadedError(Exception):
+
+    """
+    Stands in for the exception of a driver library which hasn't been
+    imported, it is never raised.
+    """
+
+
+def get_auth_errors():
+
+    return tuple(get_exception(module, name) for module, name in AUTH_ERRORS)
+
+
+def get_connect_errors():
+
+    errors = [get_exception(module, name) for module, name in CONNECT_ERRORS]
+
+    return tuple(errors) + (SocketError, SocketTimeout)
+
+
+def get_driver_args(opt):
+
+    return {arg: opt[arg] for arg in DRIVER_ARGS if arg in opt}
+
+
+def get_exception(module_name, name):
+
+    """
+    Return the exception class name from module_name if its library has
+    already been imported, otherwise return NotLoadedError.
+    """
+
+    # Check the package the exception module is in rather than the top level
+    # package, jnpr is a namespace package which is loaded at start up
+    package = module_name.rpartition('.')[0] or module_name
+    if package not in sys.modules:
+        return NotLoadedError
+
+    try:
+        return getattr(importlib.import_module(module_name), name)
+    except (AttributeError, ImportError):
+        return NotLoadedError
+
+
+def get_junos_exception(name):
+
+    return get_exception('jnpr.junos.exception', name)
+
+
+def get_napalm_exception(name):
+
+    return get_exception('napalm.base.exceptions', name)
+
+
+def get_network_driver(os_type):
+
+    with IMPORT_LOCK:
+        import napalm
+        return napalm.get_network_driver(os_type)
+
+
+def load_supported_drivers():
+
+    """
+    Return the list of drivers in napalm/_SUPPORTED_DRIVERS.py of the
+    installed NAPALM. Importing napalm._SUPPORTED_DRIVERS would import all
+    of NAPALM first, so the file is loaded on its own instead.
+    """
+
+    try:
+        spec = importlib.util.find_spec('napalm')
+        path = os.path.join(spec.submodule_search_locations[0],
+                            '_SUPPORTED_DRIVERS.py')
+        spec = importlib.util.spec_from_file_location('_SUPPORTED_DRIVERS',
+                                                      path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return list(module.SUPPORTED_DRIVERS)
+    except Exception:
+        return list(DEFAULT_DRIVERS)
+
+
+SUPPORTED_DRIVERS = load_supported_drivers()
@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+
+"""
+Load a YAML device inventory through a compiled binary cache.
+
+The first time an inventory file is loaded it is parsed as YAML and the
+result, with an index of the devices by the value of each of their fields,
+is pickled to a cache file next to the inventory (e.g. inventory.yml.cache).
+Later loads unpickle the cache instead of parsing the YAML again. The cache
+is rebuilt when the mtime or size of the inventory file changes and the
+sha256 hash of its contents no longer matches.
+
+Devices are selected with a comma separated list of terms which must all
+match, using the indexes rather than checking every device:
+
+os=junos             the os field is junos
+site=ld4,role=pe     the site is ld4 and the role is pe
+hostname=10.1.*      the hostname starts with 10.1.
+hostname~^pe[0-9]+   the hostname matches the regular expression
+tags=core            the tags list of the device includes core
+name=R1              the device is named R1 in the inventory
+
+The other scripts in this repo import this module to load their inventory.
+Run it directly to compile the cache ahead of time or to look up devices:
+
+./inventory_cache.py -i inventory.yml -s name=R1
+./inventory_cache.py -i inventory.yml -s os=junos,site=ld4
+"""
+
+
+import argparse
+from bisect import bisect_left
+import fnmatch
+import hashlib
+import os
+import pickle
+import re
+import sys
+import tempfile
+import yaml
+
+
+# Bump this when the layout of the compiled inventory changes
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.cache'
+
+# Inventory fields which aren't indexed and can't be selected on
+UNINDEXED_FIELDS = ('optional_args', 'password')
+
+# A selector term is field=value, field=glob* or field~regex
+SELECTOR_TERM = re.compile(r'^\s*([\w.-]+)\s*([=~])\s*(.*?)\s*$')
+
+# Use the libyaml parser when PyYAML has been built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def build_index(devices):
+
+    """
+    Return a dict of {field: {value: [dev]}} for every scalar field of the
+    devices in the inventory, each item of a list field (e.g. tags) is
+    indexed as a separate value. The device names are indexed as "name".
+    """
+
+    index = {'name': {}}
+
+    for dev, opt in devices.items():
+        index['name'].setdefault(index_value(dev), []).append(dev)
+        if not isinstance(opt, dict):
+            continue
+
+        for field, value in opt.items():
+            if field in UNINDEXED_FIELDS:
+                continue
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                if isinstance(item, (dict, list)) or item is None:
+                    continue
+                index.setdefault(field, {}).setdefault(
+                    index_value(item), []
+                ).append(dev)
+
+    return index
+
+
+def compile_devices(devices):
+
+    """
+    Return the devices with their indexes, as stored in the cache.
+    """
+
+    index = build_index(devices)
+
+    return {
+        'devices': devices,
+        'index': index,
+        'position': {dev: pos for pos, dev in enumerate(devices)},
+        # The values of each field in order, to find prefix matches
+        'sorted': {field: sorted(values) for field, values in index.items()},
+    }
+
+
+def compile_inv(filename, stat, inv_hash):
+
+    try:
+        with open(filename) as inventory_file:
+            devices = yaml.load(inventory_file, Loader=YAML_LOADER)
+    except Exception as e:
+        print("Couldn't load inventory YAML {}: {}".format(filename, e))
+        return False
+
+    if not devices:
+        devices = {}
+    elif not isinstance(devices, dict):
+        print("Inventory file {} isn't a dict of devices".format(filename))
+        return False
+
+    compiled = compile_devices(devices)
+    compiled.update({
+        'hash': inv_hash,
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'version': CACHE_VERSION,
+    })
+
+    return compiled
+
+
+def get_cache_file(filename):
+
+    return filename + CACHE_SUFFIX
+
+
+def hash_file(filename):
+
+    sha256 = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as inventory_file:
+            for block in iter(lambda: inventory_file.read(1024 * 1024), b''):
+                sha256.update(block)
+    except Exception as e:
+        print("Couldn't read inventory file {}: {}".format(filename, e))
+        return False
+
+    return sha256.hexdigest()
+
+
+def index_value(value):
+
+    # Match YAML booleans as they are usually written in the inventory file
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+
+    return str(value)
+
+
+def load_cache(cache_file):
+
+    try:
+        with open(cache_file, 'rb') as cache:
+            compiled = pickle.load(cache)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("Ignoring unreadable inventory cache {}: {}".format(cache_file, e))
+        return None
+
+    if (not isinstance(compiled, dict) or
+        compiled.get('version') != CACHE_VERSION):
+        return None
+
+    return compiled
+
+
+def load_compiled(filename, rebuild=False):
+
+    """
+    Return the compiled inventory for filename, from the cache file if it is
+    still valid, otherwise by parsing the YAML file and rebuilding the cache.
+    Returns False if the inventory can't be loaded.
+    """
+
+    try:
+        stat = os.stat(filename)
+    except Exception as e:
+        print("Couldn't open inventory file {}: {}".format(filename, e))
+        return False
+
+    cache_file = get_cache_file(filename)
+    compiled = None if rebuild else load_cache(cache_file)
+
+    # An unchanged mtime and size means the cache can be used without
+    # reading the inventory file at all
+    if (compiled and compiled['mtime'] == stat.st_mtime_ns and
+        compiled['size'] == stat.st_size):
+        return compiled
+
+    inv_hash = hash_file(filename)
+    if not inv_hash:
+        return False
+
+    # The file was touched (e.g. by a git checkout) but the content is the
+    # same, so only the recorded mtime needs updating
+    if compiled and compiled['hash'] == inv_hash:
+        compiled['mtime'] = stat.st_mtime_ns
+        compiled['size'] = stat.st_size
+        save_cache(cache_file, compiled)
+        return compiled
+
+    compiled = compile_inv(filename, stat, inv_hash)
+    if compiled is False:
+        return False
+
+    save_cache(cache_file, compiled)
+
+    return compiled
+
+
+def load_inv(filename, selector=None, dev_os=None):
+
+    """
+    Return the inventory in filename as a dict of {dev: opt}, optionally
+    only the devices which match selector and are of OS type dev_os.
+    Returns False on error.
+    """
+
+    terms = parse_selector(selector, dev_os)
+    if terms is False:
+        return False
+
+    compiled = load_compiled(filename)
+    if compiled is False:
+        return False
+
+    return select_devices(compiled, terms)
+
+
+def match_term(compiled, field, op, value):
+
+    """
+    Return the set of devices which match a single selector term. Exact and
+    prefix matches are looked up in the index, globs and regular expressions
+    are only checked against the unique values of the field.
+    """
+
+    values = compiled['index'].get(field, {})
+
+    if op == '~':
+        regex = re.compile(value)
+        keys = [key for key in values if regex.search(key)]
+
+    elif value.endswith('*') and not any(c in value[:-1] for c in '*?['):
+        prefix = value[:-1]
+        keys = []
+        ordered = compiled['sorted'].get(field, [])
+        pos = bisect_left(ordered, prefix)
+        while pos < len(ordered) and ordered[pos].startswith(prefix):
+            keys.append(ordered[pos])
+            pos += 1
+
+    elif any(c in value for c in '*?['):
+        keys = [key for key in values if fnmatch.fnmatchcase(key, value)]
+
+    else:
+        keys = [value] if value in values else []
+
+    matches = set()
+    for key in keys:
+        matches.update(values[key])
+
+    return matches
+
+
+def parse_cli_args():
+
+    parser = argparse.ArgumentParser(
+        description='Compile a YAML device inventory into a binary cache and '
+                    'look up devices in it.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-i', '--inventory-file',
+        help='Device inventory file (YAML formatted).',
+        type=str,
+        default='./inventory.yml',
+    )
+    parser.add_argument(
+        '-o', '--os',
+        help='Only show devices with this OS type e.g. ios or junos, the '
+             'same as -s os=<type>.',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '-r', '--rebuild',
+        help='Rebuild the cache even if it is up to date.',
+        default=False,
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '-s', '--select',
+        help='Only show devices which match this selector, a comma separated '
+             'list of field=value, field=prefix* or field~regex terms which '
+             'must all match e.g. os=junos,site=ld4 or tags=core.',
+        type=str,
+        default=None,
+    )
+
+    return vars(parser.parse_args())
+
+
+def parse_selector(selector, dev_os=None):
+
+    """
+    Return a list of (field, op, value) terms from a selector string, with
+    an os term added for dev_os. Returns False if the selector is invalid.
+    """
+
+    terms = []
+
+    for term in (selector or '').split(','):
+        if not term.strip():
+            continue
+
+        match = SELECTOR_TERM.match(term)
+        if not match or not match.group(3):
+            print("Invalid inventory selector term: {}".format(term))
+            return False
+
+        field, op, value = match.groups()
+        if op == '~':
+            try:
+                re.compile(value)
+            except re.error as e:
+                print("Invalid regex in selector term {}: {}".format(term, e))
+                return False
+
+        terms.append((field, op, value))
+
+    if dev_os:
+        terms.append(('os', '=', dev_os))
+
+    return terms
+
+
+def save_cache(cache_file, compiled):
+
+    # Write the cache to a temporary file and rename it into place so that
+    # another script loading the inventory never reads a partial cache
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache:
+            pickle.dump(compiled, cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        print("Couldn't save inventory cache {}: {}".format(cache_file, e))
+        try:
+            os.unlink(tmp_file)
+        except Exception:
+            pass
+        return False
+
+    return True
+
+
+def select_devices(compiled, terms):
+
+    """
+    Return a dict of the devices in the compiled inventory which match all of
+    the selector terms, in the same order as the inventory file.
+    """
+
+    devices = compiled['devices']
+
+    if not terms:
+        return dict(devices)
+
+    # Intersect the smallest sets of matching devices first
+    matches = sorted(
+        (match_term(compiled, field, op, value) for field, op, value in terms),
+        key=len,
+    )
+    selected = matches[0]
+    for devs in matches[1:]:
+        if not selected:
+            break
+        selected = selected & devs
+
+    position = compiled['position']
+
+    return {dev: devices[dev] for dev in sorted(selected, key=position.get)}
+
+
+def select_inv(devices, selector):
+
+    """
+    Return a dict of the devices in an already loaded inventory which match
+    selector. Returns False if the selector is invalid.
+    """
+
+    terms = parse_selector(selector)
+    if terms is False:
+        return False
+
+    return select_devices(compile_devices(devices), terms)
+
+
+def main():
+
+    args = parse_cli_args()
+
+    terms = parse_selector(args['select'], args['os'])
+    if terms is False:
+        sys.exit(1)
+
+    compiled = load_compiled(args['inventory_file'], args['rebuild'])
+    if compiled is False:
+        sys.exit(1)
+
+    devices = select_devices(compiled, terms)
+
+    if devices:
+        print(yaml.dump(devices, default_flow_style=False), end='')
+
+    print("{} of {} device(s) matched, cache {}".
+          format(len(devices), len(compiled['devices']),
+                 get_cache_file(args['inventory_file'])))
+
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Write structured results to an output log file one at a time, as YAML, JSON
+or msgpack.
+
+Each result is serialised and written as soon as output_write() is called,
+so the results of a device aren't held in memory until the end of the run.
+For yaml and json the file is a single mapping of every result, for msgpack
+it is a stream of single entry maps, one per result, which can be read with
+msgpack.Unpacker(). msgpack is optional, check_format() reports when it
+isn't installed.
+"""
+
+
+import json
+import yaml
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Supported output file formats and their file extension
+OUTPUT_FORMATS = {
+    'json': '.json',
+    'msgpack': '.msgpack',
+    'yaml': '.yml',
+}
+
+
+def check_format(output_format):
+
+    if output_format not in OUTPUT_FORMATS:
+        print("Unsupported output format: {}".format(output_format))
+        return False
+
+    if (output_format == 'msgpack') and (not msgpack):
+        print("msgpack output requires the msgpack module: "
+              "pip3 install msgpack")
+        return False
+
+    return True
+
+
+def output_close(writer):
+
+    try:
+        if writer['format'] == 'json':
+            if writer['count']:
+                writer['file'].write('\n}\n')
+            else:
+                writer['file'].write('{}\n')
+    except Exception as e:
+        print("Couldn't finish output log file {}: {}".
+              format(writer['filename'], e))
+
+    writer['file'].close()
+
+
+def output_open(filename, output_format):
+
+    """
+    Open an output log file for writing results to one at a time with
+    output_write(). The file extension of the format is added to filename.
+    """
+
+    if not check_format(output_format):
+        return False
+
+    filename = filename+OUTPUT_FORMATS[output_format]
+
+    try:
+        if output_format == 'msgpack':
+            output_log = open(filename, 'wb')
+        else:
+            output_log = open(filename, 'w')
+    except Exception as e:
+        print("Couldn't open output log file {}: {}".format(filename, e))
+        return False
+
+    return {
+        'count': 0,
+        'file': output_log,
+        'filename': filename,
+        'format': output_format,
+    }
+
+
+def output_write(writer, key, value):
+
+    """
+    Serialise a single result and write it to the output log file straight
+    away, so results aren't held in memory until the end of the run.
+    """
+
+    # Serialise the result before writing anything, so that a result which
+    # can't be serialised doesn't leave a partial entry in the file
+    try:
+        if writer['format'] == 'json':
+            data = json.dumps(key)+': '+json.dumps(value, default=str)
+            if writer['count']:
+                data = ',\n'+data
+            else:
+                data = '{\n'+data
+
+        elif writer['format'] == 'msgpack':
+            data = msgpack.packb({key: value}, default=str)
+
+        else:
+            data = yaml.dump({key: value}, default_flow_style=False)
+
+    except Exception as e:
+        print("Couldn't serialise {} output to {}: {}".
+              format(key, writer['format'], e))
+        return False
+
+    try:
+        writer['file'].write(data)
+    except Exception as e:
+        print("Couldn't write {} output to {}: {}".
+              format(key, writer['filename'], e))
+        return False
+
+    writer['count'] += 1
+
+    return True
@@ -7,14 +7,32 @@ Optionally use a diff filter.
 
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import difflib
+import hashlib
+import json
 import os
+from os import listdir
+from os.path import getmtime
+from os.path import isfile
 import re
-import shlex
-import subprocess
 import sys
 import yaml
 
 
+IOS_TIMESTAMP = re.compile(
+    r"ime source.*([0-9][0-9]:){2}[0-9][0-9]\.[0-9][0-9][0-9] "
+    r"[A-Z][A-Z][A-Z] [A-Z][a-z][a-z] [A-Z][a-z][a-z] "
+    r"[0-9]{1,2} [0-9]{4}"
+)
+JUNOS_TIMESTAMP = re.compile(
+    r"^[A-Z][a-z][a-z] [0-9][0-9] ([0-9][0-9]:){2}[0-9][0-9]"
+)
+# Bumped whenever hash_output() changes, older manifests are then ignored
+MANIFEST_VERSION = 2
+
+
 def check_diff_path_exists(diff_dir):
 
     if not os.path.isdir(diff_dir):
@@ -40,10 +58,278 @@ def check_path_exists(directory):
         return True
 
 
-def compare_files(cmd_filter, diff_file, os, pre_filename, post_filename):
+def compare_files(cmd_filter, diff_file, os, pre_filename, post_filename,
+                  manifest=None):
+
+    diff = generate_diff(cmd_filter, os, pre_filename, post_filename,
+                         manifest)
+    if not diff:
+        return
+
+    write_diff(diff_file, diff)
+
+    return
+
+
+def count_changed_lines(opcodes):
+
+    """
+    Return the number of lines that `diff -y --suppress-common-lines` would
+    print for these opcodes. A block of changed lines is printed side by
+    side, so it counts as the longer of the two sides.
+    """
+
+    count = 0
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'replace':
+            count += max(i2 - i1, j2 - j1)
+        elif tag == 'delete':
+            count += i2 - i1
+        elif tag == 'insert':
+            count += j2 - j1
+
+    return count
+
+
+def diff_device(cmd_filter, diff_file, os, pre_dir, post_dir,
+                manifest_file=None):
+
+    '''
+    Compare every pre-change command output file in pre_dir with the
+    matching post-change file in post_dir, appending any diffs to diff_file.
+    The content hash of each output file is recorded in a manifest, by
+    default next to the diff file, so that a re-run can skip unchanged pairs
+    without reading them. Set manifest_file to '' to disable the manifest.
+    '''
+
+    print("Comparing {} to {}...".format(pre_dir, post_dir))
+
+    if manifest_file is None:
+        manifest_file = diff_file+".manifest.json"
+
+    if manifest_file:
+        manifest = load_manifest(manifest_file, cmd_filter, os)
+    else:
+        manifest = None
+
+    for pre_file, post_file in list_output_files(pre_dir, post_dir):
+        compare_files(cmd_filter, diff_file, os, pre_file, post_file,
+                      manifest)
+
+    if manifest_file:
+        save_manifest(manifest_file, manifest)
+
+
+def diff_devices(cmd_filter, devices, workers=1):
+
+    '''
+    Compare the command output files of several devices at once. devices is
+    a list of dicts with the keys diff_file, os, pre_dir and post_dir, and
+    optionally manifest_file (see diff_device()). Every pair of output files
+    from every device is compared in a pool of worker processes. The diffs
+    are then written to each device's diff file in the same order that
+    diff_device() writes them. Returns False if any pair couldn't be
+    compared, the manifest of that device is then left as it was.
+    '''
+
+    jobs = []
+    manifests = []
+    failed = set()
+
+    for device in devices:
+
+        print("Comparing {} to {}...".format(device['pre_dir'],
+                                             device['post_dir']))
+
+        manifest_file = device.get('manifest_file', None)
+        if manifest_file is None:
+            manifest_file = device['diff_file']+".manifest.json"
+
+        if manifest_file:
+            manifest = load_manifest(manifest_file, cmd_filter, device['os'])
+            manifests.append((device['diff_file'], manifest_file, manifest))
+        else:
+            manifest = None
+
+        for pre_file, post_file in list_output_files(device['pre_dir'],
+                                                     device['post_dir']):
+            jobs.append((device, manifest, pre_file, post_file))
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = None
+
+    # Only the manifest entries for the two files being compared are sent
+    # to the worker, the updated entries are sent back and merged below
+    results = []
+    for device, manifest, pre_file, post_file in jobs:
+        if manifest is not None:
+            files = get_manifest_entries(manifest, [pre_file, post_file])
+        else:
+            files = None
+        if executor:
+            results.append(executor.submit(diff_worker, cmd_filter,
+                                           device['os'], pre_file, post_file,
+                                           files))
+        else:
+            results.append(diff_worker(cmd_filter, device['os'], pre_file,
+                                       post_file, files))
+
+    for (device, manifest, pre_file, post_file), result in zip(jobs, results):
+
+        if executor:
+            try:
+                result = result.result()
+            except Exception as e:
+                print("Couldn't compare {} to {}: {}".
+                      format(pre_file, post_file, e))
+                failed.add(device['diff_file'])
+                continue
+
+        diff, files = result
+
+        if manifest is not None:
+            manifest['files'].update(files)
+
+        if diff:
+            write_diff(device['diff_file'], diff)
+
+    if executor:
+        executor.shutdown()
+
+    for diff_file, manifest_file, manifest in manifests:
+        if diff_file not in failed:
+            save_manifest(manifest_file, manifest)
+
+    if failed:
+        print("Couldn't compare every output file for: {}".
+              format(", ".join(sorted(failed))))
+        return False
+
+    return True
+
+
+def diff_worker(cmd_filter, os, pre_filename, post_filename, files=None):
+
+    """
+    Compare a single pair of output files, this is run in a worker process
+    by diff_devices(). Returns the diff and the manifest entries for the two
+    files.
+    """
+
+    if files is not None:
+        manifest = {'files': files}
+    else:
+        manifest = None
+
+    diff = generate_diff(cmd_filter, os, pre_filename, post_filename,
+                         manifest)
+
+    if manifest is not None:
+        return diff, manifest['files']
+    else:
+        return diff, None
+
+
+def filter_output(cmd_filter, cmd, pre_lines, post_lines):
+
+    # Only compare the first N lines of output for "head" commands
+    if cmd in list(cmd_filter['head_cmds'].keys()):
+
+        count = int(cmd_filter['head_cmds'][cmd])
+
+        return (pre_lines[:count], post_lines[:count])
+
+
+    elif cmd in cmd_filter['exclude_cmds']:
+
+        return False, False
+
+    else:
+
+        return (pre_lines, post_lines)
+
+
+def format_context_diff(pre_lines, post_lines, groups, pre_filename,
+                        post_filename, pre_date, post_date):
+
+    """
+    Format grouped opcodes from difflib.SequenceMatcher in `diff -c` format.
+    This is the output of difflib.context_diff(), which can't be given the
+    opcodes that generate_diff() has already computed.
+    """
+
+    prefix = {'insert': '+ ', 'delete': '- ', 'replace': '! ', 'equal': '  '}
+
+    # The date is left out, along with its tab, if it couldn't be read
+    diff = [
+        "*** {}\n".format("\t".join(filter(None, [pre_filename, pre_date]))),
+        "--- {}\n".format("\t".join(filter(None, [post_filename,
+                                                   post_date]))),
+    ]
+
+    for group in groups:
+
+        first, last = group[0], group[-1]
+        diff.append("***************\n")
+
+        diff.append("*** {} ****\n".format(format_range(first[1], last[2])))
+        if any(tag in ('replace', 'delete') for tag, _, _, _, _ in group):
+            for tag, i1, i2, _, _ in group:
+                if tag != 'insert':
+                    diff.extend(prefix[tag]+line for line in pre_lines[i1:i2])
+
+        diff.append("--- {} ----\n".format(format_range(first[3], last[4])))
+        if any(tag in ('replace', 'insert') for tag, _, _, _, _ in group):
+            for tag, _, _, j1, j2 in group:
+                if tag != 'delete':
+                    diff.extend(prefix[tag]+line for line in post_lines[j1:j2])
+
+    return "".join(diff)
+
+
+def format_range(start, stop):
+
+    # Line range of a hunk as `diff -c` prints it, e.g. "3,7", "3" or "2"
+    # when the hunk is empty (the line before the insert)
+    beginning = start + 1
+    length = stop - start
+
+    if not length:
+        beginning -= 1
+    if length <= 1:
+        return "{}".format(beginning)
+
+    return "{},{}".format(beginning, beginning + length - 1)
+
+
+def generate_diff(cmd_filter, os, pre_filename, post_filename, manifest=None):
+
+    """
+    Compare the output of a command from before and after the change, and
+    return the diff in `diff -c` format. Nothing is returned if there is no
+    difference, or the only difference is the CLI timestamp, or the command
+    is excluded by the filter.
+    """
+
+    # If both files are unchanged since they were hashed by a previous run,
+    # and their hashes match, there is nothing to compare
+    if manifest is not None:
+        pre_hash = get_manifest_hash(manifest, pre_filename)
+        post_hash = get_manifest_hash(manifest, post_filename)
+        if (pre_hash) and (pre_hash == post_hash):
+            return
+
+    pre_lines = read_output(pre_filename)
+    post_lines = read_output(post_filename)
+
+    if (pre_lines is False) or (post_lines is False):
+        return
 
     # Get the command that was executed from the output log
-    cmd = get_cmd(pre_filename)
+    cmd = get_cmd(pre_lines)
     if not cmd:
         return
 
@@ -53,38 +339,37 @@ def compare_files(cmd_filter, diff_file, os, pre_filename, post_filename):
     the diff is made:
     """
     if cmd_filter:
-        pre_filename, post_filename = filter_output(cmd_filter, cmd,
-                                                    pre_filename,
-                                                    post_filename)
+        pre_lines, post_lines = filter_output(cmd_filter, cmd, pre_lines,
+                                              post_lines)
 
-    else:
-        """
-        If there is no diff filter defined, escape the filename, this would be
-        done in the filter_output() function
-        """
-        pre_filename = shlex.quote(pre_filename)
-        post_filename = shlex.quote(post_filename)
-
-
-    if (not pre_filename) or (not post_filename):
+    if (pre_lines is False) or (post_lines is False):
         return
 
-    command = "diff -y --suppress-common-lines "+pre_filename+" "+post_filename
-    command += " | wc -l | tr -d '\\n'"
+    """
+    Most outputs are identical before and after a change. Compare a hash of
+    each output, ignoring the CLI timestamp line, before running the much
+    more expensive line by line diff.
+    """
+    timestamp = get_timestamp(os)
 
-    try:        
-        result = subprocess.getstatusoutput(command)
-        if result[0] != 0:
-            print("Couldn't check diff line count: {}\n{}".
-                  format(command, result[1]))
-            return
-        diff_count = int(result[1])
+    pre_hash = hash_output(pre_lines, timestamp)
+    post_hash = hash_output(post_lines, timestamp)
 
-    except Exception as e:
-        print("Unable to check number of diff lines for command {}: {}"
-              .format(cmd, e))
+    if manifest is not None:
+        set_manifest_hash(manifest, pre_filename, pre_hash)
+        set_manifest_hash(manifest, post_filename, post_hash)
+
+    if pre_hash == post_hash:
         return
 
+    # The changed line count and the diff hunks both come from this one
+    # matcher, so they always agree
+    matcher = difflib.SequenceMatcher(None, pre_lines, post_lines,
+                                      autojunk=False)
+    groups = list(matcher.get_grouped_opcodes())
+    opcodes = [opcode for group in groups for opcode in group]
+
+    diff_count = count_changed_lines(opcodes)
     if diff_count == 0:
         return
 
@@ -93,37 +378,14 @@ def compare_files(cmd_filter, diff_file, os, pre_filename, post_filename):
     the timestamp from the CLI. Try to match the IOS CLI timestamp and Junos
     timestamp patterns in the output.
     """
-    if os == 'ios':
-        """
-        IOS Examples:
-        No time source, *11:47:36.151 UTC Wed Nov 7 2018
-        Time source is NTP, 13:57:04.417 UTC Wed Nov 7 2018
-        Time source is hardware calendar, *16:40:11.691 UTC Fri Nov 23 2018
-        """
-        timestamp = "ime source.*([0-9][0-9]:){2}[0-9][0-9]\.[0-9][0-9][0-9] "
-        timestamp += "[A-Z][A-Z][A-Z] [A-Z][a-z][a-z] [A-Z][a-z][a-z] "
-        timestamp += "[0-9]{1,2} [0-9]{4}"
-    elif os == 'junos':
-        """
-        Junos Examples:
-        Oct 25 18:15:40
-        Nov 07 14:01:37
-        """
-        timestamp = "^[A-Z][a-z][a-z] [0-9][0-9] ([0-9][0-9]:){2}[0-9][0-9]"
-    else:
-        timestamp = False
-
-    if (diff_count == 1) and (timestamp): 
+    if (diff_count == 1) and (timestamp):
 
-        command = "diff -y --suppress-common-lines "+pre_filename+" "
-        command += post_filename+" | grep -E '"+timestamp+"' -c"
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag != 'equal':
+                changed = pre_lines[i1:i2] + post_lines[j1:j2]
 
-        result = subprocess.getstatusoutput(command)
-        # ^ grep will return the count of lines that match the timestamp regex
-
-        if (int(result[0]) == 0) and (int(result[1]) == 1):
+        if any(timestamp.search(line) for line in changed):
             """
-            grep matched exactly one occurance of the timestamp regex.
             If only one line changed and it matched the timestamp regex
             no command output has changed.
             """
@@ -133,86 +395,135 @@ def compare_files(cmd_filter, diff_file, os, pre_filename, post_filename):
     Otherwise, more than one line changed or the only line that changed
     wasn't a CLI timestamp, create a diff:
     """
-    command = "diff -c "+pre_filename+" "+post_filename+" >> "+diff_file
-    result = subprocess.getstatusoutput(command)
+    return format_context_diff(pre_lines, post_lines, groups, pre_filename,
+                               post_filename, get_mtime(pre_filename),
+                               get_mtime(post_filename))
+
+
+def get_cmd(pre_lines):
+
+    if not pre_lines:
+        return
+
     """
-    diff exit code is 1 when there is a difference between the two files,
-    it is 0 when there is no difference, 2 if there is a problem.
+    The first line in the text file is the original command that was run,
+    prefixed with a hash "#" character
     """
-    if result[0] != 1:
-        print("Couldn't create diff: {}\n{}".format(command, result[1]))
-        return
+    cmd = pre_lines[0].translate({ord("#"): None, ord("\n"): None})
 
-    return
+    return cmd
 
 
-def filter_output(cmd_filter, cmd, pre_filename, post_filename):
+def get_manifest_entries(manifest, filenames):
 
-    if cmd in list(cmd_filter['head_cmds'].keys()):
+    entries = {}
+    for filename in filenames:
+        if filename in manifest['files']:
+            entries[filename] = manifest['files'][filename]
 
-        count = str(cmd_filter['head_cmds'][cmd])
+    return entries
 
-        command = "head -n "+count+" "+shlex.quote(pre_filename)
-        command += " > "+shlex.quote(pre_filename+".tmp")
 
-        result = subprocess.getstatusoutput(command)
-        if result[0] != 0:
-            print("Couldn't `head` pre-change file: {}\n{}".
-                  format(command, result[1]))
-            return False, False
+def get_manifest_hash(manifest, filename):
 
+    """
+    Return the hash recorded for a file by a previous run, if the file
+    hasn't been modified since.
+    """
 
-        command = "head -n "+count+" "+shlex.quote(post_filename)
-        command += " > "+shlex.quote(post_filename+".tmp")
+    try:
+        stat = os.stat(filename)
+    except Exception:
+        return None
 
-        result = subprocess.getstatusoutput(command)
-        if result[0] != 0:
-            print("Couldn't `head` post-change file: {}\n{}".
-                  format(command, result[1]))
-            return False, False
+    entry = manifest['files'].get(filename)
+    if not entry:
+        return None
 
-        pre_filename = shlex.quote(pre_filename+".tmp")
-        post_filename = shlex.quote(post_filename+".tmp")
+    if (entry['size'] != stat.st_size) or (entry['mtime'] != stat.st_mtime):
+        return None
 
-        return (pre_filename, post_filename)
+    return entry['hash']
 
 
-    elif cmd in cmd_filter['exclude_cmds']:
+def get_mtime(filename):
+
+    # Format the file modification time the same way `diff -c` does
+    try:
+        mtime = datetime.fromtimestamp(getmtime(filename)).astimezone()
+    except Exception:
+        return ""
+
+    return mtime.strftime('%Y-%m-%d %H:%M:%S.%f %z')
 
-        return False, False
 
+def get_timestamp(os):
+
+    if os == 'ios':
+        """
+        IOS Examples:
+        No time source, *11:47:36.151 UTC Wed Nov 7 2018
+        Time source is NTP, 13:57:04.417 UTC Wed Nov 7 2018
+        Time source is hardware calendar, *16:40:11.691 UTC Fri Nov 23 2018
+        """
+        return IOS_TIMESTAMP
+    elif os == 'junos':
+        """
+        Junos Examples:
+        Oct 25 18:15:40
+        Nov 07 14:01:37
+        """
+        return JUNOS_TIMESTAMP
     else:
+        return False
 
-        pre_filename = shlex.quote(pre_filename)
-        post_filename = shlex.quote(post_filename)
 
-        return (pre_filename, post_filename)
+def hash_output(lines, timestamp):
 
+    """
+    Hash the filtered command output, ignoring the CLI timestamp. Only the
+    first line which matches the timestamp is skipped, and its position is
+    hashed in its place. Two outputs then only hash the same if they are
+    identical or the only changed line is the CLI timestamp, so timestamps
+    inside the output itself (e.g. syslog messages) are still compared.
+    """
+    output_hash = hashlib.sha256()
+    skipped = False
 
-def get_cmd(pre_filename):
+    for index, line in enumerate(lines):
+        if (timestamp) and (not skipped) and (timestamp.search(line)):
+            output_hash.update("{}\0".format(index).encode())
+            skipped = True
+            continue
+        output_hash.update(line.encode('utf-8', 'replace'))
 
-    try:
-        pre_file = open(pre_filename, 'r')
-    except Exception:
-        print("Couldn't open pre-change file {}".format(pre_filename))
-        return
+    return output_hash.hexdigest()
 
-    try:
-        first_line = pre_file.readline()
-    except Exception:
-        print("Couldn't read first line of pre-change file {}".
-              format(pre_filename))
-        return
 
-    pre_file.close()
+def list_output_files(pre_dir, post_dir):
 
     """
-    The first line in the text file is the original command that was run,
-    prefixed with a hash "#" character
+    Return a list of (pre_file, post_file) tuples for every pre-change
+    command output file in pre_dir which has a matching post-change file in
+    post_dir.
     """
-    cmd = first_line.translate({ord("#"): None, ord("\n"): None})
 
-    return cmd
+    output_files = []
+
+    for file in listdir(pre_dir):
+
+        pre_file = pre_dir+"/"+file
+        post_file = post_dir+"/"+file
+
+        # Don't try to compare any other files in the same directory
+        if file.lower().endswith(".txt"):
+            if isfile(post_file):
+                output_files.append((pre_file, post_file))
+            else:
+                print("Can't find matching post-change file for pre-change"
+                      " file: {}".format(post_file))
+
+    return output_files
 
 
 def load_filter(filename):
@@ -224,7 +535,7 @@ def load_filter(filename):
         sys.exit(1)
 
     try:
-        cmd_filter = yaml.load(filter_file)
+        cmd_filter = yaml.safe_load(filter_file)
     except Exception as e:
         print("Couldn't load YAML file {}: {}".format(filename, e))
         sys.exit(1)
@@ -234,6 +545,44 @@ def load_filter(filename):
     return cmd_filter
 
 
+def load_manifest(manifest_file, cmd_filter, os):
+
+    """
+    The manifest records the hash of each command output file. The hashes
+    depend on the filter and the device OS (which decides the timestamp
+    format), so a manifest from a run with a different filter or OS, or from
+    an older version of this script, is ignored.
+    """
+
+    filter_hash = hashlib.sha256(
+        json.dumps(cmd_filter, sort_keys=True).encode()
+    ).hexdigest()
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'filter': filter_hash,
+        'os': os,
+        'files': {},
+    }
+
+    if not isfile(manifest_file):
+        return manifest
+
+    try:
+        with open(manifest_file) as manifest_log:
+            old_manifest = json.load(manifest_log)
+    except Exception as e:
+        print("Couldn't load manifest {}: {}".format(manifest_file, e))
+        return manifest
+
+    if ( (old_manifest.get('version') == MANIFEST_VERSION) and
+         (old_manifest.get('filter') == filter_hash) and
+         (old_manifest.get('os') == os) ):
+        manifest['files'] = old_manifest.get('files', {})
+
+    return manifest
+
+
 def parse_cli_args():
 
     parser = argparse.ArgumentParser(
@@ -254,6 +603,15 @@ def parse_cli_args():
         type=str,
         default='./diff_filter.yml',
     )
+    parser.add_argument(
+        '-m', '--manifest',
+        help='Manifest file used to record the hash of each command output '
+             'file so that unchanged files can be skipped when re-run. '
+             'Defaults to the diff filename with ".manifest.json" appended. '
+             'To disable the manifest add the option -m \'\'.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-o', '--os',
         help='The device OS that produced the logs being compared. '
@@ -274,10 +632,65 @@ def parse_cli_args():
         type=str,
         default='./pre/',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of worker processes used to compare the output files. '
+             'The default of 1 compares them one by one in this process.',
+        type=int,
+        default=1,
+    )
 
     return vars(parser.parse_args())
 
 
+def read_output(filename):
+
+    try:
+        with open(filename, 'r', errors='replace') as output_file:
+            lines = output_file.readlines()
+    except Exception as e:
+        print("Couldn't read command output file {}: {}".format(filename, e))
+        return False
+
+    # Make sure a missing newline on the last line doesn't show as a change
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+
+    return lines
+
+
+def save_manifest(manifest_file, manifest):
+
+    try:
+        with open(manifest_file, 'w') as manifest_log:
+            json.dump(manifest, manifest_log, indent=1, sort_keys=True)
+    except Exception as e:
+        print("Couldn't save manifest {}: {}".format(manifest_file, e))
+
+
+def set_manifest_hash(manifest, filename, output_hash):
+
+    try:
+        stat = os.stat(filename)
+    except Exception:
+        return
+
+    manifest['files'][filename] = {
+        'hash': output_hash,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+    }
+
+
+def write_diff(diff_file, diff):
+
+    try:
+        with open(diff_file, 'a') as diff_log:
+            diff_log.write(diff)
+    except Exception as e:
+        print("Couldn't write diff to {}: {}".format(diff_file, e))
+
+
 def main():
 
     args = parse_cli_args()
@@ -305,23 +718,19 @@ def main():
         print("{} already exists, will be appended to!".
               format(diff_file))
     
-    print("Comparing {} to {}...".format(args['pre'], args['post']))
-
-    for file in os.listdir(args['pre']):
-
-        pre_file = args['pre']+"/"+file
-        post_file = args['post']+"/"+file
-
-        # Don't try to compare any other files in the same directory
-        if file.lower().endswith(".txt"):
-            if os.path.isfile(post_file):
-
-                compare_files(cmd_filter, diff_file, args['os'], pre_file,
-                              post_file)
-            else:
-                print("Can't find matching post-change file for pre-change"
-                      " file: {}".format(post_file))
-                continue
+    if args['workers'] > 1:
+        device = {
+            'diff_file': diff_file,
+            'manifest_file': args['manifest'],
+            'os': args['os'],
+            'post_dir': args['post'],
+            'pre_dir': args['pre'],
+        }
+        if not diff_devices(cmd_filter, [device], args['workers']):
+            sys.exit(1)
+    else:
+        diff_device(cmd_filter, diff_file, args['os'], args['pre'],
+                    args['post'], args['manifest'])
 
     print("done")
 
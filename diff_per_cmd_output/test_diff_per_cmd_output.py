@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+'''
+Regression tests for diff_per_cmd_output.py, run with `python -m pytest`.
+'''
+
+
+import diff_per_cmd_output
+
+
+CMD = "#show log messages | last 200 | no-more\n"
+
+PRE_SYSLOG = [
+    CMD,
+    "\n",
+    "Nov 12 14:30:00 r1 newsyslog[12191]: logfile turned over\n",
+    "Nov 12 14:30:32 r1 sshd[12198]: Accepted password for napalm\n",
+]
+
+POST_SYSLOG = PRE_SYSLOG + [
+    "Nov 12 14:31:07 r1 rpd[1510]: BGP_PEER_DOWN: peer 10.0.0.2\n",
+    "Nov 12 14:31:07 r1 rpd[1510]: BGP_PEER_STATE_CHANGED: Idle\n",
+]
+
+
+def write_output(path, lines):
+
+    with open(path, 'w') as output_file:
+        output_file.writelines(lines)
+
+    return str(path)
+
+
+def test_junos_syslog_output_is_diffed(tmp_path):
+
+    pre_file = write_output(tmp_path / "pre.txt", PRE_SYSLOG)
+    post_file = write_output(tmp_path / "post.txt", POST_SYSLOG)
+    manifest = {'files': {}}
+
+    diff = diff_per_cmd_output.generate_diff(None, 'junos', pre_file,
+                                             post_file, manifest)
+
+    assert diff
+    assert "+ Nov 12 14:31:07 r1 rpd[1510]: BGP_PEER_DOWN" in diff
+
+    # A re-run using the manifest must not skip the pair either
+    diff = diff_per_cmd_output.generate_diff(None, 'junos', pre_file,
+                                             post_file, manifest)
+
+    assert diff
+
+
+def test_junos_cli_timestamp_only_is_not_diffed(tmp_path):
+
+    pre_lines = [CMD, "\n", "Nov 07 11:47:47\n", "Groups: 1 Peers: 2\n"]
+    post_lines = [CMD, "\n", "Nov 07 11:55:38\n", "Groups: 1 Peers: 2\n"]
+
+    pre_file = write_output(tmp_path / "pre.txt", pre_lines)
+    post_file = write_output(tmp_path / "post.txt", post_lines)
+
+    assert diff_per_cmd_output.generate_diff(None, 'junos', pre_file,
+                                             post_file) is None
+
+
+def test_long_output_diff_matches_changed_lines(tmp_path):
+
+    # Over 200 lines difflib's autojunk heuristic treats the repeated blank
+    # lines as junk, the diff must still only show the one changed line
+    pre_lines = ["#show interfaces terse\n"]
+    for port in range(150):
+        pre_lines += ["ge-0/0/{} up up\n".format(port), "\n"]
+    post_lines = list(pre_lines)
+    post_lines[151] = "ge-0/0/75 up down\n"
+
+    pre_file = write_output(tmp_path / "pre.txt", pre_lines)
+    post_file = write_output(tmp_path / "post.txt", post_lines)
+
+    diff = diff_per_cmd_output.generate_diff(None, 'ios', pre_file,
+                                             post_file)
+
+    assert diff.count("***************") == 1
+    assert "! ge-0/0/75 up up" in diff
+    assert "! ge-0/0/75 up down" in diff
+    assert "*** 149,155 ****" in diff
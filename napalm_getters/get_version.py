@@ -28,16 +28,15 @@ R2:
 
 import argparse
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-import napalm
-from napalm.base.exceptions import ConnectionException
-from netmiko.ssh_exception import NetMikoAuthenticationException
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
+import os
 import sys
-import yaml
+
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
 
 
 def parse_cli_args():
@@ -68,19 +67,10 @@ def main():
     args['password'] = getpass("Default password:")
     
 
-    try:
-        inventory_file = open(args['inventory_file'])
-    except Exception:
-        print('Couldn\'t open inventory file {}'.format(args['inventory_file']))
-
-    try:
-        inventory = yaml.load(inventory_file)
-    except Exception as e:
-        print("Failed to load YAML: {}".format(e))
+    inventory = inventory_cache.load_inv(args['inventory_file'])
+    if inventory is False:
         return 1
 
-    inventory_file.close()
-
 
     for dev, opt in inventory.items():
 
@@ -97,13 +87,13 @@ def main():
         if 'optional_args' not in opt:
             opt['optional_args'] = None
 
-        driver = napalm.get_network_driver(opt['os'])
+        driver = drivers.get_network_driver(opt['os'])
         
         # If Kwargs doesn't have exactly the keys required (no extras)
         # driver() will throw an exception
         opt.pop('os')
 
-        device = driver(**opt)
+        device = driver(**drivers.get_driver_args(opt))
 
 
         # Try to get the transport port number and type
@@ -130,10 +120,10 @@ def main():
         # Connect to the device
         try:
            device.open()
-        except (JuniperConnectAuthError, NetMikoAuthenticationException):
+        except drivers.get_auth_errors():
             print("Unable to authenticate to {} as {}".format(opt['hostname'], opt['username']))
             continue
-        except (ConnectionException, JuniperConnectRefusedError, SocketError, SocketTimeout, SSHException):
+        except drivers.get_connect_errors():
             print("Unable to connect to: {} using {} on port {}".
                   format(opt['hostname'], transport, port))
             continue
@@ -31,27 +31,44 @@ R2:
 
 
 import argparse
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.utilities import get_structured_data
-from netmiko.ssh_exception import NetMikoAuthenticationException
 import os
-from paramiko.ssh_exception import SSHException
+import pickle
 import pprint
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
 import sys
+import tempfile
+import time
 import yaml
 
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
+import output_writer
+
+
+# The NAPALM getters to run against each device, and a description of each
+# for error messages
+GETTERS = [
+    ('get_bgp_neighbors', 'BGP neighbours'),
+    ('get_bgp_neighbors_detail', 'detailed BGP neighbour information'),
+    ('get_environment', 'environment details'),
+    ('get_facts', 'facts'),
+    ('get_interfaces', 'interfaces'),
+    ('get_interfaces_counters', 'interface counters'),
+    ('get_interfaces_ip', 'interface IPs'),
+    ('get_network_instances', 'VRFs'),
+    ('get_optics', 'optics'),
+    ('get_snmp_information', 'SNMP information'),
+    ('get_ntp_servers', 'NTP servers'),
+    ('get_ntp_stats', 'NTP stats'),
+]
+
 
 def check_log_path_exists(log_dir):
 
@@ -69,6 +86,220 @@ def check_log_path_exists(log_dir):
         return True
 
 
+def collect_device(args, dev, opt):
+
+    """
+    Connect to a single device, run every getter which is due and save the
+    structured output. Getters whose cached result is still within its TTL
+    aren't run again, if every getter is cached the device isn't connected
+    to at all. Returns False if the device couldn't be collected.
+    """
+
+    print("Trying {}...".format(dev))
+
+    if opt['os'] not in drivers.SUPPORTED_DRIVERS:
+        print("{} has an unsupported device OS type: {}".format(dev, opt['os']))
+        return False
+
+    timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
+    output_file = args['log_dir']+'/'+dev+'_'+timestamp
+    output_log = output_writer.output_open(output_file, args['format'])
+    if not output_log:
+        return False
+
+    if args['cache_dir']:
+        cache_file = args['cache_dir']+'/'+dev+'.cache'
+        cache = load_cache(cache_file)
+    else:
+        cache_file = None
+        cache = {}
+
+    getters, cached_output = get_due_getters(args, cache)
+
+    if getters:
+
+        if not set_dev_opts(args, opt):
+            write_cached(output_log, cached_output)
+            output_writer.output_close(output_log)
+            return False
+
+        driver = drivers.get_network_driver(opt['os'])
+        
+        # If Kwargs doesn't have exactly the keys required (no extras)
+        # driver() will throw an exception
+        opt.pop('os')
+        device = driver(**drivers.get_driver_args(opt))
+
+        # Try to get the transport port number and type for debug messages
+        port = get_port(device)
+        transport = get_transport(device)
+
+        # Connect to the device
+        if not dev_connect(device, opt, port, transport):
+            write_cached(output_log, cached_output)
+            output_writer.output_close(output_log)
+            return False
+
+        # Write each getter's output as soon as it is available, cached and
+        # fresh output are written in the same order so that the output
+        # file doesn't depend on which getters were cached
+        for getter, output in run_getters(device, opt, getters,
+                                          cached_output):
+            output_writer.output_write(output_log, getter, output)
+            if cache_file and getter not in cached_output:
+                cache[getter] = {'timestamp': time.time(), 'data': output}
+
+        device.close()
+
+        if cache_file:
+            save_cache(cache_file, cache)
+
+    else:
+        print("All getters for {} are cached".format(dev))
+        write_cached(output_log, cached_output)
+
+    output_writer.output_close(output_log)
+
+    print("{} done".format(dev))
+
+    return True
+
+
+def collect_inventory_pool(args, inventory):
+
+    """
+    Run collect_device() for many devices at once using a bounded pool of
+    worker threads. At most --workers devices are connected to at any time,
+    the getters for a single device are run one after another on its
+    session.
+    """
+
+    failed = []
+
+    print("Collecting from {} device(s) using {} workers".
+          format(len(inventory.keys()), args['workers']))
+
+    with ThreadPoolExecutor(max_workers=args['workers']) as pool:
+
+        futures = {}
+        for dev, opt in inventory.items():
+            futures[pool.submit(collect_device, args, dev, opt)] = dev
+
+        for future in as_completed(futures):
+            # Isolate each device, an unexpected error on one device must
+            # not stop the remaining devices from being collected
+            try:
+                if not future.result():
+                    failed.append(futures[future])
+            except Exception as e:
+                print("Error collecting from {}: {}".format(futures[future], e))
+                failed.append(futures[future])
+
+    if failed:
+        print("Failed device(s): {}".format(", ".join(sorted(failed))))
+        return False
+
+    return True
+
+
+def dev_connect(device, opt, port, transport):
+
+    try:
+       device.open()
+    except drivers.get_auth_errors():
+        print("Unable to authenticate to {} as {}".
+              format(opt['hostname'], opt['username']))
+        return False
+    except drivers.get_connect_errors():
+        print("Unable to connect to: {} using {} on port {}".
+              format(opt['hostname'], transport, port))
+        return False
+    except ValueError as e:
+        print("Unable to connect to {}: {}".format(opt['hostname'], e))
+        return False
+
+    return True
+
+
+def get_bgp_neighbors_detail(device, opt):
+
+    """
+    Get the detailed information for every BGP neighbour in one call, for
+    all VRFs and address families the driver supports. If the driver can't
+    do that (the IOS driver fails when a neighbour is up), fall back to one
+    call per neighbour. A neighbour which fails is skipped and its error is
+    recorded. Returns the neighbour details in the same format as the NAPALM
+    getter, and a dict of the neighbours which failed.
+    """
+
+    errors = {}
+
+    try:
+        return device.get_bgp_neighbors_detail(), errors
+    except Exception as e:
+        print("Couldn't get detailed BGP neighbour information from {} in "
+              "one call, trying each neighbour: {}".format(opt['hostname'], e))
+
+    try:
+        bgp_neighbours = device.get_bgp_neighbors()
+    except Exception:
+        print("Couldn't get BGP neighbours from {}".format(opt['hostname']))
+        return None, errors
+
+    detail = {}
+
+    # Each table is keyed by VRF and has a dict of peers keyed by the peer IP
+    for vrf, table in bgp_neighbours.items():
+
+        for neighbour in table['peers'].keys():
+
+            try:
+                neighbour_detail = device.get_bgp_neighbors_detail(neighbour)
+            except Exception as e:
+                print("Couldn't get detailed BGP neighbour information from "
+                      "{} for {}: {}".format(opt['hostname'], neighbour, e))
+                errors[neighbour] = str(e)
+                continue
+
+            # The output is keyed by VRF then remote AS, each is a list of
+            # neighbour details
+            for detail_vrf, remote_ases in neighbour_detail.items():
+                for remote_as, neighbours in remote_ases.items():
+                    detail.setdefault(detail_vrf, {}).setdefault(
+                        remote_as, []
+                    ).extend(neighbours)
+
+    return detail, errors
+
+
+def get_due_getters(args, cache):
+
+    """
+    Return the list of getters which need to be run against a device, and
+    the cached output of those which don't. A getter is due when it has no
+    cached output or the cached output is older than the getter's TTL.
+    """
+
+    due = []
+    cached_output = {}
+    now = time.time()
+
+    for getter, description in GETTERS:
+
+        if args['getters'] and getter not in args['getters']:
+            continue
+
+        ttl = args['ttls'].get(getter, args['ttls'].get('default', 0))
+
+        if ( (getter in cache) and
+             (now - cache[getter]['timestamp'] < ttl) ):
+            cached_output[getter] = cache[getter]['data']
+        else:
+            due.append((getter, description))
+
+    return due, cached_output
+
+
 def get_port(device):
 
     port = "unknown"
@@ -98,32 +329,66 @@ def get_transport(device):
     return transport
 
 
-def load_inv(filename, type=None):
+def load_cache(cache_file):
+
+    """
+    The cache is pickled so that cached getter output has the same types as
+    fresh output (e.g. int keys and datetimes), otherwise the output file
+    would change depending on which getters were cached.
+    """
 
     try:
-        inventory_file = open(filename)
-    except Exception:
-        print("Couldnt open inventory file {}".format(filename))
+        with open(cache_file, 'rb') as cache_log:
+            cache = pickle.load(cache_log)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print("Couldn't load getter cache {}: {}".format(cache_file, e))
+        return {}
+
+    if not isinstance(cache, dict):
+        return {}
+
+    return cache
+
+
+def load_inv(filename, selector=None, type=None):
+
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # down to the selected devices and type if they are supplied
+    inventory = inventory_cache.load_inv(filename, selector, type)
+    if inventory is False:
         sys.exit(1)
 
+    return inventory
+
+
+def load_ttls(filename):
+
+    """
+    Load the per-getter TTLs in seconds, from a YAML file. The "default" key
+    is used for any getter not listed, without it they are always run.
+    """
+
+    if not filename:
+        return {}
+
+    if not os.path.isfile(filename):
+        print("Getter TTL file {} doesn't exist, every getter will be run".
+              format(filename))
+        return {}
+
     try:
-        inventory = yaml.load(inventory_file)
+        with open(filename) as ttl_file:
+            ttls = yaml.safe_load(ttl_file)
     except Exception as e:
-        print("Couldn't load YAML file {}: {}".format(filename, e))
+        print("Couldn't load getter TTL file {}: {}".format(filename, e))
         sys.exit(1)
 
-    inventory_file.close()
-
-    # Filter the inventory down to the specified type if one is supplied
-    if type:
-        filtered_inventory = {}
-        for dev, opt in inventory.items():
-            if opt['os'] == type:
-                filtered_inventory[dev] = opt
-    else:
-        filtered_inventory = inventory
+    if not ttls:
+        return {}
 
-    return filtered_inventory
+    return ttls
 
 
 def parse_cli_args():
@@ -133,6 +398,29 @@ def parse_cli_args():
                     'the structured output of every NAPALM getter to a file.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
+    parser.add_argument(
+        '-c', '--cache-dir',
+        help='Path to the getter cache directory. The output of each getter '
+             'is cached per device and re-used until its TTL expires. To '
+             'disable the cache add the option -c \'\'.',
+        type=str,
+        default='./cache',
+    )
+    parser.add_argument(
+        '-f', '--format',
+        help='Output file format, one of: {}'.format(
+            ", ".join(sorted(output_writer.OUTPUT_FORMATS.keys()))),
+        type=str,
+        choices=sorted(output_writer.OUTPUT_FORMATS.keys()),
+        default='yaml',
+    )
+    parser.add_argument(
+        '-g', '--getters',
+        help='Only run the listed getters e.g. -g get_facts get_interfaces',
+        type=str,
+        nargs='+',
+        default=None,
+    )
     parser.add_argument(
         '-i', '--inventory-file',
         help='Input YAML inventory file',
@@ -145,219 +433,158 @@ def parse_cli_args():
         type=str,
         default='./logs',
     )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--type',
-        help='Only process devices with the specific OS type e.g. ios or junos',
+        help='Only process devices with the specific OS type e.g. ios or '
+             'junos, the same as -s os=<type>.',
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '--ttl-file',
+        help='YAML file of the TTL in seconds of each getter\'s cached '
+             'output. Set to blank to always run every getter, e.g. '
+             '--ttl-file \'\'',
+        type=str,
+        default='./getter_ttl.yml',
+    )
     parser.add_argument(
         '-u', '--username',
         help='Default username for device access',
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of devices to collect from concurrently. The default '
+             'of 1 processes the inventory one device at a time.',
+        type=int,
+        default=1,
+    )
 
     return vars(parser.parse_args())
 
 
-def set_dev_opts(args, opt):
-
-    if 'username' not in opt:
-        if not args['username']:
-            print ("No username specified")
-            return False
-        else:   
-            opt['username'] = args['username']
-
-    if 'password' not in opt:
-        opt['password'] = args['password']
-        if opt['password'] == "":
-            print("No password specified")
-            return False
-
-    if 'optional_args' not in opt:
-        opt['optional_args'] = None
-
-    return True
-
-
-def main():
-    
-    args = parse_cli_args()
-    args['password'] = getpass("Default password:")
-    
-    inventory = load_inv(args['inventory_file'], args['type'])
-
-    if not check_log_path_exists(args['log_dir']):
-        sys.exit(1)
+def run_getters(device, opt, getters, cached_output=None):
 
+    """
+    Run a list of getters against an open device, yielding the name and
+    output of each getter as it completes. A getter which fails is left out
+    of the output. The output of the getters in cached_output is yielded
+    from the cache instead, in the same order as GETTERS.
+    """
 
-    for dev, opt in inventory.items():
+    if cached_output is None:
+        cached_output = {}
 
-        print("Trying {}...".format(dev))
+    for getter, description in GETTERS:
 
-        if opt['os'] not in SUPPORTED_DRIVERS:
-            print("{} has an unsupported device OS type: {}".format(dev, opt['os']))
+        if getter in cached_output:
+            yield getter, cached_output[getter]
             continue
 
-        timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
-        output_file = args['log_dir']+'/'+dev+'_'+timestamp+'.yml'
-        try:
-            output_log = open(output_file, 'w')
-        except Exception:
-            print("Couldn't open output log file {}".format(output_log))
+        if (getter, description) not in getters:
             continue
 
-        if not set_dev_opts(args, opt):
+        if getter == 'get_bgp_neighbors_detail':
+            detail, errors = get_bgp_neighbors_detail(device, opt)
+            if detail is not None:
+                yield getter, detail
+            if errors:
+                yield 'get_bgp_neighbors_detail_errors', errors
             continue
 
-        driver = napalm.get_network_driver(opt['os'])
-        
-        # If Kwargs doesn't have exactly the keys required (no extras)
-        # driver() will throw an exception
-        opt.pop('os')
-        device = driver(**opt)
-
-        # Try to get the transport port number and type for debug messages
-        port = get_port(device)
-        transport = get_transport(device)
-
-        # Connect to the device
         try:
-           device.open()
-        except (JuniperConnectAuthError, NetMikoAuthenticationException):
-            print("Unable to authenticate to {} as {}".
-                  format(opt['hostname'], opt['username']))
-            continue
-        except (ConnectionException, JuniperConnectRefusedError, SocketError,
-                SocketTimeout, SSHException):
-            print("Unable to connect to: {} using {} on port {}".
-                  format(opt['hostname'], transport, port))
+            output = getattr(device, getter)()
+        except Exception:
+            print("Couldn't get {} from {}".
+                  format(description, opt['hostname']))
             continue
 
+        yield getter, output
 
-        structured_output = {}
 
+def save_cache(cache_file, cache):
 
+    # Write the cache to a temporary file and rename it into place so that
+    # a run which is interrupted never leaves a partial cache
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache_log:
+            pickle.dump(cache, cache_log, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        print("Couldn't save getter cache {}: {}".format(cache_file, e))
         try:
-            bgp_neighbours = device.get_bgp_neighbors()
-            structured_output['get_bgp_neighbors'] = bgp_neighbours
+            os.unlink(tmp_file)
         except Exception:
-            print("Couldn't get BGP neighbours from {}".
-                  format(opt['hostname']))
-        
+            pass
 
-        '''
-        # IOS bugs when the neighour is UP?!
-        # Also only supports IPv4/IPv6 unicast AFI/SAFI
-        
-        structured_output['get_bgp_neighbors_detail'] = {}
-
-        # table will be a tuple,
-        # entry 0 is the routerID
-        # entry 1 is the dict of peers
-        for table in bgp_neighbours.items():
-            
-            # Each 'peer' will be a dict,
-            # key is the BGP peer IP and val is a defaultdict,
-            # with a single entry which is also default dict,
-            # which contains all the BGP peer details
-            if table[1]['peers']:
-                for neighbour in table[1]['peers'].keys():
-                    try:
-                        bgp_neighbours_detailed = device.get_bgp_neighbors_detail(neighbour)
-                        for k1, v1 in bgp_neighbours_detailed.items():
-                            for k2, v2 in v1.items():
-                                structured_output['get_bgp_neighbors_detail'][neighbour] = v2[0]
-                    except Exception as e:
-                        print("Couldn't get detailed BGP neighbour information"
-                              " from {} for {}".format(opt['hostname'], neighbour))
-                        print(e)
-                        sys.exit(1)
-                        #continue
-        '''
 
-        try:
-            environment = device.get_environment()
-            structured_output['get_environment'] = environment
-        except Exception:
-            print("Couldn't get environment details from {}".
-                  format(opt['hostname']))
+def set_dev_opts(args, opt):
 
-        try:
-            facts = device.get_facts()
-            structured_output['get_facts'] = facts
-        except Exception:
-            print("Couldn't get facts from {}".
-                  format(opt['hostname']))
+    if 'username' not in opt:
+        if not args['username']:
+            print ("No username specified")
+            return False
+        else:   
+            opt['username'] = args['username']
 
-        try:
-            interfaces = device.get_interfaces()
-            structured_output['get_interfaces'] = interfaces
-        except Exception:
-            print("Couldn't get interfaces from {}".
-                  format(opt['hostname']))
+    if 'password' not in opt:
+        opt['password'] = args['password']
+        if opt['password'] == "":
+            print("No password specified")
+            return False
 
-        try:
-            interface_counters = device.get_interfaces_counters()
-            structured_output['get_interfaces_counters'] = interface_counters
-        except Exception:
-            print("Couldn't get interface counters from {}".
-                  format(opt['hostname']))
+    if 'optional_args' not in opt:
+        opt['optional_args'] = None
 
-        try:
-            interface_ips = device.get_interfaces_ip()
-            structured_output['get_interfaces_ip'] = interface_ips
-        except Exception:
-            print("Couldn't get interface IPs from {}".
-                  format(opt['hostname']))
+    return True
 
-        try:
-            vrfs = device.get_network_instances()
-            structured_output['get_network_instances'] = vrfs
-        except Exception:
-            print("Couldn't get VRFs from {}".
-                  format(opt['hostname']))
 
-        try:
-            optics = device.get_optics()
-            structured_output['get_optics'] = optics
-        except Exception:
-            print("Couldn't get optics from {}".
-                  format(opt['hostname']))
-        try:
-            snmp = device.get_snmp_information()
-            structured_output['get_snmp_information'] = snmp
-        except Exception:
-            print("Couldn't get optics from {}".
-                  format(opt['hostname']))
+def write_cached(output_log, cached_output):
 
-        try:
-            ntp_servers = device.get_ntp_servers()
-            structured_output['get_ntp_servers'] = ntp_servers
-        except Exception:
-            print("Couldn't get optics from {}".
-                  format(opt['hostname']))
+    for getter, output in cached_output.items():
+        output_writer.output_write(output_log, getter, output)
 
-        try:
-            ntp_stats = device.get_ntp_stats()
-            structured_output['get_ntp_stats'] = ntp_stats
-        except Exception:
-            print("Couldn't get optics from {}".
-                  format(opt['hostname']))
 
+def main():
+    
+    args = parse_cli_args()
+    args['password'] = getpass("Default password:")
+    
+    inventory = load_inv(args['inventory_file'], args['select'], args['type'])
+
+    if not output_writer.check_format(args['format']):
+        sys.exit(1)
 
-        try:
-            yaml.dump(structured_output, output_log, default_flow_style=False)
-        except Exception:
-            print("Couldn't serialise CLI output to YAML")
+    if not check_log_path_exists(args['log_dir']):
+        sys.exit(1)
 
+    if args['cache_dir'] and not check_log_path_exists(args['cache_dir']):
+        sys.exit(1)
 
-        output_log.close()
-        device.close()
+    if args['cache_dir']:
+        args['ttls'] = load_ttls(args['ttl_file'])
+    else:
+        args['ttls'] = {}
 
-        print("{} done".format(dev))
+
+    if args['workers'] > 1:
+        collect_inventory_pool(args, inventory)
+    else:
+        for dev, opt in inventory.items():
+            collect_device(args, dev, opt)
 
     return
 
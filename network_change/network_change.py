@@ -13,84 +13,213 @@
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 from getpass import getpass
+import importlib.util
 import os
-import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import shlex
+import shutil
 import subprocess
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
 import sys
-import yaml
+import threading
 
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
 
-def apply_config(args, log_dir, inventory, scripts):
 
-    passed = True
-
-    for dev, opt in inventory.items():
+def apply_config(args, log_dir, inventory, modules, broker):
 
-        if args['target']:
-            config_file = args['configs']
-        elif args['host']:
-            config_file = args['configs']+'/'+dev+'.txt'
-        elif args['replace']:
-            config_file = args['configs']+'replace_config_'+opt['os']+'.txt'
-        else:
-            config_file = args['configs']+'merge_config_'+opt['os']+'.txt'
+    """
+    Apply the config in waves. The first wave is the -canary device(s), each
+    wave after that is twice the size of the last one, up to -max-wave
+    devices. The devices in a wave are configured concurrently and then the
+    first -wave-checks check commands of each device are run and diffed
+    against its pre-change state. If any device in a wave fails or its check
+    outputs have changed the user is asked before the next wave starts.
+    """
 
-        command = shlex.quote(scripts['apply'])
-        command += " -c "+shlex.quote(config_file)
-        
-        if args['dry_run']:    
-            command += " -d"
+    cmd_filter = None
+    if args['wave_checks']:
+        cmd_filter = modules['diff'].load_filter(args['filter'])
 
-        command += " -t "+opt['hostname']
+    waves = get_waves(list(inventory.keys()), args['canary'], args['max_wave'])
+    applied = 0
+    passed = True
 
-        command += " -l "+log_dir
+    for index, wave in enumerate(waves):
 
-        # Commit message is only supported on Junos
-        if (args['note']) and (opt['os'] == 'junos'):
-            command += " -n \""+args['note']+"\""
+        print("\nApplying wave {} of {} to {} device(s): {}".
+              format(index + 1, len(waves), len(wave), ", ".join(wave)))
 
-        elif opt['os'] == 'junos':
-            command += " -n \""+args['ref']+"\""
-        
-        command += " -p "+opt['password']
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(wave)) as pool:
 
-        if args['replace']:
-            command += " -r"
+            futures = {}
+            for dev in wave:
+                future = pool.submit(apply_wave_device, args, log_dir, dev,
+                                     inventory[dev], modules, broker,
+                                     cmd_filter)
+                futures[future] = dev
 
-        command += " -o "+opt['os']
+            for future in as_completed(futures):
+                # Isolate each device, an unexpected error on one device
+                # must not stop the rest of the wave
+                try:
+                    if not future.result():
+                        failed.append(futures[future])
+                except Exception as e:
+                    print("Error applying config to {}: {}".
+                          format(futures[future], e))
+                    failed.append(futures[future])
 
-        command += " -u "+opt['username']
+        applied += len(wave)
 
-        # "commit check" only supported on Junos
-        if opt['os'] == 'junos' and args['verify']:
-            command += " -v"
+        if not failed:
+            print("Wave {} passed".format(index + 1))
+            continue
 
-        cmd = shlex.split(command)
-
-        try:
-            subprocess.run(cmd, check=True, timeout=300)
-        except Exception as e:
-            print("Error applying device config: {}".format(e))
-            passed = False
+        print("Wave {} failed on: {}".format(index + 1,
+                                             ", ".join(sorted(failed))))
+        passed = False
 
+        if applied < len(inventory):
+            question = ("Continue with the remaining {} device(s)? [yes/no]: ".
+                        format(len(inventory) - applied))
+        else:
+            question = ("Config changes have encountered errors, "
+                        "do you want to continue? [yes/no]: ")
 
-    if not passed:
         asking = True
         while(asking):
-            answer = input("Config changes have encountered errors, "
-                           "do you want to continue? [yes/no]: ")
+            answer = input(question)
             if answer == "yes":
-                return True
+                break
             elif answer == "no":
                 return False
-    else:
+
+    if passed:
         print("Config applied to all devices without issue.")
+
+    return True
+
+
+def apply_device(args, log_dir, dev, opt, modules, broker):
+
+    """
+    Apply the config to a single device using a session from the broker.
+    Returns False if the config couldn't be applied.
+    """
+
+    if args['target']:
+        config_file = args['configs']
+    elif args['host']:
+        config_file = args['configs']+'/'+dev+'.txt'
+    elif args['replace']:
+        config_file = args['configs']+'replace_config_'+opt['os']+'.txt'
+    else:
+        config_file = args['configs']+'merge_config_'+opt['os']+'.txt'
+
+    # Commit message is only supported on Junos
+    if (args['note']) and (opt['os'] == 'junos'):
+        note = args['note']
+    elif opt['os'] == 'junos':
+        note = args['ref']
+    else:
+        note = None
+
+    # Arguments as apply_config.py would have parsed them in target mode
+    apply_args = {
+        'configs': config_file,
+        'dry_run': args['dry_run'],
+        'host': False,
+        'log_dir': log_dir+"/config/",
+        'note': note,
+        'replace': args['replace'],
+        'target': opt['hostname'],
+        # "commit check" only supported on Junos
+        'verify': (opt['os'] == 'junos' and args['verify']),
+    }
+
+    print("Trying {}...".format(dev))
+
+    device = session_borrow(broker, dev, opt, modules)
+    if not device:
+        return False
+
+    passed = True
+    try:
+        if not modules['apply'].configure_device(apply_args,
+                                                 opt['hostname'], device,
+                                                 opt['os']):
+            passed = False
+    except Exception as e:
+        print("Error applying device config: {}".format(e))
+        passed = False
+
+    # Refresh the rollback fingerprint now the change has been committed
+    if not args['dry_run']:
+        record_fingerprint(log_dir+"/rollback/", dev, opt, device, modules,
+                           'applied')
+
+    session_return(broker, dev, device)
+    print("{} done".format(dev))
+
+    return passed
+
+
+def apply_wave_device(args, log_dir, dev, opt, modules, broker, cmd_filter):
+
+    if not apply_device(args, log_dir, dev, opt, modules, broker):
+        return False
+
+    # Nothing has changed on the device during a dry run
+    if not args['wave_checks'] or args['dry_run']:
         return True
 
+    return wave_check(args, log_dir, dev, opt, modules, broker, cmd_filter)
+
+
+def broker_start(args, modules):
+
+    """
+    The session broker holds open NAPALM sessions to the devices being
+    changed so that each stage of the change (pre-checks, applying config and
+    post-checks) borrows an existing session instead of connecting again.
+    Idle sessions are checked every -keepalive seconds, which keeps them
+    alive while waiting at a prompt() and removes any which have dropped.
+    """
+
+    broker = {
+        'devices': {},
+        'keepalive': args['keepalive'],
+        'lock': threading.Lock(),
+        'max_sessions': args['max_sessions'],
+        'stop': threading.Event(),
+    }
+
+    if broker['keepalive']:
+        thread = threading.Thread(target=session_keepalive, args=(broker,))
+        thread.daemon = True
+        thread.start()
+
+    return broker
+
+
+def broker_stop(broker):
+
+    broker['stop'].set()
+
+    for dev, entry in broker['devices'].items():
+        with entry['lock']:
+            for device in entry['idle']:
+                session_close(dev, device)
+            entry['idle'] = []
+
 
 def build_inventory(args):
 
@@ -216,16 +345,15 @@ def check_config_files_exist(args, inventory):
     return True
 
 
-def check_config_syntax(args, inventory, scripts):
+def check_config_syntax(args, inventory, modules):
 
     # Check the syntax of the config that will be applied to each device.
     passed = True
 
-    # List of unique OS types in the inventory file
-    os_types = []
-    for dev, opt in inventory.items():
-      if opt['os'] not in os_types:
-        os_types.append(opt['os'])
+    # List of unique config files and their OS type. All of the files are
+    # checked in one call, the per-OS/type config files are only checked once
+    config_files = []
+    checked = set()
 
     # Check the per-OS/type config file syntax or, if running in per-host mode,
     # check the per-host config file syntax
@@ -248,18 +376,22 @@ def check_config_syntax(args, inventory, scripts):
         else:
             config_file = args['configs']+'/merge_config_'+opt['os']+'.txt'
 
+        if (config_file, opt['os']) not in checked:
+            checked.add((config_file, opt['os']))
+            config_files.append((config_file, opt['os']))
 
-        command = shlex.quote(scripts['syntax'])
-        command += " -c "+shlex.quote(config_file)
-        command += " -t "+opt['os']
+    try:
+        results = modules['syntax'].check_config_files(
+            config_files, args['syntax_workers'],
+            modules['syntax'].CACHE_FILE
+        )
+    except Exception as e:
+        print("Unable to check config file syntax: {}".format(e))
+        results = []
+        passed = False
 
-        try:
-            result = subprocess.getstatusoutput(command)
-            if result[0] != 0:
-                print(result[1])
-                passed = False
-        except Exception as e:
-            print("Unable to check syntax for config file {}: {}".format(command, e))
+    for result in results:
+        if not result['passed']:
             passed = False
 
     if not passed:
@@ -296,8 +428,10 @@ def check_log_path_exists(log_dir):
     dirs = [ log_dir,
              log_dir+"/pre",
              log_dir+"/config",
+             log_dir+"/wave",
              log_dir+"/post",
              log_dir+"/diff",
+             log_dir+"/rollback",
             ]
 
     for d in dirs:
@@ -452,17 +586,6 @@ def commit_change(url, ref):
     return True
 
 
-def filter_inv(inventory, os_type):
-
-    # Filter the inventory down to the specified type:
-    filtered_inv = {}
-    for dev, opt in inventory.items():
-        if opt['os'] == os_type:
-            filtered_inv[dev] = opt
-
-    return filtered_inv
-
-
 def get_solarwinds_alarms(sw_api_url, inventory):
 
     """
@@ -491,6 +614,10 @@ def get_solarwinds_alarms(sw_api_url, inventory):
     api_query += "/Query?query=SELECT+SysName+,+IPAddress+,+Severity+FROM+"
     api_query += "Orion.Nodes+WHERE+Severity+>+1"
 
+    # Requests is only imported when SolarWinds is being checked
+    import requests
+    from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
     try:
         requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
         sw_nodes = requests.get(
@@ -533,23 +660,91 @@ def get_solarwinds_alarms(sw_api_url, inventory):
 
 
 def generate_state_diff(diff_dir, diff_filter, inventory, pre_dir, post_dir,
-                         scripts):
+                        modules, workers=1):
+
+    """
+    The per-device output directories are independent, so with more than
+    one worker the output files of all devices are compared in a single
+    process pool. The diffs are still written to one file per device.
+    Returns False if any output file couldn't be compared, the diffs are
+    then incomplete.
+    """
+
+    cmd_filter = modules['diff'].load_filter(diff_filter)
+
+    devices = []
 
     for dev, opt in inventory.items():
 
-        command = shlex.quote(scripts['diff'])
-        command += " -d "+shlex.quote(diff_dir+"/"+opt['hostname']+".diff")
-        command += " -f "+shlex.quote(diff_filter)
-        command += " -o "+opt['os']
-        command += " -pre "+shlex.quote(pre_dir+"/"+opt['hostname'])
-        command += " -post "+shlex.quote(post_dir+"/"+opt['hostname'])
+        dev_pre_dir = pre_dir+"/"+opt['hostname']
+        dev_post_dir = post_dir+"/"+opt['hostname']
 
-        cmd = shlex.split(command)
+        if ( (not modules['diff'].check_path_exists(dev_pre_dir)) or
+             (not modules['diff'].check_path_exists(dev_post_dir)) ):
+            print("Error generating state diff for {}".format(dev))
+            continue
+
+        devices.append({
+            'diff_file': diff_dir+"/"+opt['hostname']+".diff",
+            'os': opt['os'],
+            'post_dir': dev_post_dir,
+            'pre_dir': dev_pre_dir,
+        })
 
+    if workers > 1:
         try:
-            subprocess.run(cmd, check=True, timeout=60)
+            return modules['diff'].diff_devices(cmd_filter, devices, workers)
         except Exception as e:
             print("Error generating state diff: {}".format(e))
+            return False
+
+    ret_val = True
+
+    for device in devices:
+        try:
+            modules['diff'].diff_device(cmd_filter, device['diff_file'],
+                                        device['os'], device['pre_dir'],
+                                        device['post_dir'])
+        except Exception as e:
+            print("Error generating state diff: {}".format(e))
+            ret_val = False
+
+    return ret_val
+
+
+def get_dev_opts(opt):
+
+    """
+    Return a copy of the NAPALM driver arguments for a device. The functions
+    in the other scripts pop 'os' from, and add defaults to, the dict they
+    are given so they must not be given the inventory entry itself.
+    """
+
+    dev_opt = {}
+    for key in ['hostname', 'os', 'username', 'password', 'timeout',
+                'optional_args']:
+        if key in opt:
+            dev_opt[key] = copy.deepcopy(opt[key])
+
+    return dev_opt
+
+
+def get_waves(devs, canary, max_wave):
+
+    """
+    Split the devices into waves, the first wave is the canary devices and
+    each wave after that is twice the size of the last one, up to max_wave.
+    """
+
+    waves = []
+    size = max(1, canary)
+
+    while devs:
+        waves.append(devs[:size])
+        devs = devs[size:]
+        size = min(max(1, max_wave), size * 2)
+
+    return waves
 
 
 def git_directory(url):
@@ -568,33 +763,19 @@ def load_inv(args):
 
     print("Loading inventory {}".format(args['inventory_file']))
 
-    # Load the initial inventory from a YAML file
-    try:
-        inventory_file = open(args['inventory_file'])
-    except Exception as e:
-        print("Couldn't open inventory file {}".format(e))
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # to the devices matching the selector and device OS if specified
+    filtered_inv = inventory_cache.load_inv(args['inventory_file'],
+                                            args['select'], args['os'])
+    if filtered_inv is False:
         sys.exit(1)
 
-    try:
-        raw_inventory = yaml.load(inventory_file)
-    except Exception as e:
-        print("Couldn't load inventory YAML: {}".format(e))
-        sys.exit(1)
-
-    inventory_file.close()
-
-    # Filter the inventory to a specific device OS if specified
-    if args['os']:
-        filtered_inv = filter_inv(raw_inventory, args['os'])
-    else:
-        filtered_inv = raw_inventory
-
     inventory = filtered_inv.copy()
 
     for dev, opt in filtered_inv.items():
 
         # Remove any unsupported OS types from the inventory
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             print("Removing {}, unsupported device OS type: {}".
                   format(dev, opt['os']))
             inventory.pop(dev)
@@ -608,6 +789,49 @@ def load_inv(args):
     return inventory
 
 
+def load_scripts(scripts_dir, scripts):
+
+    """
+    Import the other scripts in this repo as modules so that each stage of
+    the change can call them directly. This means the Python interpreter,
+    NAPALM and the device driver libraries are only started and imported
+    once per run, instead of once per device per stage.
+    """
+
+    if not check_script_files_exist(scripts_dir, scripts):
+        return False
+
+    modules = {}
+
+    for name, script_path in scripts.items():
+
+        module_name = os.path.splitext(os.path.basename(script_path))[0]
+
+        # Worker processes started with spawn or forkserver (the default
+        # on macOS, and on Linux from Python 3.14) import the module by name
+        # to unpickle functions from it, e.g. in diff_devices(), so its
+        # directory must be on the path they inherit
+        script_dir = os.path.dirname(os.path.abspath(script_path))
+        if script_dir not in sys.path:
+            sys.path.append(script_dir)
+
+        try:
+            spec = importlib.util.spec_from_file_location(module_name,
+                                                          script_path)
+            module = importlib.util.module_from_spec(spec)
+            # Register the module so that functions from it can be sent to
+            # worker processes, e.g. by diff_devices()
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+        except Exception as e:
+            print("Couldn't load script {}: {}".format(script_path, e))
+            return False
+
+        modules[name] = module
+
+    return modules
+
+
 def parse_cli_args():
 
     parser = argparse.ArgumentParser(
@@ -616,6 +840,13 @@ def parse_cli_args():
                     'state change.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
+    parser.add_argument(
+        '-canary',
+        help='Number of devices in the first wave of the change, each wave '
+             'after that is twice the size of the last one.',
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '-checks',
         help='Directory of pre/post check command files. When making a '
@@ -637,6 +868,13 @@ def parse_cli_args():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-diff-workers',
+        help='Number of worker processes used to diff the pre and post-check '
+             'output of all devices.',
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '-filter',
         help='Location of the pre/post checks diff filter.',
@@ -660,6 +898,14 @@ def parse_cli_args():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-force-rollback',
+        help='With -rollback, also roll back the devices whose rollback '
+             'fingerprints don\'t show that the rollback restores their '
+             'pre-change config.',
+        default=False,
+        action='store_true',
+    )
     parser.add_argument(
         '-i', '--inventory-file',
         help='Device inventory file (YAML formatted). This is the default mode. '
@@ -679,6 +925,28 @@ def parse_cli_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-keepalive',
+        help='How often, in seconds, to check the sessions which are kept '
+             'open to each device between the stages of the change. Idle '
+             'sessions which have dropped are closed and reconnected when '
+             'next used. Set to 0 to disable.',
+        type=int,
+        default=60,
+    )
+    parser.add_argument(
+        '-max-sessions',
+        help='Maximum number of sessions to open to a single device.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '-max-wave',
+        help='Maximum number of devices in a wave of the change, the devices '
+             'in a wave are configured concurrently.',
+        type=int,
+        default=32,
+    )
     parser.add_argument(
         '-n', '--note',
         help='Override the commit note/comment. Not all devices support commit '
@@ -689,8 +957,9 @@ def parse_cli_args():
     parser.add_argument(
         '-o', '--os',
         help='Only process devices from the inventory file with the specific '
-             'OS type e.g. ios or junos. This is optional with an inventory '
-             'file but mandatory for a single device when using -t|--target.',
+             'OS type e.g. ios or junos, the same as -s os=<type>. This is '
+             'optional with an inventory file but mandatory for a single '
+             'device when using -t|--target.',
         type=str,
         default=None,
     )
@@ -714,6 +983,30 @@ def parse_cli_args():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-rollback-priority',
+        help='Roll back the devices which match this selector first, e.g. '
+             'tags=core. Use it more than once to set several priorities, the '
+             'devices matching none of them are rolled back last.',
+        type=str,
+        action='append',
+        default=None,
+    )
+    parser.add_argument(
+        '-rollback-workers',
+        help='Number of devices to roll back concurrently.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-scripts', '--scripts-dir',
         help='Path to the root of this NAPALM repo.',
@@ -727,6 +1020,13 @@ def parse_cli_args():
         type=str,
         default='https://solarwinds.example.com:17778/SolarWinds/InformationService/v3/Json',
     )
+    parser.add_argument(
+        '-syntax-workers',
+        help='Number of worker processes used to syntax check the config '
+             'files.',
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '-t', '--target',
         help='Hostname or IP of target device to configure. When using this '
@@ -750,6 +1050,15 @@ def parse_cli_args():
         default=False,
         action='store_true',
     )
+    parser.add_argument(
+        '-wave-checks',
+        help='Number of check commands, from the top of the checks file, to '
+             'run on each device after each wave of the change and diff '
+             'against the pre-change state. Set it to 0 to disable the '
+             'checks between waves.',
+        type=int,
+        default=5,
+    )
 
     return vars(parser.parse_args())
 
@@ -794,62 +1103,192 @@ def prompt(index):
         return False
 
 
-def rollback(inventory, scripts):
+def record_fingerprint(fingerprint_dir, dev, opt, device, modules, stage):
 
-    ret_val = True
+    """
+    Save the rollback fingerprint of a device for a stage of the change,
+    'pre' when the pre-change state is recorded or 'applied' once the config
+    has been committed. Recording the pre stage starts a new record.
+    """
 
-    for dev, opt in inventory.items():
+    filename = fingerprint_dir+"/"+dev+".yml"
 
-        command = shlex.quote(scripts['rollback'])
-        command += " -o "+opt['os']
-        command += " -p "+opt['password']
-        command += " -t "+opt['hostname']
-        command += " -u "+opt['username']
+    fingerprint = modules['rollback'].get_fingerprint(dev, device, opt['os'])
+    if not fingerprint:
+        return False
 
-        cmd = shlex.split(command)
+    record = {}
+    if stage != 'pre':
+        record = modules['rollback'].load_fingerprint(filename) or {}
+    record[stage] = fingerprint
 
-        try:
-            subprocess.run(cmd, check=True, timeout=300)
-        except Exception as e:
-            print("Error running rollback on {}: {}".format(dev, e))
-            ret_val = False
+    return modules['rollback'].save_fingerprint(filename, record)
 
-    if not ret_val:
-        print("There were errors with the rollback!")
 
-    return ret_val
+def rollback(args, log_dir, inventory, modules):
+
+    """
+    Roll back the devices concurrently in -rollback-priority order using
+    rollback.py, each device is given a copy of only its driver options.
+    Devices whose rollback fingerprints, recorded during the change, don't
+    check out are refused unless -force-rollback is used.
+    """
+
+    ready = modules['rollback'].get_ready_devices(inventory,
+                                                  log_dir+"/rollback/",
+                                                  args['force_rollback'])
+    refused = [dev for dev in inventory if dev not in ready]
+
+    order = modules['rollback'].get_rollback_order(ready,
+                                                   args['rollback_priority'])
+    if order is False:
+        return False
 
+    dev_opts = {dev: get_dev_opts(inventory[dev]) for dev in order}
+    results = modules['rollback'].rollback_inventory(dev_opts,
+                                                     args['rollback_workers'])
+
+    if refused:
+        print("Refused to roll back: {}".format(", ".join(refused)))
+
+    failed = [dev for dev in results if not results[dev]]
+    if failed:
+        print("There were errors with the rollback on: {}".
+              format(", ".join(sorted(failed))))
+        return False
+
+    return not refused
+
+
+def run_change(args, log_dir, inventory, modules, broker):
+
+    """
+    If the user is running a specific step in the change process, jump to
+    that function only:
+    """
+    if args['jump']:
+        
+        # Checkout network change git repo
+        if int(args['jump']) == 0:
+            script_git_checkout(args)
+            return
 
-def run_checks(args, log_dir, inventory, scripts):
+        # Record pre-change state only
+        if int(args['jump']) == 1:
+            script_pre_checks(args, log_dir, inventory, modules, broker)
+            return
+
+        # Apply config only
+        elif int(args['jump']) == 2:
+            script_apply_config(args, log_dir, inventory, modules, broker)
+            return
+
+        # Record post-change state only
+        elif int(args['jump']) == 3:
+            script_post_checks(args, log_dir, inventory, modules, broker)
+            return
+
+        # Commit and push to network change git repo only
+        elif int(args['jump']) == 4:
+            script_git_commit(args)
+            return
+
+        else:
+            print("Invalid option: -j {}!".format(args['jump']))
+            return
+
+    # Else, run all steps...
+
+    # Optionally check SolarWinds for active alarms
+    if args['solar_winds']:
+        alarm_hosts_pre = check_solarwinds(args['solar_winds'], inventory)
+        print("")
+        if not alarm_hosts_pre:
+            sys.exit(1)
+
+    # This function creates the dict entry args['git_dir']
+    script_git_checkout(args)
+    print("")
+    script_pre_checks(args, log_dir, inventory, modules, broker)
+    print("")
+    script_apply_config(args, log_dir, inventory, modules, broker)
+    print("")
+    script_post_checks(args, log_dir, inventory, modules, broker)
+    print("")
+
+    # Optioanlly check if same/new alarms are active
+    if args['solar_winds']:
+        alarm_hosts_post = check_solarwinds(args['solar_winds'], inventory)
+        print("")
+        if not alarm_hosts_post:
+            sys.exit(1)
+        else:
+            if alarm_hosts_pre != alarm_hosts_post:
+                print("Pre/Post alarms are different:")
+                print("pre: {}".format(alarm_hosts_pre))
+                print("post: {}".format(alarm_hosts_post))
+
+    script_git_commit(args)
+    print("")
+
+
+    print("All done!")
+
+
+def run_checks(args, log_dir, inventory, modules, broker,
+               fingerprint_dir=None):
 
     passed = True
 
     for dev, opt in inventory.items():
 
-        command = shlex.quote(scripts['log_cmd'])
-        command += " -o "+opt['os']
-        command += " -l "+log_dir
-        command += " -p "+opt['password']
-        command += " -t "+opt['hostname']
-        command += " -u "+opt['username']
-
         """
         If running in single host/target mode this argument points to a file
         else, if points to a directrory
         """
         if args['target']:
-            command += " -c "+shlex.quote(args['checks'])
+            checks_file = args['checks']
         else:
-            command += " -c "+shlex.quote(args['checks']+"/checks_"+opt['os']+".txt")
+            checks_file = args['checks']+"/checks_"+opt['os']+".txt"
+
+        # Arguments as run_and_log_per_cmd.py would have parsed them in
+        # target mode
+        log_args = {
+            'batch': False,
+            'cmd_dir': checks_file,
+            'log_dir': log_dir,
+            'target': opt['hostname'],
+        }
 
-        cmd = shlex.split(command)
+        print("Trying {}...".format(dev))
+
+        cmds = modules['log_cmd'].load_cmds(log_args, opt)
+        if not cmds:
+            passed = False
+            continue
+
+        device = session_borrow(broker, dev, opt, modules)
+        if not device:
+            passed = False
+            continue
 
         try:
-            subprocess.run(cmd, check=True, timeout=300)
+            if not modules['log_cmd'].run_cmds(log_args, opt['hostname'],
+                                               device, cmds):
+                passed = False
         except Exception as e:
             print("Error running device check commands: {}".format(e))
             passed = False
 
+        # Record what a rollback would restore while the session is open
+        if fingerprint_dir:
+            if not record_fingerprint(fingerprint_dir, dev, opt, device,
+                                      modules, 'pre'):
+                passed = False
+
+        session_return(broker, dev, device)
+        print("{} done".format(dev))
+
     print("")
 
     if not passed:
@@ -865,11 +1304,11 @@ def run_checks(args, log_dir, inventory, scripts):
         return True
 
 
-def script_apply_config(args, log_dir, inventory, scripts):
+def script_apply_config(args, log_dir, inventory, modules, broker):
 
     if not prompt(2):
         sys.exit(1)
-    if not apply_config(args, log_dir+"/config/", inventory, scripts):
+    if not apply_config(args, log_dir, inventory, modules, broker):
         sys.exit(1)  ### If no, ask for rollback!
 
 
@@ -891,15 +1330,16 @@ def script_git_commit(args):
             sys.exit(1)
 
 
-def script_pre_checks(args, log_dir, inventory, scripts):
+def script_pre_checks(args, log_dir, inventory, modules, broker):
 
     if not prompt(1):
         sys.exit(1)
-    if not run_checks(args, log_dir+"/pre/", inventory, scripts):
+    if not run_checks(args, log_dir+"/pre/", inventory, modules, broker,
+                      log_dir+"/rollback/"):
         sys.exit(1)
 
 
-def script_pre_reqs(args, inventory, scripts):
+def script_pre_reqs(args, inventory, modules):
 
     if not inventory:
         sys.exit(1)
@@ -910,24 +1350,141 @@ def script_pre_reqs(args, inventory, scripts):
     if not check_config_files_exist(args, inventory):
         sys.exit(1)
 
-    if not check_script_files_exist(args['scripts_dir'], scripts):
-        sys.exit(1)
-
-    if not check_config_syntax(args, inventory, scripts):             
+    if not check_config_syntax(args, inventory, modules):
         sys.exit(1)
 
 
-def script_post_checks(args, log_dir, inventory, scripts):
+def script_post_checks(args, log_dir, inventory, modules, broker):
 
     if not prompt(3):
         sys.exit(1)
-    if not run_checks(args, log_dir+"/post/", inventory, scripts):
+    if not run_checks(args, log_dir+"/post/", inventory, modules, broker):
         sys.exit(1)
 
-    generate_state_diff(log_dir+"/diff", args['filter'], inventory,
-                        log_dir+"/pre/", log_dir+"/post", scripts)
+    if not generate_state_diff(log_dir+"/diff", args['filter'], inventory,
+                               log_dir+"/pre/", log_dir+"/post", modules,
+                               args['diff_workers']):
+        print("The state diff is incomplete, not all outputs were compared")
+        sys.exit(1)
     
 
+def session_borrow(broker, dev, opt, modules):
+
+    """
+    Borrow an open session to a device from the session broker, connecting
+    to the device if it has no idle session. At most -max-sessions sessions
+    are opened to the same device, further borrowers wait for a session to be
+    returned. A session which has dropped since it was last used is
+    reconnected. Returns False if the device couldn't be connected to.
+    """
+
+    with broker['lock']:
+        if dev not in broker['devices']:
+            broker['devices'][dev] = {
+                'idle': [],
+                'lock': threading.Lock(),
+                'slots': threading.BoundedSemaphore(broker['max_sessions']),
+            }
+        entry = broker['devices'][dev]
+
+    entry['slots'].acquire()
+
+    device = None
+    with entry['lock']:
+        if entry['idle']:
+            device = entry['idle'].pop()
+
+    if device and not session_is_alive(device):
+        print("Session to {} has dropped, reconnecting...".format(dev))
+        session_close(dev, device)
+        device = None
+
+    if not device:
+        device = session_connect(opt, modules)
+
+    if not device:
+        entry['slots'].release()
+        return False
+
+    return device
+
+
+def session_close(dev, device):
+
+    try:
+        device.close()
+    except Exception as e:
+        print("Couldn't cleanly close session to {}: {}".format(dev, e))
+
+
+def session_connect(opt, modules):
+
+    dev_opt = get_dev_opts(opt)
+
+    # Default timeout is 60 seconds, raise to 180 as apply_config.py does
+    if 'timeout' not in dev_opt:
+        dev_opt['timeout'] = 180
+
+    driver = drivers.get_network_driver(dev_opt['os'])
+
+    # If Kwargs doesn't have exactly the keys required (no extras)
+    # driver() will throw an exception
+    dev_opt.pop('os')
+    device = driver(**drivers.get_driver_args(dev_opt))
+
+    # Try to get the transport port number and type for debug messages
+    port = modules['log_cmd'].get_port(device)
+    transport = modules['log_cmd'].get_transport(device)
+
+    if not modules['log_cmd'].dev_connect(device, dev_opt, port, transport):
+        return False
+
+    return device
+
+
+def session_is_alive(device):
+
+    """
+    For IOS devices is_alive() sends a null character over the SSH session
+    which is what keeps an idle session up. Junos devices already send SSH
+    keepalives by default (the NAPALM 'keepalive' optional arg).
+    """
+
+    try:
+        return device.is_alive()['is_alive']
+    except Exception:
+        return False
+
+
+def session_keepalive(broker):
+
+    while not broker['stop'].wait(broker['keepalive']):
+
+        with broker['lock']:
+            entries = list(broker['devices'].items())
+
+        for dev, entry in entries:
+            with entry['lock']:
+                alive = []
+                for device in entry['idle']:
+                    if session_is_alive(device):
+                        alive.append(device)
+                    else:
+                        print("Session to {} has dropped".format(dev))
+                        session_close(dev, device)
+                entry['idle'] = alive
+
+
+def session_return(broker, dev, device):
+
+    entry = broker['devices'][dev]
+
+    with entry['lock']:
+        entry['idle'].append(device)
+
+    entry['slots'].release()
+
+
 def set_dev_opts(args, opt):
 
     if 'username' not in opt:
@@ -950,6 +1507,91 @@ def set_dev_opts(args, opt):
     return True
 
 
+def wave_check(args, log_dir, dev, opt, modules, broker, cmd_filter):
+
+    """
+    Run the first -wave-checks check commands on a device which has just
+    been changed and diff the output against its pre-change state. Returns
+    False if the commands failed or any of the outputs have changed.
+    """
+
+    if args['target']:
+        checks_file = args['checks']
+    else:
+        checks_file = args['checks']+"/checks_"+opt['os']+".txt"
+
+    # Arguments as run_and_log_per_cmd.py would have parsed them in
+    # target mode
+    log_args = {
+        'batch': False,
+        'cmd_dir': checks_file,
+        'log_dir': log_dir+"/wave/",
+        'target': opt['hostname'],
+    }
+
+    cmds = modules['log_cmd'].load_cmds(log_args, opt)
+    if not cmds:
+        return False
+    cmds = [cmd for cmd in cmds if cmd][:args['wave_checks']]
+
+    pre_dir = log_dir+"/pre/"+opt['hostname']
+    wave_dir = log_dir+"/wave/"+opt['hostname']
+    diff_file = log_dir+"/wave/"+opt['hostname']+".diff"
+
+    # Outputs and diffs left by an earlier run with the same -r reference
+    # (e.g. before a -j re-run) must not be compared or appended to
+    try:
+        if os.path.isdir(wave_dir):
+            shutil.rmtree(wave_dir)
+        if os.path.isfile(diff_file):
+            os.remove(diff_file)
+    except Exception as e:
+        print("Couldn't clear the old wave check outputs of {}: {}".
+              format(dev, e))
+        return False
+
+    device = session_borrow(broker, dev, opt, modules)
+    if not device:
+        return False
+
+    try:
+        passed = modules['log_cmd'].run_cmds(log_args, opt['hostname'],
+                                             device, cmds)
+    except Exception as e:
+        print("Error running wave check commands on {}: {}".format(dev, e))
+        passed = False
+
+    session_return(broker, dev, device)
+
+    if not os.path.isdir(pre_dir):
+        print("No pre-change state for {}, skipping the wave check diff".
+              format(dev))
+        return passed
+
+    # Only the outputs of the wave check commands are compared, the pre
+    # directory has the outputs of every check command
+    changed = []
+    for file in sorted(os.listdir(wave_dir)):
+        pre_file = pre_dir+"/"+file
+        if not file.lower().endswith(".txt") or not os.path.isfile(pre_file):
+            continue
+
+        diff = modules['diff'].generate_diff(cmd_filter, opt['os'], pre_file,
+                                             wave_dir+"/"+file)
+        if diff:
+            modules['diff'].write_diff(diff_file, diff)
+            changed.append(file)
+
+    if changed:
+        print("{} wave check outputs have changed, see {}: {}".
+              format(dev, diff_file, ", ".join(changed)))
+        passed = False
+    else:
+        print("{} wave check passed".format(dev))
+
+    return passed
+
+
 def main():
     
     args = parse_cli_args()
@@ -967,98 +1609,40 @@ def main():
         "rollback": args['scripts_dir']+"rollback/rollback.py"
     }
 
-    # Perform a rollback on each device
+    modules = load_scripts(args['scripts_dir'], scripts)
+    if not modules:
+        sys.exit(1)
+
+    if args['git_url']:
+        log_dir = git_directory(args['git_url'])+"/"+args['ref']+"/"
+    else:
+        log_dir = "./"+args['ref']+"/"
+
+    # Perform a rollback on each device, checked against the rollback
+    # fingerprints recorded in the change's logging directory
     if args['rollback']:
         print("\nPerforming rollback...")
-        rollback(inventory, scripts)
+        if not rollback(args, log_dir, inventory, modules):
+            sys.exit(1)
         print("All done!")
         return
 
 
-    script_pre_reqs(args, inventory, scripts)
+    script_pre_reqs(args, inventory, modules)
     print("")
 
     # Create logging directory if it doesn't already exist
-    if args['git_url']:
-        log_dir = git_directory(args['git_url'])+"/"+args['ref']+"/"
-    else:
-        log_dir = "./"+args['ref']+"/"
     if not check_log_path_exists(log_dir):
         sys.exit(1)
     print("")
 
 
-    """
-    If the user is running a specific step in the change process, jump to
-    that function only:
-    """
-    if args['jump']:
-        
-        # Checkout network change git repo
-        if int(args['jump']) == 0:
-            script_git_checkout(args)
-            return
-
-        # Record pre-change state only
-        if int(args['jump']) == 1:
-            script_pre_checks(args, log_dir, inventory, scripts)
-            return
-
-        # Apply config only
-        elif int(args['jump']) == 2:
-            script_apply_config(args, log_dir, inventory, scripts)
-            return
-
-        # Record post-change state only
-        elif int(args['jump']) == 3:
-            script_post_checks(args, log_dir, inventory, scripts)
-            return
-
-        # Commit and push to network change git repo only
-        elif int(args['jump']) == 4:
-            script_git_commit(args)
-            return
-
-        else:
-            print("Invalid option: -j {}!".format(args['jump']))
-            return
-
-    # Else, run all steps...
-
-    # Optionally check SolarWinds for active alarms
-    if args['solar_winds']:
-        alarm_hosts_pre = check_solarwinds(args['solar_winds'], inventory)
-        print("")
-        if not alarm_hosts_pre:
-            sys.exit(1)
-
-    # This function creates the dict entry args['git_dir']
-    #script_git_checkout(args)
-    #print("")
-    #script_pre_checks(args, log_dir, inventory, scripts)
-    #print("")
-    #script_apply_config(args, log_dir, inventory, scripts)
-    #print("")
-    #script_post_checks(args, log_dir, inventory, scripts)
-    #print("")
-
-    # Optioanlly check if same/new alarms are active
-    if args['solar_winds']:
-        alarm_hosts_post = check_solarwinds(args['solar_winds'], inventory)
-        print("")
-        if not alarm_hosts_post:
-            sys.exit(1)
-        else:
-            if alarm_hosts_pre != alarm_hosts_post:
-                print("Pre/Post alarms are different:")
-                print("pre: {}".format(alarm_hosts_pre))
-                print("post: {}".format(alarm_hosts_post))
-
-    script_git_commit(args)
-    print("")
-
+    broker = broker_start(args, modules)
 
-    print("All done!")
+    try:
+        run_change(args, log_dir, inventory, modules, broker)
+    finally:
+        broker_stop(broker)
 
 
 if __name__ == '__main__':
@@ -19,27 +19,42 @@ R2:
 
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-from jnpr.junos.exception import ConnectUnknownHostError as JuniperConnectUnknownHostError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.ssh_exception import NetMikoAuthenticationException
-from netmiko.ssh_exception import NetMikoTimeoutException
+import hashlib
 import os
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
+import re
 import sys
+import time
 import yaml
 
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
+
+
+# The config backup the NAPALM IOS driver saves before each commit
+IOS_ROLLBACK_FILE = "flash:rollback_config.txt"
+
+# The rollback file in the output of "dir", giving its size and timestamp
+IOS_DIR_ENTRY = re.compile(
+    r'^\s*\d+\s+\S+\s+(\d+)\s+(.+?)\s+\S*rollback_config\.txt\s*$', re.M
+)
+
+# A commit in the output of "show system commit", giving its timestamp
+JUNOS_COMMIT = re.compile(
+    r'^\s*\d+\s+(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d \S+)', re.M
+)
+
+# Lines of the running config which change when the config itself hasn't
+VOLATILE_CONFIG = re.compile(
+    r'^(!|#|Building configuration|Current configuration)'
+)
+
 
 def build_inventory(args):
 
@@ -79,17 +94,61 @@ def build_inventory(args):
                 return inventory
 
 
+def check_fingerprint(dev, record):
+
+    """
+    Check the rollback fingerprints of a device, recorded by network_change.py
+    before and after the change was applied, show that a rollback restores
+    the pre-change config. Returns False and prints why if they don't.
+    """
+
+    reason = None
+
+    if not record or 'pre' not in record:
+        reason = "no pre-change rollback fingerprint was recorded"
+    elif 'applied' not in record:
+        reason = ("no rollback fingerprint was recorded after the change "
+                  "was applied")
+    else:
+        pre = record['pre']
+        applied = record['applied']
+
+        if applied['config'] == pre['config']:
+            reason = "the change didn't alter the running config"
+
+        elif applied['os'] == 'ios':
+            if not applied.get('rollback_file'):
+                reason = "{} is missing".format(IOS_ROLLBACK_FILE)
+            elif applied['rollback_file'] == pre.get('rollback_file'):
+                reason = ("{} wasn't rewritten when the change was applied".
+                          format(IOS_ROLLBACK_FILE))
+
+        elif applied['os'] == 'junos':
+            commits = applied.get('commits', [])
+            if (len(commits) < 2 or not pre.get('commits') or
+                    commits[1] != pre['commits'][0]):
+                reason = ("rollback 1 isn't the pre-change config, the "
+                          "commit history doesn't match")
+
+        else:
+            reason = "unsupported device type {}".format(applied['os'])
+
+    if reason:
+        print("Refusing to roll back {}: {}".format(dev, reason))
+        return False
+
+    return True
+
+
 def dev_connect(device, opt, port, transport):
 
     try:
        device.open()
-    except (JuniperConnectAuthError, NetMikoAuthenticationException):
+    except drivers.get_auth_errors():
         print("Unable to authenticate to {} as {}".
               format(opt['hostname'], opt['username']))
         return False
-    except (ConnectionException, JuniperConnectRefusedError, 
-            JuniperConnectUnknownHostError, SocketError,
-            SocketTimeout, SSHException):
+    except drivers.get_connect_errors():
         print("Unable to connect to {} using {} on port {}".
               format(opt['hostname'], transport, port))
         return False
@@ -100,15 +159,54 @@ def dev_connect(device, opt, port, transport):
     return True
 
 
-def filter_inv(inventory, os_type):
+def get_config_checksum(config):
 
-    # Filter the inventory down to the specified type:
-    filtered_inv = {}
-    for dev, opt in inventory.items():
-        if opt['os'] == os_type:
-            filtered_inv[dev] = opt
+    lines = [line.rstrip() for line in config.splitlines()
+             if line.strip() and not VOLATILE_CONFIG.match(line)]
+
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+
+def get_fingerprint(dev, device, dev_os):
+
+    """
+    Return the rollback fingerprint of a connected device: a checksum of its
+    running config and the state of what a rollback restores, the size and
+    timestamp of the rollback file on IOS or the commit history on Junos.
+    Returns False if it couldn't be read.
+    """
+
+    try:
+        config = device.get_config(retrieve='running')
+        fingerprint = {
+            'config': get_config_checksum(config.get('running', '')),
+            'os': dev_os,
+            'time': datetime.now().strftime('%Y-%m-%d--%H-%M-%S'),
+        }
+
+        if dev_os == 'ios':
+            cmd = "dir {}".format(IOS_ROLLBACK_FILE)
+            match = IOS_DIR_ENTRY.search(device.cli([cmd])[cmd])
+            if match:
+                fingerprint['rollback_file'] = {
+                    'date': match.group(2),
+                    'size': int(match.group(1)),
+                }
+            else:
+                fingerprint['rollback_file'] = None
+
+        elif dev_os == 'junos':
+            cmd = "show system commit"
+            # The latest commit is rollback 0, the one before it rollback 1
+            commits = JUNOS_COMMIT.findall(device.cli([cmd])[cmd])
+            fingerprint['commits'] = commits[:2]
+
+    except Exception as e:
+        print("Couldn't read the rollback fingerprint of {}: {}".
+              format(dev, e))
+        return False
 
-    return filtered_inv
+    return fingerprint
 
 
 def get_port(device):
@@ -128,6 +226,50 @@ def get_port(device):
     return port
 
 
+def get_ready_devices(inventory, fingerprint_dir, force=False):
+
+    """
+    Return the devices of the inventory whose rollback fingerprints in
+    fingerprint_dir pass check_fingerprint(). This only reads the saved
+    fingerprints, the devices aren't connected to. With force the devices
+    which fail the check are returned too.
+    """
+
+    ready = {}
+
+    for dev, opt in inventory.items():
+        record = load_fingerprint(os.path.join(fingerprint_dir, dev+".yml"))
+        if check_fingerprint(dev, record):
+            ready[dev] = opt
+        elif force:
+            print("Rolling back {} anyway, the rollback is forced".format(dev))
+            ready[dev] = opt
+
+    return ready
+
+
+def get_rollback_order(inventory, priority):
+
+    """
+    Return the devices in the order they are rolled back. The devices which
+    match the first priority selector go first, then those matching the
+    second one and so on, the remaining devices go last in inventory order.
+    Returns False if a selector is invalid.
+    """
+
+    order = []
+
+    for selector in (priority or []):
+        selected = inventory_cache.select_inv(inventory, selector)
+        if selected is False:
+            return False
+        order.extend(dev for dev in selected if dev not in order)
+
+    order.extend(dev for dev in inventory if dev not in order)
+
+    return order
+
+
 def get_transport(device):
 
     transport = "unknown"
@@ -140,37 +282,41 @@ def get_transport(device):
     return transport
 
 
-def load_inv(args):
+def load_fingerprint(filename):
 
-    print("Loading inventory {}".format(args['inventory_file']))
+    """
+    Return the rollback fingerprints saved in filename, or None if there
+    aren't any.
+    """
 
-    # Load the initial inventory from a YAML file
-    try:
-        inventory_file = open(args['inventory_file'])
-    except Exception as e:
-        print("Couldn't open inventory file {}".format(e))
-        sys.exit(1)
+    if not os.path.isfile(filename):
+        return None
 
     try:
-        raw_inventory = yaml.load(inventory_file)
+        with open(filename) as fingerprint_file:
+            return yaml.safe_load(fingerprint_file)
     except Exception as e:
-        print("Couldn't load inventory YAML: {}".format(e))
-        sys.exit(1)
+        print("Couldn't load rollback fingerprint {}: {}".format(filename, e))
+        return None
 
-    inventory_file.close()
 
-    # Filter the inventory to a specific device OS if specified
-    if args['os']:
-        filtered_inv = filter_inv(raw_inventory, args['os'])
-    else:
-        filtered_inv = raw_inventory
+def load_inv(args):
+
+    print("Loading inventory {}".format(args['inventory_file']))
+
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # to the devices matching the selector and device OS if specified
+    filtered_inv = inventory_cache.load_inv(args['inventory_file'],
+                                            args['select'], args['os'])
+    if filtered_inv is False:
+        sys.exit(1)
 
     inventory = filtered_inv.copy()
 
     for dev, opt in filtered_inv.items():
 
         # Remove any unsupported OS types from the inventory
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             print("Removing {}, unsupported device OS type: {}".
                   format(dev, opt['os']))
             inventory.pop(dev)
@@ -190,6 +336,21 @@ def parse_cli_args():
         description='Run a config rollback on each device in the inventory.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
+    parser.add_argument(
+        '-f', '--fingerprints',
+        help='Directory of the rollback fingerprints network_change.py '
+             'recorded for a change (<ref>/rollback/). Devices whose '
+             'fingerprints don\'t show that the rollback restores their '
+             'pre-change config are refused, without connecting to them.',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '--force',
+        help='Roll back the devices refused by the -f|--fingerprints check.',
+        default=False,
+        action='store_true',
+    )
     parser.add_argument(
         '-i', '--inventory-file',
         help='Device inventory file (YAML formatted). This is the default mode. '
@@ -201,8 +362,9 @@ def parse_cli_args():
     parser.add_argument(
         '-o', '--os',
         help='Only process devices from the inventory file with the specific '
-             'OS type e.g. ios or junos. This is optional with an inventory '
-             'file but mandatory for a single device when using -t|--target.',
+             'OS type e.g. ios or junos, the same as -s os=<type>. This is '
+             'optional with an inventory file but mandatory for a single '
+             'device when using -t|--target.',
         type=str,
         default=None,
     )
@@ -219,6 +381,24 @@ def parse_cli_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-P', '--priority',
+        help='Roll back the devices which match this selector first, e.g. '
+             'tags=core. Use it more than once to set several priorities, the '
+             'devices matching none of them are rolled back last.',
+        type=str,
+        action='append',
+        default=None,
+    )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--target',
         help='Hostname or IP of target device to configure. When using this '
@@ -234,10 +414,100 @@ def parse_cli_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of devices to roll back concurrently. The devices are '
+             'started in priority order, a slow device doesn\'t hold up the '
+             'devices after it.',
+        type=int,
+        default=1,
+    )
 
     return vars(parser.parse_args())
 
 
+def rollback_device(dev, opt):
+
+    """
+    Connect to a single device and roll back its config.
+    Returns False if the rollback failed.
+    """
+
+    print("Trying {}...".format(dev))
+
+    driver = drivers.get_network_driver(opt['os'])
+
+    # If Kwargs doesn't have exactly the keys required (no extras)
+    # driver() will throw an exception
+    os = opt['os']
+    opt.pop('os')
+    device = driver(**drivers.get_driver_args(opt))
+
+    # Try to get the transport port number and type for debug messages
+    port = get_port(device)
+    transport = get_transport(device)
+
+    # Connect to the device
+    if not dev_connect(device, opt, port, transport):
+        return False
+
+    if os == 'ios':
+        output = rollback_ios(dev, device)
+    elif os == 'junos':
+        output = rollback_junos(dev, device)
+    else:
+        print("Unsupported device type {}, skipping {}!".format(os, dev))
+        output = False
+
+    device.close()
+    print("{} done".format(dev))
+
+    return output
+
+
+def rollback_inventory(inventory, workers=1, priority=None):
+
+    """
+    Roll back the devices in priority order using a bounded pool of worker
+    threads, printing the result of each device as it finishes. Returns a
+    dict of {dev: result}, or False if a priority selector is invalid.
+    """
+
+    order = get_rollback_order(inventory, priority)
+    if order is False:
+        return False
+
+    results = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+
+        # rollback_device() pops 'os' from the options it is given, so each
+        # device gets its own copy
+        futures = {}
+        for dev in order:
+            future = pool.submit(rollback_device, dev, dict(inventory[dev]))
+            futures[future] = dev
+
+        for future in as_completed(futures):
+            dev = futures[future]
+            # Isolate each device, an unexpected error on one device must
+            # not stop the remaining devices
+            try:
+                results[dev] = future.result()
+            except Exception as e:
+                print("Error running rollback on {}: {}".format(dev, e))
+                results[dev] = False
+
+            print("[{}/{}] {} {} after {:.1f}s".format(
+                len(results), len(order), dev,
+                "rolled back" if results[dev] else "FAILED",
+                time.perf_counter() - start,
+            ))
+
+    return results
+
+
 def rollback_ios(dev, device):
 
 
@@ -246,7 +516,7 @@ def rollback_ios(dev, device):
     config backup on the device called rollback_config.txt, before any changes
     are made.
     """
-    ios_cmd = "configure replace flash:rollback_config.txt force"
+    ios_cmd = "configure replace {} force".format(IOS_ROLLBACK_FILE)
 
     try:
         device._file_prompt_quiet()
@@ -301,6 +571,18 @@ def rollback_junos(dev, device):
         return False
 
 
+def save_fingerprint(filename, record):
+
+    try:
+        with open(filename, 'w') as fingerprint_file:
+            yaml.safe_dump(record, fingerprint_file, default_flow_style=False)
+    except Exception as e:
+        print("Couldn't save rollback fingerprint {}: {}".format(filename, e))
+        return False
+
+    return True
+
+
 def set_dev_opts(args, opt):
 
     if 'username' not in opt:
@@ -332,46 +614,31 @@ def main():
     if not inventory:
         sys.exit(1)
 
-    ret_val = True
-    for dev, opt in inventory.items():
-
-        print("Trying {}...".format(dev))
-
-        driver = napalm.get_network_driver(opt['os'])
-        
-        # If Kwargs doesn't have exactly the keys required (no extras)
-        # driver() will throw an exception
-        os = opt['os']
-        opt.pop('os')
-        device = driver(**opt)
-
-        # Try to get the transport port number and type for debug messages
-        port = get_port(device)
-        transport = get_transport(device)
-
-        # Connect to the device
-        if not dev_connect(device, opt, port, transport):
-            ret_val = False
-            continue
-
-        if os == 'ios':
-            output = rollback_ios(dev, device)
-        elif os == 'junos':
-            output = rollback_junos(dev, device)
-        else:
-            print("Unsupported device type {}, skipping {}!".format(os, dev))
-
-        if not output:
-            ret_val = False
-
-        device.close()
-        print("{} done".format(dev))
+    ready = inventory
+    if args['fingerprints']:
+        ready = get_ready_devices(inventory, args['fingerprints'],
+                                  args['force'])
+        if not ready:
+            print("No devices are ready to roll back")
+            sys.exit(1)
+    refused = [dev for dev in inventory if dev not in ready]
+
+    results = rollback_inventory(ready, args['workers'], args['priority'])
+    if results is False:
+        sys.exit(1)
 
+    failed = [dev for dev in results if not results[dev]]
+    print("Rolled back {} of {} device(s)".
+          format(len(results) - len(failed), len(inventory)))
 
-    if ret_val:
-        sys.exit(0)
-    else:
+    if refused:
+        print("Refused to roll back: {}".format(", ".join(refused)))
+    if failed:
+        print("Rollback failed on: {}".format(", ".join(sorted(failed))))
+    if refused or failed:
         sys.exit(1)
+    else:
+        sys.exit(0)
 
 
 if __name__ == '__main__':
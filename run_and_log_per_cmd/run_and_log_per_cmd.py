@@ -24,26 +24,30 @@ R2:
 
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-from jnpr.junos.exception import ConnectUnknownHostError as JuniperConnectUnknownHostError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.ssh_exception import NetMikoAuthenticationException
-from netmiko.ssh_exception import NetMikoTimeoutException
 import os
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
 import sys
-import yaml
+import time
+
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
+
+
+# The timeout NAPALM uses when the inventory doesn't set one
+DRIVER_TIMEOUT = 60
+
+
+class DeviceTimeoutError(Exception):
+
+    """
+    Raised by run_device() when a device runs past its --device-timeout.
+    """
 
 
 def check_cmd_files_exist(args, inventory):
@@ -66,7 +70,7 @@ def check_cmd_files_exist(args, inventory):
     # Check all types of command files exist
     for dev, opt in inventory.items():
 
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             continue
 
         cmd_file = args['cmd_dir']+'/cmd_'+opt['os']+'.txt'
@@ -98,13 +102,11 @@ def dev_connect(device, opt, port, transport):
 
     try:
        device.open()
-    except (JuniperConnectAuthError, NetMikoAuthenticationException):
+    except drivers.get_auth_errors():
         print("Unable to authenticate to {} as {}".
               format(opt['hostname'], opt['username']))
         return False
-    except (ConnectionException, JuniperConnectRefusedError, 
-            JuniperConnectUnknownHostError, SocketError,
-            SocketTimeout, SSHException):
+    except drivers.get_connect_errors():
         print("Unable to connect to {} using {} on port {}".
               format(opt['hostname'], transport, port))
         return False
@@ -115,17 +117,6 @@ def dev_connect(device, opt, port, transport):
     return True
 
 
-def filter_inv(inventory, os_type):
-
-    # Filter the inventory down to the specified type:
-    filtered_inv = {}
-    for dev, opt in inventory.items():
-        if opt['os'] == os_type:
-            filtered_inv[dev] = opt
-
-    return filtered_inv
-
-
 def get_port(device):
 
     port = "unknown"
@@ -184,33 +175,19 @@ def load_inv(args):
 
     print("Loading inventory {}".format(args['inventory_file']))
 
-    # Load the initial inventory from a YAML file
-    try:
-        inventory_file = open(args['inventory_file'])
-    except Exception as e:
-        print("Couldn't open inventory file {}".format(e))
-        sys.exit(1)
-
-    try:
-        raw_inventory = yaml.load(inventory_file)
-    except Exception as e:
-        print("Couldn't load inventory YAML: {}".format(e))
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # to the devices matching the selector and device OS if specified
+    filtered_inv = inventory_cache.load_inv(args['inventory_file'],
+                                            args['select'], args['os'])
+    if filtered_inv is False:
         sys.exit(1)
 
-    inventory_file.close()
-
-    # Filter the inventory to a specific device OS if specified
-    if args['os']:
-        filtered_inv = filter_inv(raw_inventory, args['os'])
-    else:
-        filtered_inv = raw_inventory
-
     inventory = filtered_inv.copy()
 
     for dev, opt in filtered_inv.items():
 
         # Remove any unsupported OS types from the inventory
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             print("Removing {}, unsupported device OS type: {}".
                   format(dev, opt['os']))
             inventory.pop(dev)
@@ -232,6 +209,15 @@ def parse_cli_args():
                     'command into a seperate text file.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
+    parser.add_argument(
+        '-b', '--batch',
+        help='Send all commands to a device in a single request instead of '
+             'one request per command. If any command fails the batch is '
+             'split in half and retried until the failed command(s) are '
+             'found, the output of all other commands is kept.',
+        default=False,
+        action='store_true',
+    )
     parser.add_argument(
         '-c', '--cmd-dir',
         help='Path to the command file(s) directory. If using -t|--target '
@@ -239,6 +225,17 @@ def parse_cli_args():
         type=str,
         default='./commands',
     )
+    parser.add_argument(
+        '--device-timeout',
+        help='When using -w|--workers, the maximum number of seconds a single '
+             'device may take to connect and run all commands. No more '
+             'commands are sent to a device once it has timed out, its '
+             'session is closed and it is reported as timed out. The driver '
+             'timeout of each device is lowered to at most this value. Set '
+             'to 0 to disable.',
+        type=int,
+        default=600,
+    )
     parser.add_argument(
         '-i', '--inventory-file',
         help='Device inventory file (YAML formatted). This is the default mode. '
@@ -256,8 +253,9 @@ def parse_cli_args():
     parser.add_argument(
         '-o', '--os',
         help='Only process devices from the inventory file with the specific '
-             'OS type e.g. ios or junos. This is optional with an inventory '
-             'file but mandatory for a single device when using -t|--target.',
+             'OS type e.g. ios or junos, the same as -s os=<type>. This is '
+             'optional with an inventory file but mandatory for a single '
+             'device when using -t|--target.',
         type=str,
         default=None,
     )
@@ -274,6 +272,15 @@ def parse_cli_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--target',
         help='Hostname or IP of target device to configure. When using this '
@@ -289,6 +296,13 @@ def parse_cli_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of devices to run commands against concurrently. The '
+             'default of 1 processes the inventory one device at a time.',
+        type=int,
+        default=1,
+    )
 
     return vars(parser.parse_args())
 
@@ -303,6 +317,208 @@ def run_cmd(command, dev, device):
         return False
 
 
+def check_deadline(dev, deadline):
+
+    if (deadline) and (time.monotonic() >= deadline):
+        raise DeviceTimeoutError("{} ran past its device timeout".format(dev))
+
+
+def run_cmd_batch(cmds, dev, device, deadline=None):
+
+    """
+    Run a list of commands using a single device.cli() call. If one command
+    in the list fails device.cli() raises an exception and the output of
+    every command in the list is lost, so the list is split in half and each
+    half is retried, recursively, until the failing command(s) have been
+    isolated. When every command is good this costs a single round trip to
+    the device. Returns a dict of command output, keyed by command, and a
+    list of the commands which failed.
+    """
+
+    if not cmds:
+        return {}, []
+
+    check_deadline(dev, deadline)
+
+    try:
+        output = device.cli(cmds)
+        return output, []
+    except Exception as e:
+        if len(cmds) == 1:
+            print("Couldn't run a command on {}: {}".format(dev, e))
+            return {}, cmds
+
+    half = len(cmds) // 2
+    output, failed = run_cmd_batch(cmds[:half], dev, device, deadline)
+    output_2, failed_2 = run_cmd_batch(cmds[half:], dev, device, deadline)
+    output.update(output_2)
+
+    return output, failed + failed_2
+
+
+def run_cmds(args, dev, device, cmds, deadline=None):
+
+    """
+    Run a list of commands on an already connected device and save the output
+    of each command to a per-command file. Returns False if any command
+    failed. If deadline (a time.monotonic() value) is given,
+    DeviceTimeoutError is raised once it has passed, before the next command
+    is sent. The device isn't closed so that the caller can keep using it.
+    """
+
+    ret_val = True
+
+    log_dir = args['log_dir']+'/'+dev
+    check_log_path_exists(log_dir)
+
+    # In batch mode all commands are sent in one device.cli() call and
+    # the batch is only split up if one of the commands fails
+    if args['batch']:
+
+        output, failed = run_cmd_batch(cmds, dev, device, deadline)
+        if failed:
+            ret_val = False
+
+        for cmd in cmds:
+
+            if cmd not in output:
+                continue
+
+            if not save_output(cmd, dev, log_dir, output):
+                ret_val = False
+
+    # The list of commands loaded from the text file and passed to
+    # device.cli() is processed as a single list, if one of the commands
+    # fails to run the remaining commands in the list aren't run. The
+    # output dict returned by device.cli() is blank meaning that output
+    # for commands that did execute is lost. Pass each command
+    # as a one item list to device.cli() to allow for commands to fail:
+    else:
+
+        for cmd in cmds:
+
+            check_deadline(dev, deadline)
+
+            command = [cmd]
+            output = run_cmd(command, dev, device)
+
+            if not output:
+                ret_val = False
+                continue
+
+            if not save_output(cmd, dev, log_dir, output):
+                ret_val = False
+                continue
+
+    return ret_val
+
+
+def run_device(args, dev, opt, timeout=None):
+
+    """
+    Connect to a single device, run every command in its command file and
+    save the output of each command. Returns False if anything failed.
+    If timeout is set, no more commands are sent once the device has taken
+    that many seconds and DeviceTimeoutError is raised. The timeout is also
+    passed to the driver, lowering the device's own timeout if needed, so
+    that a connection or command which hangs can't run far past it.
+    """
+
+    if timeout:
+        deadline = time.monotonic() + timeout
+        opt['timeout'] = min(opt.get('timeout', DRIVER_TIMEOUT), timeout)
+    else:
+        deadline = None
+
+    print("Trying {}...".format(dev))
+
+    try:
+
+        cmds = load_cmds(args, opt)
+        if not cmds:
+            return False
+
+        driver = drivers.get_network_driver(opt['os'])
+
+        # If Kwargs doesn't have exactly the keys required (no extras)
+        # driver() will throw an exception
+        opt.pop('os')
+        device = driver(**drivers.get_driver_args(opt))
+
+        # Try to get the transport port number and type for debug messages
+        port = get_port(device)
+        transport = get_transport(device)
+
+        # Connect to the device
+        if not dev_connect(device, opt, port, transport):
+            return False
+
+        # Always close the session, even if a command or saving its output
+        # raises an exception
+        try:
+            ret_val = run_cmds(args, dev, device, cmds, deadline)
+        finally:
+            device.close()
+
+        print("{} done".format(dev))
+
+        return ret_val
+
+    except DeviceTimeoutError:
+        raise
+
+    # Isolate each device, an unexpected error on one device must not stop
+    # the remaining devices from being processed
+    except Exception as e:
+        print("Error processing {}: {}".format(dev, e))
+        return False
+
+
+def run_inventory_pool(args, inventory):
+
+    """
+    Run run_device() for many devices at once using a bounded pool of worker
+    threads. The return value has the same meaning as the sequential loop in
+    main(), False if any device failed or timed out. Each worker closes its
+    own device, a device which runs past --device-timeout stops before its
+    next command and is reported separately from the failed devices.
+    """
+
+    ret_val = True
+    failed = []
+    timed_out = []
+
+    print("Running against {} device(s) using {} workers".
+          format(len(inventory.keys()), args['workers']))
+
+    with ThreadPoolExecutor(max_workers=args['workers']) as pool:
+
+        futures = {}
+        for dev, opt in inventory.items():
+            future = pool.submit(run_device, args, dev, opt,
+                                 args['device_timeout'])
+            futures[future] = dev
+
+        for future, dev in futures.items():
+            try:
+                if not future.result():
+                    failed.append(dev)
+            except DeviceTimeoutError:
+                print("{} timed out after {} seconds".
+                      format(dev, args['device_timeout']))
+                timed_out.append(dev)
+
+    if failed:
+        ret_val = False
+        print("Failed device(s): {}".format(", ".join(sorted(failed))))
+
+    if timed_out:
+        ret_val = False
+        print("Timed out device(s): {}".format(", ".join(sorted(timed_out))))
+
+    return ret_val
+
+
 def save_output(cmd, dev, log_dir, output):
 
     cmd_safe = "".join(x for x in cmd if (x.isalnum() or x in "._- "))
@@ -321,8 +537,8 @@ def save_output(cmd, dev, log_dir, output):
     except Exception as e:
         print("Couldn't save CLI output from {}: {}".format(dev, e))
         return False
-
-    output_log.close()
+    finally:
+        output_log.close()
 
     return True
 
@@ -399,55 +615,13 @@ def main():
         sys.exit(1)
 
     
-    ret_val = True
-    for dev, opt in inventory.items():
-
-        print("Trying {}...".format(dev))
-
-        cmds = load_cmds(args, opt)
-        if not cmds:
-            ret_val = False
-            continue
-
-        driver = napalm.get_network_driver(opt['os'])
-        
-        # If Kwargs doesn't have exactly the keys required (no extras)
-        # driver() will throw an exception
-        opt.pop('os')
-        device = driver(**opt)
-
-        # Try to get the transport port number and type for debug messages
-        port = get_port(device)
-        transport = get_transport(device)
-
-        # Connect to the device
-        if not dev_connect(device, opt, port, transport):
-            ret_val = False
-            continue
-
-        log_dir = args['log_dir']+'/'+dev
-        check_log_path_exists(log_dir)        
-        # The list of commands loaded from the text file and passed to
-        # device.cli() is processed as a single list, if one of the commands
-        # fails to run the remaining commands in the list aren't run. The
-        # output dict returned by device.cli() is blank meaning that output
-        # for commands that did execute is lost. Pass each command
-        # as a one item list to device.cli() to allow for commands to fail:
-        for cmd in cmds:
-
-            command = [cmd]
-            output = run_cmd(command, dev, device)
-
-            if not output:
-                ret_val = False
-                continue
-
-            if not save_output(cmd, dev, log_dir, output):
+    if args['workers'] > 1:
+        ret_val = run_inventory_pool(args, inventory)
+    else:
+        ret_val = True
+        for dev, opt in inventory.items():
+            if not run_device(args, dev, opt):
                 ret_val = False
-                continue
-
-        device.close()
-        print("{} done".format(dev))
 
 
     if ret_val:
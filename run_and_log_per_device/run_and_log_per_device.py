@@ -36,22 +36,19 @@ R2:
 import argparse
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.ssh_exception import NetMikoAuthenticationException
 import os
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
 import sys
-import yaml
+
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
+
+
+# Size of the write buffer for each device's output log
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
 
 def check_cmd_files_exist(args, inventory):
@@ -74,7 +71,7 @@ def check_cmd_files_exist(args, inventory):
     # Check all types of command files exist
     for dev, opt in inventory.items():
 
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             continue
 
         cmd_file = args['cmd_dir']+'/cmd_'+opt['os']+'.txt'
@@ -102,6 +99,18 @@ def check_log_path_exists(log_dir):
         return True
 
 
+def close_output(dev, output_log):
+
+    # Make sure all the buffered output is on disk before closing the log
+    try:
+        output_log.flush()
+        os.fsync(output_log.fileno())
+    except Exception as e:
+        print("Couldn't save CLI output from {}: {}".format(dev, e))
+
+    output_log.close()
+
+
 def get_port(device):
 
     port = "unknown"
@@ -162,32 +171,15 @@ def load_cmds(args, opt):
     return lines
 
 
-def load_inv(filename, dev_os=None):
-
-    try:
-        inventory_file = open(filename)
-    except Exception:
-        print("Couldnt open inventory file {}".format(filename))
-        sys.exit(1)
+def load_inv(filename, selector=None, dev_os=None):
 
-    try:
-        inventory = yaml.load(inventory_file)
-    except Exception as e:
-        print("Couldn't load YAML file {}: {}".format(filename, e))
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # down to the selected devices and type if they are supplied
+    inventory = inventory_cache.load_inv(filename, selector, dev_os)
+    if inventory is False:
         sys.exit(1)
 
-    inventory_file.close()
-
-    # Filter the inventory down to the specified type if one is supplied
-    if dev_os:
-        filtered_inventory = {}
-        for dev, opt in inventory.items():
-            if opt['os'] == dev_os:
-                filtered_inventory[dev] = opt
-    else:
-        filtered_inventory = inventory
-
-    return filtered_inventory
+    return inventory
 
 
 def parse_cli_args():
@@ -221,8 +213,18 @@ def parse_cli_args():
     parser.add_argument(
         '-o', '--os',
         help='Only process devices from the inventory file with the specific '
-             'OS type e.g. ios or junos. This is optional with an inventory '
-             'file but mandatory for a single device when using -t|--target.',
+             'OS type e.g. ios or junos, the same as -s os=<type>. This is '
+             'optional with an inventory file but mandatory for a single '
+             'device when using -t|--target.',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
         type=str,
         default=None,
     )
@@ -266,6 +268,18 @@ def set_dev_opts(args, opt):
     return True
 
 
+def write_output(dev, output_log, cmd, cmd_output):
+
+    try:
+        output_log.write('#'+cmd+'\n')
+        output_log.write(cmd_output+'\n\n')
+    except Exception as e:
+        print("Couldn't save CLI output from {}: {}".format(dev, e))
+        return False
+
+    return True
+
+
 def main():
     
     args = parse_cli_args()
@@ -274,7 +288,8 @@ def main():
 
     # If an inventory file isn't being used, build a single-host-inventory
     if not args['target']:
-        inventory = load_inv(args['inventory_file'], args['os'])
+        inventory = load_inv(args['inventory_file'], args['select'],
+                             args['os'])
     else:
         if not args['os']:
             print("-t option used without -o! Can't configure {}".
@@ -300,14 +315,14 @@ def main():
 
         print("Trying {}...".format(dev))
 
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             print("{} has an unsupported device OS type: {}".format(dev, opt['os']))
             continue
 
         timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
         output_file = args['log_dir']+'/'+dev+'_'+timestamp+'.txt'
         try:
-            output_log = open(output_file, "w")
+            output_log = open(output_file, "w", buffering=OUTPUT_BUFFER_SIZE)
         except Exception as e:
             print("Couldn't open output log file {}: {}".format(output_file, e))
             continue
@@ -319,12 +334,12 @@ def main():
         if not cmds:
             continue
 
-        driver = napalm.get_network_driver(opt['os'])
+        driver = drivers.get_network_driver(opt['os'])
         
         # If Kwargs doesn't have exactly the keys required (no extras)
         # driver() will throw an exception
         opt.pop('os')
-        device = driver(**opt)
+        device = driver(**drivers.get_driver_args(opt))
 
         # Try to get the transport port number and type for debug messages
         port = get_port(device)
@@ -333,12 +348,11 @@ def main():
         # Connect to the device
         try:
            device.open()
-        except (JuniperConnectAuthError, NetMikoAuthenticationException):
+        except drivers.get_auth_errors():
             print("Unable to authenticate to {} as {}".
                   format(opt['hostname'], opt['username']))
             continue
-        except (ConnectionException, JuniperConnectRefusedError, SocketError,
-                SocketTimeout, SSHException):
+        except drivers.get_connect_errors():
             print("Unable to connect to: {} using {} on port {}".
                   format(opt['hostname'], transport, port))
             continue
@@ -347,28 +361,23 @@ def main():
         # device.cli() is processed as a single list, if one of the commands
         # fails to run the remaining commands in the list aren't run. The
         # output cli dict can no longer be saved to a file. Pass each command
-        # as a one item list to device.cli() to allow for commands to fail
-        cli_output = {}
+        # as a one item list to device.cli() to allow for commands to fail.
+        # The output of each command is appended to the log as soon as it
+        # has run, so only one command's output is held in memory and the
+        # output collected so far is kept if the session drops.
         for cmd in cmds:
             command = [cmd]
             try:
                 output = device.cli(command)
-                cli_output[cmd] = output[cmd]
+                cmd_output = output[cmd]
             except Exception as e:
                 print("Couldn't run a command on {}: {}".format(dev, e))
-                cli_output[cmd] = ""
+                cmd_output = ""
 
-        try:
-            # cli_output dict is unordered, use the original command list to
-            # write the command output in the same order the commands where
-            # executed
-            for cmd in cmds:
-                output_log.write('#'+cmd+'\n')
-                output_log.write(cli_output[cmd]+'\n\n')
-        except Exception as e:
-            print("Couldn't save CLI output from {}: {}".format(dev, e))
+            if not write_output(dev, output_log, cmd, cmd_output):
+                break
 
-        output_log.close()
+        close_output(dev, output_log)
         device.close()
 
         print("{} done".format(dev))
@@ -21,24 +21,15 @@ R2:
 import argparse
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-from jnpr.junos.exception import ConnectUnknownHostError as JuniperConnectUnknownHostError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.ssh_exception import NetMikoAuthenticationException
-from netmiko.ssh_exception import NetMikoTimeoutException
 import os
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
 import sys
-import yaml
+
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
 
 
 def all_dev_same_type(inventory):
@@ -99,13 +90,11 @@ def dev_connect(device, opt, port, transport):
 
     try:
        device.open()
-    except (JuniperConnectAuthError, NetMikoAuthenticationException):
+    except drivers.get_auth_errors():
         print("Unable to authenticate to {} as {}".
               format(opt['hostname'], opt['username']))
         return False
-    except (ConnectionException, JuniperConnectRefusedError, 
-            JuniperConnectUnknownHostError, SocketError,
-            SocketTimeout, SSHException):
+    except drivers.get_connect_errors():
         print("Unable to connect to {} using {} on port {}".
               format(opt['hostname'], transport, port))
         return False
@@ -116,17 +105,6 @@ def dev_connect(device, opt, port, transport):
     return True
 
 
-def filter_inv(inventory, os_type):
-
-    # Filter the inventory down to the specified type:
-    filtered_inv = {}
-    for dev, opt in inventory.items():
-        if opt['os'] == os_type:
-            filtered_inv[dev] = opt
-
-    return filtered_inv
-
-
 def get_port(device):
 
     port = "unknown"
@@ -160,33 +138,19 @@ def load_inv(args):
 
     print("Loading inventory {}".format(args['inventory_file']))
 
-    # Load the initial inventory from a YAML file
-    try:
-        inventory_file = open(args['inventory_file'])
-    except Exception as e:
-        print("Couldn't open inventory file {}".format(e))
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # to the devices matching the selector and device OS if specified
+    filtered_inv = inventory_cache.load_inv(args['inventory_file'],
+                                            args['select'], args['os'])
+    if filtered_inv is False:
         sys.exit(1)
 
-    try:
-        raw_inventory = yaml.load(inventory_file)
-    except Exception as e:
-        print("Couldn't load inventory YAML: {}".format(e))
-        sys.exit(1)
-
-    inventory_file.close()
-
-    # Filter the inventory to a specific device OS if specified
-    if args['os']:
-        filtered_inv = filter_inv(raw_inventory, args['os'])
-    else:
-        filtered_inv = raw_inventory
-
     inventory = filtered_inv.copy()
 
     for dev, opt in filtered_inv.items():
 
         # Remove any unsupported OS types from the inventory
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             print("Removing {}, unsupported device OS type: {}".
                   format(dev, opt['os']))
             inventory.pop(dev)
@@ -225,8 +189,9 @@ def parse_cli_args():
     parser.add_argument(
         '-o', '--os',
         help='Only process devices from the inventory file with the specific '
-             'OS type e.g. ios or junos. This is optional with an inventory '
-             'file but mandatory for a single device when using -t|--target.',
+             'OS type e.g. ios or junos, the same as -s os=<type>. This is '
+             'optional with an inventory file but mandatory for a single '
+             'device when using -t|--target.',
         type=str,
         default=None,
     )
@@ -243,6 +208,15 @@ def parse_cli_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--target',
         help='Hostname or IP of target device to configure. When using this '
@@ -312,12 +286,12 @@ def main():
 
         print("Trying {}...".format(dev))
 
-        driver = napalm.get_network_driver(opt['os'])
+        driver = drivers.get_network_driver(opt['os'])
         
         # If Kwargs doesn't have exactly the keys required (no extras)
         # driver() will throw an exception
         opt.pop('os')
-        device = driver(**opt)
+        device = driver(**drivers.get_driver_args(opt))
 
         # Try to get the transport port number and type for debug messages
         port = get_port(device)
@@ -37,25 +37,26 @@ R2:
 
 
 import argparse
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from getpass import getpass
-from jnpr.junos.exception import ConnectAuthError as JuniperConnectAuthError
-from jnpr.junos.exception import ConnectRefusedError as JuniperConnectRefusedError
-import napalm
-from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
-from napalm.base.exceptions import ConnectionException
-from napalm.base.exceptions import LockError
-from napalm.base.exceptions import MergeConfigException
-from napalm.base.exceptions import ReplaceConfigException
-from napalm.base.exceptions import UnlockError
-from netmiko.utilities import get_structured_data
-from netmiko.ssh_exception import NetMikoAuthenticationException
 import os
-from paramiko.ssh_exception import SSHException
-from socket import error as SocketError
-from socket import timeout as SocketTimeout
 import sys
-import yaml
+
+# The shared inventory and driver loaders live in the common directory
+# of this repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import drivers
+import inventory_cache
+import output_writer
+
+
+# The ntc-templates index and the compiled TextFSM template of each
+# (platform, command), loaded once per parser process
+PARSER_INDEX = None
+PARSER_TEMPLATES = {}
 
 
 def check_cmd_files_exist(args, inventory):
@@ -63,7 +64,7 @@ def check_cmd_files_exist(args, inventory):
     # Check all types of command files exist
     for dev, opt in inventory.items():
 
-        if opt['os'] not in SUPPORTED_DRIVERS:
+        if opt['os'] not in drivers.SUPPORTED_DRIVERS:
             continue
 
         cmd_file = args['cmd_dir']+'/cmd_'+opt['os']+'.txt'
@@ -115,6 +116,49 @@ def get_ntc_type(os):
         return False
 
 
+def get_parser_template(platform, cmd):
+
+    """
+    Return the compiled TextFSM template for a command on a platform, from
+    the ntc-templates index. The index is loaded once per process and each
+    template is only compiled once, after which it is kept in
+    PARSER_TEMPLATES. Returns None if there is no template, or False if the
+    command has more than one template, which get_structured_data() parses.
+    """
+
+    global PARSER_INDEX
+
+    if (platform, cmd) in PARSER_TEMPLATES:
+        return PARSER_TEMPLATES[(platform, cmd)]
+
+    # TextFSM is imported here so that it is only loaded once there is
+    # output to parse
+    import textfsm
+    from textfsm import clitable
+
+    if not PARSER_INDEX:
+        from netmiko.utilities import get_template_dir
+        template_dir = get_template_dir()
+        PARSER_INDEX = clitable.CliTable('index', template_dir)
+
+    template = None
+
+    row = PARSER_INDEX.index.GetRowMatch({'Command': cmd,
+                                          'Platform': platform})
+    if row:
+        template_names = PARSER_INDEX.index.index[row]['Template']
+        if ':' in template_names:
+            template = False
+        else:
+            with open(os.path.join(PARSER_INDEX.template_dir,
+                                   template_names)) as template_file:
+                template = textfsm.TextFSM(template_file)
+
+    PARSER_TEMPLATES[(platform, cmd)] = template
+
+    return template
+
+
 def get_port(device):
 
     port = "unknown"
@@ -172,32 +216,54 @@ def load_cmds(args, opt):
     return lines
 
 
-def load_inv(filename, type=None):
+def load_inv(filename, selector=None, type=None):
 
-    try:
-        inventory_file = open(filename)
-    except Exception:
-        print("Couldnt open inventory file {}".format(filename))
+    # Load the inventory from the compiled cache of the YAML file, filtered
+    # down to the selected devices and type if they are supplied
+    inventory = inventory_cache.load_inv(filename, selector, type)
+    if inventory is False:
         sys.exit(1)
 
+    return inventory
+
+
+def parse_output(cmd_output, platform, cmd):
+
+    """
+    Parse the output of a command through its NTC template, this is run in
+    the parser pool. Like get_structured_data() this returns a list of dicts,
+    each dict is the structured form of the commmand output (e.g. one dict
+    per interface when running "show interfaces"), or the raw output if
+    there is no template or nothing was parsed.
+    """
+
+    if not cmd_output:
+        return cmd_output
+
+    # Netmiko is imported here so that it is only loaded once there is
+    # output to parse
+    from netmiko.utilities import get_structured_data
+
     try:
-        inventory = yaml.load(inventory_file)
-    except Exception as e:
-        print("Couldn't load YAML file {}: {}".format(filename, e))
-        sys.exit(1)
+        template = get_parser_template(platform, cmd)
+    except Exception:
+        return get_structured_data(cmd_output, platform=platform, command=cmd)
 
-    inventory_file.close()
+    if template is None:
+        return cmd_output
 
-    # Filter the inventory down to the specified type if one is supplied
-    if type:
-        filtered_inventory = {}
-        for dev, opt in inventory.items():
-            if opt['os'] == type:
-                filtered_inventory[dev] = opt
-    else:
-        filtered_inventory = inventory
+    if template is False:
+        return get_structured_data(cmd_output, platform=platform, command=cmd)
+
+    template.Reset()
+    records = template.ParseText(cmd_output)
+    header = [value.lower() for value in template.header]
 
-    return filtered_inventory
+    structured_output = [dict(zip(header, record)) for record in records]
+    if not structured_output:
+        return cmd_output
+
+    return structured_output
 
 
 def parse_cli_args():
@@ -214,6 +280,14 @@ def parse_cli_args():
         type=str,
         default='./configs',
     )
+    parser.add_argument(
+        '-f', '--format',
+        help='Output file format, one of: {}'.format(
+            ", ".join(sorted(output_writer.OUTPUT_FORMATS.keys()))),
+        type=str,
+        choices=sorted(output_writer.OUTPUT_FORMATS.keys()),
+        default='yaml',
+    )
     parser.add_argument(
         '-i', '--inventory-file',
         help='Input YAML inventory file',
@@ -226,9 +300,27 @@ def parse_cli_args():
         type=str,
         default='./logs',
     )
+    parser.add_argument(
+        '--parse-workers',
+        help='Number of worker processes used to parse command output '
+             'through the NTC templates while the next commands are run. Set '
+             'to 0 to parse the output in the same process.',
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '-s', '--select',
+        help='Only process devices from the inventory file which match this '
+             'selector, a comma separated list of field=value, field=prefix* '
+             'or field~regex terms which must all match e.g. '
+             'os=junos,site=ld4 or hostname=pe*,tags=core.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--type',
-        help='Only process devices with the specific OS type e.g. ios or junos',
+        help='Only process devices with the specific OS type e.g. ios or '
+             'junos, the same as -s os=<type>.',
         type=str,
         default=None,
     )
@@ -263,12 +355,55 @@ def set_dev_opts(args, opt):
     return True
 
 
+def write_parsed(pending, wait=False):
+
+    """
+    Write the parsed output of each command to its device's output log as
+    soon as it is ready, in command order. A device is removed from pending
+    and its output log closed once all of its commands have been parsed,
+    and it has no more commands to run. If wait is True wait for every
+    command to finish parsing.
+    """
+
+    for entry in list(pending):
+
+        results = entry['results']
+
+        while entry['written'] < len(results):
+
+            cmd, result = results[entry['written']]
+
+            if isinstance(result, Future):
+                if (not wait) and (not result.done()):
+                    break
+                try:
+                    result = result.result()
+                except Exception as e:
+                    print("Couldn't parse output of {} from {}: {}".
+                          format(cmd, entry['dev'], e))
+                    result = None
+
+            output_writer.output_write(entry['output_log'], cmd, result)
+
+            # Don't keep the output once it has been written
+            results[entry['written']] = (cmd, None)
+            entry['written'] += 1
+
+        if (entry['done']) and (entry['written'] == len(results)):
+            output_writer.output_close(entry['output_log'])
+            pending.remove(entry)
+            print("{} done".format(entry['dev']))
+
+
 def main():
     
     args = parse_cli_args()
     args['password'] = getpass("Default password:")
     
-    inventory = load_inv(args['inventory_file'], args['type'])
+    inventory = load_inv(args['inventory_file'], args['select'], args['type'])
+
+    if not output_writer.check_format(args['format']):
+        sys.exit(1)
 
     if not check_files_path_exists(args['cmd_dir']):
         sys.exit(1)
@@ -279,101 +414,125 @@ def main():
     if not check_log_path_exists(args['log_dir']):
         sys.exit(1)
 
+    if args['parse_workers'] > 0:
+        parser_pool = ProcessPoolExecutor(max_workers=args['parse_workers'])
+    else:
+        parser_pool = None
 
-    for dev, opt in inventory.items():
-
-        print("Trying {}...".format(dev))
-
-        if opt['os'] not in SUPPORTED_DRIVERS:
-            print("{} has an unsupported device OS type: {}".format(dev, opt['os']))
-            continue
+    # Devices whose output is still being parsed
+    pending = []
 
-        timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
-        output_file = args['log_dir']+'/'+dev+'_'+timestamp+'.yml'
-        try:
-            output_log = open(output_file, 'w')
-        except Exception:
-            print("Couldn't open output log file {}".format(output_log))
-            continue
+    # Always write out the output already collected, even if a device
+    # causes an unexpected error
+    try:
 
-        if not set_dev_opts(args, opt):
-            continue
+        for dev, opt in inventory.items():
 
-        cmds = load_cmds(args, opt)
-        if not cmds:
-            continue
+            print("Trying {}...".format(dev))
 
-        device_type = get_ntc_type(opt['os'])
-        #if not device_type:
-        #    continue
+            if opt['os'] not in drivers.SUPPORTED_DRIVERS:
+                print("{} has an unsupported device OS type: {}".format(dev, opt['os']))
+                continue
 
-        driver = napalm.get_network_driver(opt['os'])
-        
-        # If Kwargs doesn't have exactly the keys required (no extras)
-        # driver() will throw an exception
-        opt.pop('os')
-        device = driver(**opt)
+            timestamp = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
+            output_file = args['log_dir']+'/'+dev+'_'+timestamp
+            output_log = output_writer.output_open(output_file, args['format'])
+            if not output_log:
+                continue
 
-        # Try to get the transport port number and type for debug messages
-        port = get_port(device)
-        transport = get_transport(device)
+            if not set_dev_opts(args, opt):
+                output_writer.output_close(output_log)
+                continue
 
-        # Connect to the device
-        try:
-           device.open()
-        except (JuniperConnectAuthError, NetMikoAuthenticationException):
-            print("Unable to authenticate to {} as {}".
-                  format(opt['hostname'], opt['username']))
-            continue
-        except (ConnectionException, JuniperConnectRefusedError, SocketError,
-                SocketTimeout, SSHException):
-            print("Unable to connect to: {} using {} on port {}".
-                  format(opt['hostname'], transport, port))
-            continue
+            cmds = load_cmds(args, opt)
+            if not cmds:
+                output_writer.output_close(output_log)
+                continue
 
-        # cli() returns a dict, the key is the cli command and the value is
-        # the raw output
-        ##cli_output = device.cli(cmds)
-        #
-        # If there is a command that is not like any other command, e.g.
-        # "foo-bar" - this will fail to execute and the CLI output will
-        # contain an error string like "Unknown command" from Junos or
-        # "invalid command" from IOS. If the command is similar to a real
-        # command, e.g. "show foo-bar", an IOS device / Netmiko will
-        # throw and exception and no output for any of the commands that
-        # did successfully execute are returned.
-        # For this reason we need loop over othe command list and build
-        # the output dict manually:
-        cli_output = {}
-        for cmd in cmds:
-            try:
-                raw_output = device.cli([cmd])
-                cli_output[cmd] = raw_output[cmd]
-            except Exception as e:
-                print("Coudn't execute CLI commands: {}".format(e))
-                cli_output[cmd] = None
+            device_type = get_ntc_type(opt['os'])
+            #if not device_type:
+            #    continue
 
-        dev_structured_output = {}
+            driver = drivers.get_network_driver(opt['os'])
         
-        for cmd in cmds:
-            cmd_output = cli_output[cmd]
-            # get_structured_data() returns a list of dicts, each dict is
-            # the structured form of the commmand output (e.g. one dict
-            # per interface when running "show interfaces")
-            structured_output = get_structured_data(cmd_output, platform=device_type, command=cmd)
-            dev_structured_output[cmd] = structured_output
+            # If Kwargs doesn't have exactly the keys required (no extras)
+            # driver() will throw an exception
+            opt.pop('os')
+            device = driver(**drivers.get_driver_args(opt))
 
+            # Try to get the transport port number and type for debug messages
+            port = get_port(device)
+            transport = get_transport(device)
 
-        try:
-            yaml.dump(dev_structured_output, output_log, default_flow_style=False)
-        except Exception:
-            print("Couldn't serialise CLI output to YAML")
-            #continue
-
-        output_log.close()
-        device.close()
-
-        print("{} done".format(dev))
+            # Connect to the device
+            try:
+               device.open()
+            except drivers.get_auth_errors():
+                print("Unable to authenticate to {} as {}".
+                      format(opt['hostname'], opt['username']))
+                output_writer.output_close(output_log)
+                continue
+            except drivers.get_connect_errors():
+                print("Unable to connect to: {} using {} on port {}".
+                      format(opt['hostname'], transport, port))
+                output_writer.output_close(output_log)
+                continue
+            except ValueError as e:
+                print("Unable to connect to {}: {}".format(opt['hostname'], e))
+                output_writer.output_close(output_log)
+                continue
+
+            # cli() returns a dict, the key is the cli command and the value is
+            # the raw output
+            ##cli_output = device.cli(cmds)
+            #
+            # If there is a command that is not like any other command, e.g.
+            # "foo-bar" - this will fail to execute and the CLI output will
+            # contain an error string like "Unknown command" from Junos or
+            # "invalid command" from IOS. If the command is similar to a real
+            # command, e.g. "show foo-bar", an IOS device / Netmiko will
+            # throw and exception and no output for any of the commands that
+            # did successfully execute are returned.
+            # For this reason we need loop over othe command list and build
+            # the output dict manually. The output of each command is sent to
+            # the parser pool as soon as the command has run, so parsing
+            # overlaps with collecting the next command and the next device.
+            entry = {
+                'dev': dev,
+                'done': False,
+                'output_log': output_log,
+                'results': [],
+                'written': 0,
+            }
+            pending.append(entry)
+
+            for cmd in cmds:
+                try:
+                    raw_output = device.cli([cmd])
+                    cmd_output = raw_output[cmd]
+                except Exception as e:
+                    print("Coudn't execute CLI commands: {}".format(e))
+                    cmd_output = None
+
+                if parser_pool:
+                    result = parser_pool.submit(parse_output, cmd_output,
+                                                device_type, cmd)
+                else:
+                    result = parse_output(cmd_output, device_type, cmd)
+
+                entry['results'].append((cmd, result))
+                write_parsed(pending)
+
+            device.close()
+
+            entry['done'] = True
+            write_parsed(pending)
+
+    finally:
+        write_parsed(pending, wait=True)
+
+        if parser_pool:
+            parser_pool.shutdown()
 
     return
 
@@ -0,0 +1,740 @@
+#!/usr/bin/python3
+
+"""
+Run one of the scripts in this repo against a fleet of simulated devices
+instead of real ones, to load test it and measure its throughput.
+
+./simulator.py -n 5000 ../run_and_log_per_cmd/run_and_log_per_cmd.py -c ../run_and_log_per_cmd/commands/ -w 50
+
+The NAPALM ios and junos drivers are replaced by a simulated device which
+answers with canned output from the logs checked in to this repo, after a
+configurable delay. A share of the devices can be made to refuse the
+connection, time out or fail commands. The same --seed fails the same
+devices every run.
+
+When the script is run without -i|--inventory-file an inventory of -n
+simulated devices is written to --fleet-file and passed to it. When the
+script exits the throughput and the latency of each operation is printed.
+"""
+
+
+import argparse
+from datetime import datetime
+import json
+import os
+import random
+import runpy
+import socket
+import sys
+import threading
+import time
+import yaml
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Canned command output for each device type, one file per command named
+# as run_and_log_per_cmd.py saves them
+CLI_LOGS = {
+    'ios': [
+        'run_and_log_per_cmd/logs/R3-IOSXE',
+        'diff_per_cmd_output/logs/before/R3-IOSXE',
+    ],
+    'junos': [
+        'run_and_log_per_cmd/logs/R2-Junos',
+        'diff_per_cmd_output/logs/before/R2-Junos',
+    ],
+}
+
+# Canned getter output for each device type, as saved by napalm_getters.py
+GETTER_LOGS = {
+    'ios': 'napalm_getters/logs/agn0.upo01_2018-11-07--11-36-31.yml',
+    'junos': 'napalm_getters/logs/mx960_2018-11-07--11-35-41.yml',
+}
+
+# Output for a command which has no canned output
+UNKNOWN_CMD = {
+    'ios': "% Invalid input detected at '^' marker.\n",
+    'junos': "error: syntax error\n",
+}
+
+CANNED = {}
+CANNED_LOCK = threading.Lock()
+
+# The running config, commit history and rollback file of each device, which
+# change when config is committed, kept across reconnects
+DEVICE_STATE = {}
+DEVICE_STATE_LOCK = threading.Lock()
+
+# Set from the CLI args by main()
+FLEET = {}
+
+STATS = {
+    'devices': {},
+    'errors': 0,
+    'ops': {},
+}
+STATS_LOCK = threading.Lock()
+
+
+class CommandError(Exception):
+
+    """
+    Raised by a simulated device for the commands and getters which fail.
+    """
+
+
+class SimulatedConfig(object):
+
+    """
+    Stands in for the PyEZ Config utility of the Junos driver, which the
+    scripts use as device.device.cu.
+    """
+
+    def __init__(self, device):
+        self.sim = device
+
+    def commit_check(self):
+        return self.sim.rpc('commit_check', FLEET['latency'], lambda: True)
+
+    def rollback(self, rb_id=0):
+        return self.sim.rpc('rollback', FLEET['latency'], lambda: True)
+
+
+class SimulatedDevice(object):
+
+    """
+    A simulated device with the methods of a NAPALM driver which the scripts
+    in this repo use. Every call waits for the configured latency, and the
+    device decides if it fails from its own random number generator, seeded
+    by --seed and its hostname, so each device fails the same way every run.
+    """
+
+    def __init__(self, hostname, username=None, password=None, timeout=60,
+                 optional_args=None, os_type='ios'):
+        self.hostname = hostname
+        self.os_type = os_type
+        self.timeout = timeout
+        self.port = 22
+        self.transport = 'ssh'
+        self.candidate = None
+        self.is_open = False
+        self.random = random.Random("{}:{}".format(FLEET['seed'], hostname))
+        self.device = self
+        self.cu = SimulatedConfig(self)
+
+    def __getattr__(self, name):
+        # Any NAPALM getter without canned output returns an empty result
+        if name.startswith('get_'):
+            return lambda *args, **kwargs: self.rpc(name, FLEET['latency'],
+                                                    lambda: {})
+        raise AttributeError(name)
+
+    def _file_prompt_quiet(self):
+        # Called by rollback.py before "configure replace" on IOS
+        self.check_open()
+
+    def check_open(self):
+        if not self.is_open:
+            raise CommandError("{} is not connected".format(self.hostname))
+
+    def cli(self, commands, encoding='text'):
+        self.check_open()
+        output = {}
+        for cmd in commands:
+            output[cmd] = self.rpc('cli', FLEET['latency'],
+                                   lambda: get_cli_output(self.os_type, cmd,
+                                                          self.hostname))
+        return output
+
+    def close(self):
+        self.is_open = False
+
+    def commit_config(self, message='', revert_in=None):
+        self.check_open()
+        self.rpc('commit_config', FLEET['commit_latency'], lambda: None)
+        commit_state(self.hostname, self.candidate)
+        self.candidate = None
+
+    def compare_config(self):
+        self.check_open()
+        return self.rpc('compare_config', FLEET['latency'],
+                        lambda: get_diff(self.candidate))
+
+    def discard_config(self):
+        self.check_open()
+        self.rpc('discard_config', FLEET['latency'], lambda: None)
+        self.candidate = None
+
+    def get_config(self, retrieve='all', full=False, sanitized=False):
+        self.check_open()
+        state = get_state(self.hostname)
+        return self.rpc('get_config', FLEET['latency'], lambda: {
+            'candidate': "",
+            'running': "\n".join(state['config']) + "\n",
+            'startup': "",
+        })
+
+    def is_alive(self):
+        return {'is_alive': self.is_open}
+
+    def load_merge_candidate(self, filename=None, config=None):
+        self.check_open()
+        self.rpc('load_merge_candidate', FLEET['latency'], lambda: None)
+        self.candidate = load_candidate(filename, config)
+
+    def load_replace_candidate(self, filename=None, config=None):
+        self.check_open()
+        self.rpc('load_replace_candidate', FLEET['latency'], lambda: None)
+        self.candidate = load_candidate(filename, config)
+
+    def open(self):
+        start = time.perf_counter()
+        draw = self.random.random()
+
+        if draw < FLEET['failure_rate']:
+            wait(FLEET['connect_latency'], self.random)
+            record_device(self.hostname, 'refused', start)
+            raise ConnectionRefusedError(
+                "Connection refused by {}".format(self.hostname)
+            )
+
+        if draw < FLEET['failure_rate'] + FLEET['timeout_rate']:
+            time.sleep(min(self.timeout, FLEET['timeout_delay']))
+            record_device(self.hostname, 'timeout', start)
+            raise socket.timeout("Timed out connecting to {}".
+                                 format(self.hostname))
+
+        wait(FLEET['connect_latency'], self.random)
+        self.is_open = True
+        record_device(self.hostname, 'connected', start)
+        record_op('open', time.perf_counter() - start)
+
+    def rollback(self):
+        self.check_open()
+        self.rpc('rollback', FLEET['commit_latency'], lambda: None)
+        if not rollback_state(self.hostname, self.os_type):
+            raise CommandError("{} has no config to roll back to".
+                               format(self.hostname))
+
+    def rpc(self, name, latency, result):
+
+        """
+        Wait for the latency of one round trip to the device and return the
+        result, or raise CommandError for the share of calls which fail.
+        """
+
+        start = time.perf_counter()
+        wait(latency, self.random)
+        failed = self.random.random() < FLEET['error_rate']
+        record_op(name, time.perf_counter() - start, failed)
+
+        if failed:
+            raise CommandError("Simulated {} error on {}".
+                               format(name, self.hostname))
+
+        return result()
+
+
+def build_fleet(filename, devices, os_types):
+
+    """
+    Write an inventory of simulated devices, cycling through os_types.
+    Returns False if the file can't be written.
+    """
+
+    width = len(str(devices))
+
+    try:
+        with open(filename, 'w') as fleet_file:
+            for i in range(devices):
+                dev = "sim-{:0{}d}".format(i + 1, width)
+                fleet_file.write("{}:\n".format(dev))
+                fleet_file.write("  hostname: {}.sim\n".format(dev))
+                fleet_file.write("  os: {}\n".format(os_types[i % len(os_types)]))
+                fleet_file.write("  password: simulated\n")
+                fleet_file.write("  username: simulated\n")
+    except Exception as e:
+        print("Couldn't write fleet inventory {}: {}".format(filename, e))
+        return False
+
+    print("Wrote {} simulated device(s) to {}".format(devices, filename))
+
+    return True
+
+
+def commit_state(hostname, candidate):
+
+    """
+    Add the candidate config to the running config of a device, saving the
+    old running config as the NAPALM IOS driver (in its rollback file) and
+    Junos (as rollback 1) do.
+    """
+
+    state = get_state(hostname)
+    now = datetime.now()
+
+    with DEVICE_STATE_LOCK:
+        state['rollback_file'] = {
+            'config': list(state['config']),
+            'date': now.strftime('%b %d %Y %H:%M:%S +00:00'),
+            'size': len("\n".join(state['config'])) + 1,
+        }
+        state['commits'].insert(0, now.strftime('%Y-%m-%d %H:%M:%S UTC'))
+        state['history'].insert(0, list(state['config']))
+        state['config'].extend(line for line in (candidate or "").splitlines()
+                               if line.strip())
+
+
+def get_canned(os_type):
+
+    """
+    Load the canned command and getter output of a device type the first
+    time a device of that type needs it.
+    """
+
+    with CANNED_LOCK:
+        if os_type in CANNED:
+            return CANNED[os_type]
+
+        canned = {'cli': {}, 'getters': {}}
+
+        for log_dir in CLI_LOGS.get(os_type, []):
+            log_dir = os.path.join(REPO_DIR, log_dir)
+            for log_file in sorted(os.listdir(log_dir)):
+                with open(os.path.join(log_dir, log_file)) as output:
+                    canned['cli'].setdefault(os.path.splitext(log_file)[0],
+                                             output.read())
+
+        if os_type in GETTER_LOGS:
+            with open(os.path.join(REPO_DIR, GETTER_LOGS[os_type])) as getters:
+                canned['getters'] = yaml.load(
+                    getters, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+                ) or {}
+
+        CANNED[os_type] = canned
+
+        return canned
+
+
+def get_cli_output(os_type, cmd, hostname=None):
+
+    # The output of these commands depends on the config committed so far
+    if hostname and cmd == "dir flash:rollback_config.txt":
+        rollback_file = get_state(hostname)['rollback_file']
+        if not rollback_file:
+            return ("%Error opening flash:/rollback_config.txt "
+                    "(No such file or directory)\n")
+        return ("Directory of flash:/rollback_config.txt\n\n"
+                "   12  -rw-  {}  {}  rollback_config.txt\n".
+                format(rollback_file['size'], rollback_file['date']))
+
+    if hostname and cmd == "configure replace flash:rollback_config.txt force":
+        if not replace_state(hostname):
+            return ("%Error opening flash:rollback_config.txt "
+                    "(No such file or directory)\n")
+        return "Total number of passes: 1\nRollback Done\n"
+
+    if hostname and cmd == "show system commit":
+        return "".join("{}   {} by simulated via netconf\n".format(num, commit)
+                       for num, commit in
+                       enumerate(get_state(hostname)['commits']))
+
+    # The log files are named after the command with the same characters
+    # removed as run_and_log_per_cmd.py removes
+    cmd_safe = "".join(x for x in cmd if (x.isalnum() or x in "._- "))
+
+    return get_canned(os_type)['cli'].get(cmd_safe,
+                                          UNKNOWN_CMD.get(os_type, ""))
+
+
+def get_diff(candidate):
+
+    if not candidate:
+        return ""
+
+    return "\n".join("+ " + line for line in candidate.splitlines()
+                     if line.strip())
+
+
+def get_percentile(values, percent):
+
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+
+    return values[index]
+
+
+def get_report(elapsed):
+
+    """
+    Return the throughput of the simulated fleet and the latency of each
+    operation as a dict.
+    """
+
+    with STATS_LOCK:
+        devices = dict(STATS['devices'])
+        ops = {name: sorted(times) for name, times in STATS['ops'].items()}
+        errors = STATS['errors']
+
+    results = {}
+    for dev, result in devices.items():
+        results[result['result']] = results.get(result['result'], 0) + 1
+
+    report = {
+        'devices': len(devices),
+        'devices_per_second': len(devices) / elapsed if elapsed else 0,
+        'elapsed': elapsed,
+        'errors': errors,
+        'ops': {},
+        'results': results,
+    }
+
+    for name, times in ops.items():
+        report['ops'][name] = {
+            'calls': len(times),
+            'max': times[-1],
+            'mean': sum(times) / len(times),
+            'p50': get_percentile(times, 50),
+            'p95': get_percentile(times, 95),
+            'p99': get_percentile(times, 99),
+            'per_second': len(times) / elapsed if elapsed else 0,
+        }
+
+    return report
+
+
+def get_simulated_driver(os_type):
+
+    if os_type not in GETTER_LOGS:
+        raise ValueError("The simulator doesn't support OS type {}".
+                         format(os_type))
+
+    def driver(**kwargs):
+        device = SimulatedDevice(os_type=os_type, **kwargs)
+        # The getters with canned output return it after the usual latency
+        for name, output in get_canned(os_type)['getters'].items():
+            setattr(device, name, get_simulated_getter(device, name, output))
+        return device
+
+    return driver
+
+
+def get_simulated_getter(device, name, output):
+
+    def getter(*args, **kwargs):
+        return device.rpc(name, FLEET['latency'], lambda: output)
+
+    return getter
+
+
+def get_state(hostname):
+
+    with DEVICE_STATE_LOCK:
+        # history holds the config of each earlier commit, history[0] is
+        # what Junos calls rollback 1
+        return DEVICE_STATE.setdefault(hostname, {
+            'commits': ["2018-11-07 11:35:41 UTC"],
+            'config': ["hostname {}".format(hostname)],
+            'history': [],
+            'rollback_file': None,
+        })
+
+
+def load_candidate(filename, config):
+
+    if config is not None:
+        return config
+
+    with open(filename) as candidate:
+        return candidate.read()
+
+
+def parse_cli_args():
+
+    parser = argparse.ArgumentParser(
+        description='Run a script from this repo against a fleet of '
+                    'simulated devices and report its throughput and latency.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--commit-latency',
+        help='Seconds a config commit or rollback takes.',
+        type=float,
+        default=2.0,
+    )
+    parser.add_argument(
+        '--connect-latency',
+        help='Seconds it takes to connect and log in to a device.',
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        '-e', '--error-rate',
+        help='Share of commands, getters and config operations which fail, '
+             'from 0 to 1.',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '-f', '--fleet-file',
+        help='File the simulated device inventory is written to, when the '
+             'script is run without -i|--inventory-file.',
+        type=str,
+        default='./fleet.yml',
+    )
+    parser.add_argument(
+        '--failure-rate',
+        help='Share of devices which refuse the connection, from 0 to 1.',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '-j', '--jitter',
+        help='Random variation of each latency, as a share of the latency '
+             'e.g. 0.2 is +/- 20%%.',
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        '-l', '--latency',
+        help='Seconds each command, getter or config operation takes.',
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        '-n', '--devices',
+        help='Number of simulated devices in the fleet inventory.',
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='Also save the report to this file (JSON).',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '--os',
+        help='Device types in the fleet inventory, the devices cycle through '
+             'them.',
+        nargs='+',
+        choices=sorted(GETTER_LOGS),
+        default=sorted(GETTER_LOGS),
+    )
+    parser.add_argument(
+        '--seed',
+        help='Seed for the random latency and failures, the same seed fails '
+             'the same devices every run.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--timeout-delay',
+        help='Seconds a device which times out hangs for before the '
+             'connection fails, at most the timeout of the device.',
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        '--timeout-rate',
+        help='Share of devices which time out when connecting, from 0 to 1.',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        'script',
+        help='Script to run e.g. ../apply_config/apply_config.py',
+        type=str,
+    )
+    parser.add_argument(
+        'script_args',
+        help='Arguments for the script.',
+        nargs=argparse.REMAINDER,
+    )
+
+    return vars(parser.parse_args())
+
+
+def print_report(report):
+
+    print("\nSimulated {} device(s) in {:.2f}s, {:.1f} device(s)/s".
+          format(report['devices'], report['elapsed'],
+                 report['devices_per_second']))
+    print("Connected {}, refused {}, timed out {}, {} failed operation(s)".
+          format(report['results'].get('connected', 0),
+                 report['results'].get('refused', 0),
+                 report['results'].get('timeout', 0),
+                 report['errors']))
+
+    if not report['ops']:
+        return
+
+    print("\n{:<24} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8}".
+          format("Operation", "Calls", "Per sec", "Mean", "p50", "p95", "p99",
+                 "Max"))
+
+    for name, op in sorted(report['ops'].items()):
+        print("{:<24} {:>8} {:>9.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} "
+              "{:>8.3f}".format(name, op['calls'], op['per_second'],
+                                op['mean'], op['p50'], op['p95'], op['p99'],
+                                op['max']))
+
+
+def record_device(hostname, result, start):
+
+    with STATS_LOCK:
+        STATS['devices'][hostname] = {
+            'result': result,
+            'time': time.perf_counter() - start,
+        }
+
+
+def record_op(name, elapsed, failed=False):
+
+    with STATS_LOCK:
+        STATS['ops'].setdefault(name, []).append(elapsed)
+        if failed:
+            STATS['errors'] += 1
+
+
+def replace_state(hostname):
+
+    """
+    Replace the running config of a device with its rollback file, as
+    "configure replace" does on IOS. The rollback file itself is kept.
+    Returns False if the device has no rollback file.
+    """
+
+    state = get_state(hostname)
+
+    with DEVICE_STATE_LOCK:
+        if not state['rollback_file']:
+            return False
+        state['config'][:] = state['rollback_file']['config']
+
+    return True
+
+
+def rollback_state(hostname, os_type):
+
+    """
+    Roll the running config of a device back as NAPALM's rollback() does:
+    on IOS the rollback file replaces the running config, on Junos
+    "rollback 1" is committed, which adds a new commit. Returns False if
+    there is nothing to roll back to.
+    """
+
+    if os_type == 'ios':
+        return replace_state(hostname)
+
+    state = get_state(hostname)
+    now = datetime.now()
+
+    with DEVICE_STATE_LOCK:
+        if not state['history']:
+            return False
+        previous = state['history'][0]
+        state['history'].insert(0, list(state['config']))
+        state['config'][:] = previous
+        state['commits'].insert(0, now.strftime('%Y-%m-%d %H:%M:%S UTC'))
+
+    return True
+
+
+def run_script(script, script_args):
+
+    """
+    Run the script in this process with the NAPALM drivers replaced by the
+    simulated devices. Returns the exit code of the script.
+    """
+
+    # Load the drivers module the script will import and swap the NAPALM
+    # drivers for the simulated devices
+    sys.path.insert(0, os.path.join(REPO_DIR, 'common'))
+    import drivers
+    drivers.get_network_driver = get_simulated_driver
+
+    sys.argv = [script] + script_args
+    sys.path[0] = os.path.dirname(script)
+
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code)
+        return 1
+
+    return 0
+
+
+def save_report(report, filename):
+
+    try:
+        with open(filename, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    except Exception as e:
+        print("Couldn't save the report to {}: {}".format(filename, e))
+        return False
+
+    print("\nSaved the report to {}".format(filename))
+
+    return True
+
+
+def wait(latency, rng):
+
+    if latency <= 0:
+        return
+
+    jitter = latency * FLEET['jitter']
+    time.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+
+
+def main():
+
+    args = parse_cli_args()
+
+    for rate in ['error_rate', 'failure_rate', 'timeout_rate']:
+        if not 0 <= args[rate] <= 1:
+            print("--{} must be between 0 and 1".format(rate.replace('_', '-')))
+            sys.exit(1)
+
+    FLEET.update(args)
+
+    script = os.path.abspath(args['script'])
+    if not os.path.isfile(script):
+        print("Script doesn't exist: {}".format(script))
+        sys.exit(1)
+
+    script_args = args['script_args']
+    if not any(arg in ('-i', '--inventory-file') or
+               arg.startswith('--inventory-file=') for arg in script_args):
+        if not build_fleet(args['fleet_file'], args['devices'], args['os']):
+            sys.exit(1)
+        script_args = ['-i', args['fleet_file']] + script_args
+
+    start = time.perf_counter()
+    ret_val = run_script(script, script_args)
+    report = get_report(time.perf_counter() - start)
+
+    report['created'] = datetime.now().isoformat()
+    report['exit_code'] = ret_val
+    report['script'] = args['script']
+    report['settings'] = {
+        name: args[name] for name in ['commit_latency', 'connect_latency',
+                                      'error_rate', 'failure_rate', 'jitter',
+                                      'latency', 'seed', 'timeout_delay',
+                                      'timeout_rate']
+    }
+
+    print_report(report)
+
+    if args['output']:
+        save_report(report, args['output'])
+
+    return ret_val
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,263 @@
 #!/usr/bin/python3
 
 """
-Perform a syntax check against a specified config file.
+Perform a syntax check against a specified config file, or every config file
+in a list of files and directories.
 """
 
 import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import io
+import json
 import os
 import re
 import socket
 import sys
+import tempfile
 
 
-def check_file_exists(cfg_file):
+CACHE_FILE = os.path.expanduser("~/.cache/syntax_check.json")
+CACHE_SIZE = 10000
 
-    if not os.path.isfile(cfg_file):
-        print("Host config file {} doesn't exist".format(cfg_file))
-        sys.exit(1)
 
+def compile_rules(rules):
 
-def check_ios_bd(cfg_line):
+    """
+    Compile a list of (name, pattern) rules into two regexes. The first is a
+    plain alternation of every rule, one search of a line with it finds if
+    any rule matches. The second is anchored to the start of the line and
+    has a lookahead per rule which searches the whole line. Its alternatives
+    are tried in list order so the first rule in the list which matches the
+    line wins, the same as an if/elif chain of re.search() calls. The name
+    of the rule which matched is the lastgroup of the match.
+    """
 
-    bd = cfg_line.split()[1] # "100"
+    any_rule = re.compile(
+        "|".join([pattern for name, pattern in rules])
+    )
+    first_rule = re.compile(
+        "^(?:" +
+        "|".join(["(?=.*?(?P<{}>{}))".format(name, pattern)
+                  for name, pattern in rules]) +
+        ")"
+    )
+
+    return any_rule, first_rule
+
+
+def get_rules_version():
+
+    """
+    Any change to the rules or checks in this script must invalidate the
+    cached results, so the rules version is a hash of this script.
+    """
+
+    try:
+        with open(os.path.realpath(__file__), 'rb') as script:
+            return hashlib.sha256(script.read()).hexdigest()[:16]
+    except Exception:
+        return None
+
+
+# Config line rules in priority order
+IOS_RULES = compile_rules([
+    ('bd', r"bridge- "),
+    ('bgp_neigh_addr', r"nei "),
+    ('int_desc', r" des"),
+    ('ipv4_address', r"ip addr"),
+    ('ipv4_helper', r"ip help"),
+    ('ipv6_address', r"ipv6 addr"),
+    ('isis_net', r" net "),
+    ('rid', r"router-id"),
+    ('vrf_rd', r"rd [1-9]"),
+    ('vrf_rt', r"route-target (?:ex|im|bo)"),
+])
+JUNOS_RULES = compile_rules([
+    ('bd_vlan_id', r"set bridge-domains .* vlan-id "),
+    ('int_desc', r"set interfaces .* des"),
+    ('int_vlan_id',
+     r"set interfaces [a-z]+-?[0-9](?:/?[0-9]?)+ unit [0-9]+ vlan-id "),
+    ('ipv4_address',
+     r"set interfaces [a-z]+-?[0-9](?:/?[0-9]?)+ unit [0-9]+ "
+     r"family inet address "),
+    ('ipv6_address',
+     r"set interfaces [a-z]+-?[0-9](?:/?[0-9]?)+ unit [0-9]+ "
+     r"family inet6 address "),
+])
+
+RULES_VERSION = get_rules_version()
+
+INT_DESC = re.compile(r"(.*\|){6}")
+ISIS_NSAP = re.compile(
+    r"49\.[0-9][0-9][0-9][0-9]\.[0-9][0-9][0-9][0-9]\.[0-9][0-9][0-9][0-9]\."
+    r"[0-9][0-9][0-9][0-9]\.(00$|0000$)"
+)
+
+
+def check_config_file(cfg_filename, dev_type):
+
+    """
+    Syntax check a single config file for the given device type.
+    Returns True if the config passed all checks.
+    """
+
+    if not os.path.isfile(cfg_filename):
+        print("Host config file {} doesn't exist".format(cfg_filename))
+        return False
+
+    print("Syntax checking: {}".format(cfg_filename))
+
+    try:
+        cfg_file = open(cfg_filename)
+    except Exception as e:
+        print("Couldn't open config file {}: {}".format(cfg_filename, e))
+        return False
+
+    try:
+        config = cfg_file.readlines()
+    except Exception as e:
+        print("Couldn't load config file {}: {}".format(cfg_filename, e))
+        cfg_file.close()
+        return False
+
+    cfg_file.close()
+
+    if dev_type == "ios":
+        passed = validate_ios_config(config)
+
+    elif dev_type == 'junos':
+        passed = validate_junos_config(config)
+
+    else:
+        print("Unsupported device type: {}".format(dev_type))
+        return False
+
+    if passed:
+        print("Config passed without issue")
+    else:
+        print("Config file failed checks")
+
+    return passed
+
+
+def check_config_files(config_files, workers=1, cache_file=None,
+                       cache_size=CACHE_SIZE):
+
+    """
+    Syntax check a list of (cfg_filename, dev_type) tuples in this process,
+    or across a pool of worker processes. The messages from each check are
+    printed in the order of the list. Returns a list of per-file results,
+    dicts with the keys config_file, type, passed, messages and cached.
+
+    If a cache file is given, files with the same content and device type as
+    a file checked by a previous run, with the same version of this script,
+    return the previous result without being checked again. The cache keeps
+    the cache_size most recently used results.
+    """
+
+    if cache_file:
+        cache = load_cache(cache_file)
+    else:
+        cache = None
+
+    outputs = [None] * len(config_files)
+    cache_keys = [None] * len(config_files)
+    unchecked = []
+
+    for index, (cfg_filename, dev_type) in enumerate(config_files):
+
+        if cache is not None:
+            cache_keys[index] = get_cache_key(cfg_filename, dev_type)
+
+        cache_key = cache_keys[index]
+        if cache_key and cache_key in cache:
+            cache.move_to_end(cache_key)
+            entry = cache[cache_key]
+            # The file name isn't part of the key, re-add it to the messages
+            outputs[index] = (
+                entry['passed'],
+                ["Syntax checking: {}".format(cfg_filename)] +
+                entry['messages'],
+            )
+        else:
+            unchecked.append(index)
+
+    if (workers > 1) and (len(unchecked) > 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for index in unchecked:
+                cfg_filename, dev_type = config_files[index]
+                futures[index] = executor.submit(check_config_worker,
+                                                 cfg_filename, dev_type)
+            for index, future in futures.items():
+                try:
+                    outputs[index] = future.result()
+                except Exception as e:
+                    outputs[index] = (False, ["Unable to check syntax: {}".
+                                              format(e)])
+                    cache_keys[index] = None
+    else:
+        for index in unchecked:
+            cfg_filename, dev_type = config_files[index]
+            outputs[index] = check_config_worker(cfg_filename, dev_type)
+
+    results = []
+
+    for index, (cfg_filename, dev_type) in enumerate(config_files):
+
+        passed, messages = outputs[index]
+
+        for message in messages:
+            print(message)
+
+        if (cache_keys[index]) and (index in unchecked) and (messages):
+            cache[cache_keys[index]] = {
+                'messages': messages[1:],
+                'passed': passed,
+            }
+
+        results.append({
+            'cached': index not in unchecked,
+            'config_file': cfg_filename,
+            'messages': messages,
+            'passed': passed,
+            'type': dev_type,
+        })
+
+    if cache is not None:
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+        save_cache(cache_file, cache)
+
+    return results
+
+
+def check_config_worker(cfg_filename, dev_type):
+
+    """
+    Check a single config file and capture the messages printed by the
+    checks. Returns a tuple of the result and the list of messages.
+    """
+
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        try:
+            passed = check_config_file(cfg_filename, dev_type)
+        except Exception as e:
+            print("Unable to check syntax for config file {}: {}".
+                  format(cfg_filename, e))
+            passed = False
+
+    return passed, output.getvalue().splitlines()
+
+
+def check_ios_bd(cfg_line, tokens):
+
+    bd = tokens[1] # "100"
     if not is_valid_bd(bd):
         print("Invalid bridge-domain: {}".format(cfg_line))
         return False
@@ -28,15 +265,15 @@ def check_ios_bd(cfg_line):
     return True
 
 
-def check_ios_bgp_neigh_addr(cfg_line):
+def check_ios_bgp_neigh_addr(cfg_line, tokens):
 
     # Crude IPv4/IPv6 test..
 
     # Is IPv4
-    if len(cfg_line.split(".")) > 1:
+    if "." in cfg_line:
 
         # "neighbor 10.0.0.1"
-        ipv4_neigh = cfg_line.split()[1] # "10.0.0.1"
+        ipv4_neigh = tokens[1] # "10.0.0.1"
         if not is_valid_ipv4_address(ipv4_neigh):
             print("Invalid IPv4 BGP neighbour address: {}".format(cfg_line))
             return False
@@ -48,7 +285,7 @@ def check_ios_bgp_neigh_addr(cfg_line):
     else:
 
         # "neighbor 1::1:2:3:4"
-        ipv6_neigh = cfg_line.split()[1] # "1::1:2:3:4"
+        ipv6_neigh = tokens[1] # "1::1:2:3:4"
         if not is_valid_ipv4_address(ipv6_neigh):
             print("Invalid IPv6 BGP neighbour address: {}".format(cfg_line))
             return False
@@ -57,9 +294,9 @@ def check_ios_bgp_neigh_addr(cfg_line):
             return True
 
 
-def check_ios_int_desc(cfg_line):
+def check_ios_int_desc(cfg_line, tokens):
 
-    int_desc = cfg_line.split()[1] # "core|CORE-LD4-PE1|xe-2/2/8|Carrier1|C1234|10G|DWDM wave via Ciena"
+    int_desc = tokens[1] # "core|CORE-LD4-PE1|xe-2/2/8|Carrier1|C1234|10G|DWDM wave via Ciena"
     if not is_valid_int_desc(int_desc):
         print("Invalid interface description format: {}".format(cfg_line))
         return False
@@ -67,9 +304,9 @@ def check_ios_int_desc(cfg_line):
     return True
 
 
-def check_ios_int_ipv4_helper(cfg_line):
+def check_ios_int_ipv4_helper(cfg_line, tokens):
 
-    ipv4_helper = cfg_line.split()[2] # "10.0.0.1"
+    ipv4_helper = tokens[2] # "10.0.0.1"
     if not is_valid_ipv4_address(ipv4_helper):
         print("Invalid IPv4 helper address: {}".format(cfg_line))
         return False
@@ -77,18 +314,18 @@ def check_ios_int_ipv4_helper(cfg_line):
     return True
 
 
-def check_ios_int_ipv4(cfg_line):
+def check_ios_int_ipv4(cfg_line, tokens):
 
     ret_val = True
 
-    ipv4_addr = cfg_line.split()[2] # "10.0.0.1"
+    ipv4_addr = tokens[2] # "10.0.0.1"
     if not is_valid_ipv4_address(ipv4_addr):
         print("Invalid IPv4 address: {}".format(cfg_line))
         ret_val = False
 
     try:
         # Check dotted subnet mask
-        ipv4_mask = cfg_line.split()[3] # "255.255.255.0"
+        ipv4_mask = tokens[3] # "255.255.255.0"
         if not is_valid_ipv4_mask(ipv4_mask, dotted=True):
             print("Invalid IPv4 subnet mask: {}".format(cfg_line))
             ret_val = False
@@ -96,7 +333,7 @@ def check_ios_int_ipv4(cfg_line):
 
         try:
             # Check CIDR subnet mask
-            ipv4_mask = cfg_line.split()[2].split("/")[1] # "24"
+            ipv4_mask = tokens[2].split("/")[1] # "24"
             if not is_valid_ipv4_mask(ipv4_mask, dotted=False):
                 print("Invalid IPv4 subnet mask: {}".format(cfg_line))
                 ret_val = False
@@ -106,18 +343,18 @@ def check_ios_int_ipv4(cfg_line):
     return ret_val
 
 
-def check_ios_int_ipv6(cfg_line):
+def check_ios_int_ipv6(cfg_line, tokens):
 
     ret_val = True
 
-    ipv6_addr = cfg_line.split()[2].split("/")[0] # "a:b:c:d::1"
+    ipv6_addr = tokens[2].split("/")[0] # "a:b:c:d::1"
     if not is_valid_ipv6_address(ipv6_addr):
         print("Invalid IPv6 address: {}".format(cfg_line))
         ret_val = False
 
      # Check CIDR subnet mask
     try:
-        ipv6_mask = cfg_line.split()[2].split("/")[1] # "64"
+        ipv6_mask = tokens[2].split("/")[1] # "64"
         if not is_valid_ipv6_mask(ipv6_mask):
             print("Invalid IPv6 subnet mask: {}".format(cfg_line))
             ret_val = False
@@ -127,21 +364,21 @@ def check_ios_int_ipv6(cfg_line):
     return ret_val
 
 
-def check_ios_rid(cfg_line):
+def check_ios_rid(cfg_line, tokens):
 
     # Crude IPv4/IPv6 test..
 
     # Is IPv4
-    if len(cfg_line.split(".")) > 1:
+    if "." in cfg_line:
 
         # Try OSPF: "router-id 10.0.0.1"
-        ipv4_rid = cfg_line.split()[1] # "10.0.0.1"
+        ipv4_rid = tokens[1] # "10.0.0.1"
         if is_valid_ipv4_address(ipv4_rid):
             return True
 
          # Try BGP: "bgp router-id 10.0.0.1"
         else:
-            ipv4_rid = cfg_line.split()[2] # "10.0.0.1"
+            ipv4_rid = tokens[2] # "10.0.0.1"
             if is_valid_ipv4_address(ipv4_rid):
                 return True
             else:
@@ -152,7 +389,7 @@ def check_ios_rid(cfg_line):
     else:
 
         # Try BGP: "bgp router-id 1::2:3:4:5"
-        ipv6_rid = cfg_line.split()[1] # OSPF "10.0.0.1"
+        ipv6_rid = tokens[1] # OSPF "10.0.0.1"
         if not is_valid_ipv6_address(ipv6_rid):
             print("Invalid IPv6 router ID: {}".format(cfg_line))
             return False
@@ -161,9 +398,9 @@ def check_ios_rid(cfg_line):
             return True
 
 
-def check_ios_isis_net(cfg_line):
+def check_ios_isis_net(cfg_line, tokens):
     
-    isis_net = cfg_line.split()[1] # "49.0001.0101.0500.0192.00"
+    isis_net = tokens[1] # "49.0001.0101.0500.0192.00"
     if not is_valid_isis_nsap(isis_net):
         print("Invalid ISIS NET: {}".format(cfg_line))
         return False
@@ -171,10 +408,10 @@ def check_ios_isis_net(cfg_line):
     return True
 
 
-def check_ios_vrf_rd(cfg_line):
+def check_ios_vrf_rd(cfg_line, tokens):
 
 
-    rd = cfg_line.split()[1] # "10.0.0.1:100"
+    rd = tokens[1] # "10.0.0.1:100"
     if not is_valid_rd(rd):
         print("Invalid route distinguisher: {}".format(cfg_line))
         return False
@@ -182,9 +419,9 @@ def check_ios_vrf_rd(cfg_line):
     return True
 
 
-def check_ios_vrf_rt(cfg_line):
+def check_ios_vrf_rt(cfg_line, tokens):
 
-    rt = cfg_line.split()[2] # "123:456"
+    rt = tokens[2] # "123:456"
     if not is_valid_rt(rt):
         print("Invalid route-target: {}".format(cfg_line))
         return False
@@ -192,9 +429,9 @@ def check_ios_vrf_rt(cfg_line):
     return True
 
 
-def check_junos_bd_vlan_id(cfg_line):
+def check_junos_bd_vlan_id(cfg_line, tokens):
 
-    vlan_id = cfg_line.split()[4] # "100"
+    vlan_id = tokens[4] # "100"
     if not is_valid_bd(vlan_id):
         print("Invalid bridge-domain VLAN ID: {}".format(cfg_line))
         return False
@@ -202,7 +439,7 @@ def check_junos_bd_vlan_id(cfg_line):
     return True
 
 
-def check_junos_int_desc(cfg_line):
+def check_junos_int_desc(cfg_line, tokens):
 
     int_desc = cfg_line.split("description")[1] # "core|CORE-LD4-PE1|xe-2/2/8|Carrier1|C1234|10G|DWDM wave via Ciena"
     if not is_valid_int_desc(int_desc):
@@ -212,9 +449,9 @@ def check_junos_int_desc(cfg_line):
     return True
 
 
-def check_junos_int_vlan_id(cfg_line):
+def check_junos_int_vlan_id(cfg_line, tokens):
 
-    vlan_id = cfg_line.split()[6] # "100"
+    vlan_id = tokens[6] # "100"
     if not is_valid_bd(vlan_id):
         print("Invalid VLAN ID: {}".format(cfg_line))
         return False
@@ -222,18 +459,18 @@ def check_junos_int_vlan_id(cfg_line):
     return True
 
 
-def check_junos_int_ipv4(cfg_line):
+def check_junos_int_ipv4(cfg_line, tokens):
 
     ret_val = True
 
-    ipv4_addr = cfg_line.split()[8].split("/")[0] # "10.0.0.1"
+    ipv4_addr = tokens[8].split("/")[0] # "10.0.0.1"
     if not is_valid_ipv4_address(ipv4_addr):
         print("Invalid IPv4 address: {}".format(cfg_line))
         ret_val = False
 
     try:
         # Check CIDR subnet mask
-        ipv4_mask = cfg_line.split()[8].split("/")[1] # "24"
+        ipv4_mask = tokens[8].split("/")[1] # "24"
         if not is_valid_ipv4_mask(ipv4_mask, dotted=False):
             print("Invalid IPv4 subnet mask: {}".format(cfg_line))
             ret_val = False
@@ -243,18 +480,18 @@ def check_junos_int_ipv4(cfg_line):
     return ret_val
 
 
-def check_junos_int_ipv6(cfg_line):
+def check_junos_int_ipv6(cfg_line, tokens):
 
     ret_val = True
 
-    ipv6_addr = cfg_line.split()[8].split("/")[0] # "a:b:c:d::1"
+    ipv6_addr = tokens[8].split("/")[0] # "a:b:c:d::1"
     if not is_valid_ipv6_address(ipv6_addr):
         print("Invalid IPv6 address: {}".format(cfg_line))
         ret_val = False
 
      # Check CIDR subnet mask
     try:
-        ipv6_mask = cfg_line.split()[8].split("/")[1] # "64"
+        ipv6_mask = tokens[8].split("/")[1] # "64"
         if not is_valid_ipv6_mask(ipv6_mask):
             print("Invalid IPv6 subnet mask: {}".format(cfg_line))
             ret_val = False
@@ -264,6 +501,26 @@ def check_junos_int_ipv6(cfg_line):
     return ret_val
 
 
+def get_cache_key(cfg_filename, dev_type):
+
+    """
+    The cache key is a hash of the file content, the device type and the
+    rules version. Returns None if the file can't be read, it won't be
+    cached.
+    """
+
+    if not RULES_VERSION:
+        return None
+
+    try:
+        with open(cfg_filename, 'rb') as cfg_file:
+            content_hash = hashlib.sha256(cfg_file.read()).hexdigest()
+    except Exception:
+        return None
+
+    return "{}:{}:{}".format(RULES_VERSION, dev_type, content_hash)
+
+
 def is_valid_bd(bd):
 
     if not bd.isdigit():
@@ -280,8 +537,7 @@ def is_valid_int_desc(int_desc):
 
     # The format used is 6 fields seperated by a vertical pipe
     # "link_type|remote_device_hostname|remote_interface_name|circuit_provider|circuit_ref|circuit_speed|free_text"
-    desc = r"(.*\|){6}"
-    if not re.search(desc, int_desc):
+    if not INT_DESC.search(int_desc):
         return False
 
     return True
@@ -355,9 +611,7 @@ def is_valid_isis_nsap(net):
 
     # Assume NSAP starts with 49 for private areas and ends with either 
     # .00 or .0000
-    NSAP = r"49\.[0-9][0-9][0-9][0-9]\.[0-9][0-9][0-9][0-9]\.[0-9][0-9][0-9][0-9]\.[0-9][0-9][0-9][0-9]\.(00$|0000$)"
-
-    if not re.search(NSAP, net):
+    if not ISIS_NSAP.search(net):
         return False
 
     return True
@@ -426,6 +680,50 @@ def is_valid_rt(rt):
     return True
 
 
+def list_config_files(paths, dev_type):
+
+    """
+    Expand a list of config files and directories into a list of
+    (cfg_filename, dev_type) tuples. Every file in a directory is checked.
+    """
+
+    config_files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                cfg_filename = os.path.join(path, filename)
+                if os.path.isfile(cfg_filename):
+                    config_files.append((cfg_filename, dev_type))
+        else:
+            config_files.append((path, dev_type))
+
+    return config_files
+
+
+def load_cache(cache_file):
+
+    """
+    The cache is stored as a list of [key, result] pairs, least recently
+    used first.
+    """
+
+    cache = OrderedDict()
+
+    if not os.path.isfile(cache_file):
+        return cache
+
+    try:
+        with open(cache_file) as cache_log:
+            for key, entry in json.load(cache_log):
+                cache[key] = entry
+    except Exception as e:
+        print("Couldn't load syntax check cache {}: {}".format(cache_file, e))
+        return OrderedDict()
+
+    return cache
+
+
 def parse_cli_args():
 
     parser = argparse.ArgumentParser(
@@ -434,11 +732,34 @@ def parse_cli_args():
     )
     parser.add_argument(
         '-c', '--config-file',
-        help='Config file to check.',
+        help='Config file(s) to check. If a directory is given every file in '
+             'it is checked.',
         type=str,
+        nargs='+',
         default=None,
         required=True
     )
+    parser.add_argument(
+        '--cache-file',
+        help='Cache of previous check results, keyed by the config file '
+             'content. To disable the cache add the option --cache-file \'\'.',
+        type=str,
+        default=CACHE_FILE,
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='Maximum number of results to keep in the cache, the least '
+             'recently used results are removed first.',
+        type=int,
+        default=CACHE_SIZE,
+    )
+    parser.add_argument(
+        '-r', '--results',
+        help='Write the result of each config file check to this file in '
+             'JSON format, use - for stdout.',
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '-t', '--type',
         help='The device type of the config file being checked (use NAPALM '
@@ -447,170 +768,141 @@ def parse_cli_args():
         default=None,
         required=True
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of worker processes used to check the config files.',
+        type=int,
+        default=1,
+    )
 
     return vars(parser.parse_args())
 
 
-def validate_ios_config(config):
-
-    ret_val = True
+def save_cache(cache_file, cache):
 
-    IOS_BD = r"bridge- "
-    IOS_BGP_NEIGH_ADDR = r"nei "
-    IOS_INT_DESC = r" des"
-    IOS_IPV4_ADDRESS = r"ip addr"
-    IOS_IPV4_HELPER = r"ip help"
-    IOS_IPV6_ADDRESS = r"ipv6 addr"
-    IOS_ISIS_NET = r" net "
-    IOS_RID = r"router-id"
-    IOS_VRF_RT = r"route-target (ex|im|bo)"
-    IOS_VRF_RD = r"rd [1-9]"
+    # Write to a temporary file then rename it so that another run never
+    # reads a partially written cache
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir,
+                                         delete=False) as cache_log:
+            json.dump(list(cache.items()), cache_log)
+        os.replace(cache_log.name, cache_file)
+    except Exception as e:
+        print("Couldn't save syntax check cache {}: {}".format(cache_file, e))
 
 
-    for cfg_line in config:
+def save_results(filename, results):
 
+    if filename == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
 
-        if re.search(IOS_BD, cfg_line):
-            # Check bridge-domain ID
-            if not check_ios_bd(cfg_line.strip()):
-                ret_val = False
+    try:
+        with open(filename, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    except Exception as e:
+        print("Couldn't save results to {}: {}".format(filename, e))
 
-        elif re.search(IOS_BGP_NEIGH_ADDR, cfg_line):
-            # Check BGP neighbor IP address, could be IPv4 or IPv6!
-            if not check_ios_bgp_neigh_addr(cfg_line.strip()):
-                ret_val = False
 
-        elif re.search(IOS_INT_DESC, cfg_line):
-            # Check interface description format
-            if not check_ios_int_desc(cfg_line.strip()):
-                ret_val = False
+def validate_config(config, rules, checks):
 
-        elif re.search(IOS_IPV4_ADDRESS, cfg_line):
-            # Check interface IPv4 address and mask
-            if not check_ios_int_ipv4(cfg_line.strip()):
-                ret_val = False
+    """
+    Classify each config line against the combined rules. Lines which don't
+    match any rule, which is most of them, are skipped after a single regex
+    search. Matching lines are tokenised once and passed to the check for
+    the highest priority rule they matched.
+    """
 
-        elif re.search(IOS_IPV4_HELPER, cfg_line):
-            # Check interface IPv4 helper address
-            if not check_ios_int_ipv4_helper(cfg_line.strip()):
-                ret_val = False
+    any_rule, first_rule = rules
 
-        elif re.search(IOS_IPV6_ADDRESS, cfg_line):
-            # Check interface IPv6 address and mask
-            if not check_ios_int_ipv6(cfg_line.strip()):
-                ret_val = False
+    ret_val = True
 
-        elif re.search(IOS_ISIS_NET, cfg_line):
-            # Check ISIS NET
-            if not check_ios_isis_net(cfg_line.strip()):
-                ret_val = False
+    for cfg_line in config:
 
-        elif re.search(IOS_RID, cfg_line):
-            # Check router ID e.g. OSPF or BGP, could be IPv4 or IPv6!
-            if not check_ios_rid(cfg_line.strip()):
-                ret_val = False
+        if not any_rule.search(cfg_line):
+            continue
 
-        elif re.search(IOS_VRF_RD, cfg_line):
-            # Check VRF route distinguisher
-            if not check_ios_vrf_rd(cfg_line.strip()):
-                ret_val = False
+        match = first_rule.match(cfg_line)
 
-        elif re.search(IOS_VRF_RT, cfg_line):
-            # Check VRF route target
-            if not check_ios_vrf_rt(cfg_line.strip()):
-                ret_val = False
+        cfg_line = cfg_line.strip()
+        if not checks[match.lastgroup](cfg_line, cfg_line.split()):
+            ret_val = False
 
     return ret_val
 
 
-def validate_junos_config(config):
-
-    ret_val = True
-
-    JUNOS_BD_VLAN_ID = r"set bridge-domains .* vlan-id "
-    JUNOS_INT_DESC = r"set interfaces .* des"
-    JUNOS_INT_VLAN_ID = r"set interfaces [a-z]+(-?)[0-9](/?[0-9]?)+ unit [0-9]+ vlan-id "
-    JUNOS_IPV4_ADDRESS = r"set interfaces [a-z]+(-?)[0-9](/?[0-9]?)+ unit [0-9]+ family inet address "
-    JUNOS_IPV6_ADDRESS = r"set interfaces [a-z]+(-?)[0-9](/?[0-9]?)+ unit [0-9]+ family inet6 address "
-
-
-    for cfg_line in config:
-
-        if re.search(JUNOS_BD_VLAN_ID, cfg_line):
-            # Check bridge-domain VLAN ID
-            if not check_junos_bd_vlan_id(cfg_line.strip()):
-                ret_val = False
-
-        elif re.search(JUNOS_INT_DESC, cfg_line):
-            # Check interface description format
-            if not check_junos_int_desc(cfg_line.strip()):
-                ret_val = False
+def validate_ios_config(config):
 
-        elif re.search(JUNOS_INT_VLAN_ID, cfg_line):
-            # Check VLAN number
-            if not check_junos_int_vlan_id(cfg_line.strip()):
-                ret_val = False
+    checks = {
+        # Check bridge-domain ID
+        'bd': check_ios_bd,
+        # Check BGP neighbor IP address, could be IPv4 or IPv6!
+        'bgp_neigh_addr': check_ios_bgp_neigh_addr,
+        # Check interface description format
+        'int_desc': check_ios_int_desc,
+        # Check interface IPv4 address and mask
+        'ipv4_address': check_ios_int_ipv4,
+        # Check interface IPv4 helper address
+        'ipv4_helper': check_ios_int_ipv4_helper,
+        # Check interface IPv6 address and mask
+        'ipv6_address': check_ios_int_ipv6,
+        # Check ISIS NET
+        'isis_net': check_ios_isis_net,
+        # Check router ID e.g. OSPF or BGP, could be IPv4 or IPv6!
+        'rid': check_ios_rid,
+        # Check VRF route distinguisher
+        'vrf_rd': check_ios_vrf_rd,
+        # Check VRF route target
+        'vrf_rt': check_ios_vrf_rt,
+    }
+
+    return validate_config(config, IOS_RULES, checks)
 
-        elif re.search(JUNOS_IPV4_ADDRESS, cfg_line):
-            # Check interface IPv4 address and mask
-            if not check_junos_int_ipv4(cfg_line.strip()):
-                ret_val = False
 
-        elif re.search(JUNOS_IPV6_ADDRESS, cfg_line):
-            # Check interface IPv6 address and mask
-            if not check_junos_int_ipv6(cfg_line.strip()):
-                ret_val = False
+def validate_junos_config(config):
 
+    checks = {
+        # Check bridge-domain VLAN ID
+        'bd_vlan_id': check_junos_bd_vlan_id,
+        # Check interface description format
+        'int_desc': check_junos_int_desc,
+        # Check VLAN number
+        'int_vlan_id': check_junos_int_vlan_id,
+        # Check interface IPv4 address and mask
+        'ipv4_address': check_junos_int_ipv4,
+        # Check interface IPv6 address and mask
+        'ipv6_address': check_junos_int_ipv6,
+    }
 
-    return ret_val
+    return validate_config(config, JUNOS_RULES, checks)
 
 
 def main():
     
     args = parse_cli_args()
 
-    cfg_filename = args['config_file']
-    
-    check_file_exists(cfg_filename)
-
-    print("Syntax checking: {}".format(cfg_filename))
-
+    config_files = list_config_files(args['config_file'], args['type'])
 
-    config = []
-
-    try:
-        cfg_file = open(cfg_filename)
-    except Exception as e:
-        print("Couldn't open config file {}: {}".format(cfg_filename, e))
-        sys.exit(1)
-
-    try:
-        config = cfg_file.readlines()
-    except Exception as e:
-        print("Couldn't load config file {}: {}".format(cfg_filename, e))
-        cfg_file.close()
-        sys.exit(1)
+    # Print the messages to stderr if the results are going to stdout
+    if args['results'] == '-':
+        with contextlib.redirect_stdout(sys.stderr):
+            results = check_config_files(config_files, args['workers'],
+                                         args['cache_file'],
+                                         args['cache_size'])
+    else:
+        results = check_config_files(config_files, args['workers'],
+                                     args['cache_file'], args['cache_size'])
 
-    cfg_file.close()
+    if args['results']:
+        save_results(args['results'], results)
 
-    if args['type'] == "ios":
-        if validate_ios_config(config):
-            print("Config passed without issue")
-        else:
-            print("Config file failed checks")
+    for result in results:
+        if not result['passed']:
             sys.exit(1)
 
-    elif args['type'] == 'junos':
-        if validate_junos_config(config):
-            print("Config passed without issue")
-        else:
-            print("Config file failed checks")
-            sys.exit(1)
-
-    else:
-        print("Unsupported device type: {}".format(args['type']))
-        sys.exit(1)
-
 
 if __name__ == '__main__':
     sys.exit(main())